@@ -9,5 +9,23 @@ from DaemonCerts.DaemonCerts import DaemonCerts
 
 if __name__ == '__main__':
     import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "keypool-fill":
+        from DaemonCerts.KeyPool import fill_main
+        sys.exit(fill_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from DaemonCerts.BatchIssuer import batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "inventory":
+        from DaemonCerts.Inventory import inventory_main
+        sys.exit(inventory_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "renew-daemon":
+        from DaemonCerts.RenewalDaemon import renew_daemon_main
+        sys.exit(renew_daemon_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from DaemonCerts.IssuingService import serve_main
+        sys.exit(serve_main(sys.argv[2:]))
+    if "--plan" in sys.argv[1:]:
+        from DaemonCerts.ChangePlanner import plan_main
+        sys.exit(plan_main(sys.argv[1:]))
     dc = DaemonCerts(sys.argv[1:])
     dc.main()
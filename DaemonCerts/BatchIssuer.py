@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import traceback
+from os.path import join
+
+from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings, SETTINGS_FLAGS
+from DaemonCerts.SiteProvisioner import SiteProvisioner, flatten_settings
+from DaemonCerts.Errors import DaemonCertsError
+
+# Issues the certificates and configurations of many sites in a single process, through SiteProvisioner.
+# All sites share the CA (directory.ca). Per crypto.backend they share the loaded CAContext, the SerialAllocator
+# and the CertificateDatabase. A site succeeded, if its run returned a RunResult, errors are DaemonCertsErrors.
+#
+# YAML manifest:
+#   defaults:                  # optional, applied to every site
+#     cert.Organization: MyOrganization
+#   sites:
+#     - name: site-a           # optional, defaults to the FQDN
+#       FQDN: a.example.com
+#       GCID: SITE-A
+#       Domains:
+#         UNITY: unity.a.example.com
+#
+# CSV manifest: one site per row, the header contains the setting names (name,FQDN,GCID,Domains.UNITY,...).
+# Empty cells are ignored.
+
+# These settings have to be the same for all sites, because all sites share the CA.
+SHARED_SETTINGS = ["directory.ca", "CAMODE"]
+# Per site output directories, relative to the output directory of the site if not given in the manifest.
+SITE_DIRECTORIES = [
+    ("directory.unicore", "unicore"),
+    ("directory.certs", join("unicore", "certs")),
+    ("directory.support", "supportfiles"),
+    ("directory.csrs", "csrs")
+]
+
+def read_manifest(filename):
+    """
+    Returns (defaults, sites), both flat dicts of dotted setting names.
+    """
+    if filename.lower().endswith(".csv"):
+        import csv
+        with open(filename, 'r') as infile:
+            rows = list(csv.DictReader(infile))
+        sites = [dict((key.strip(), value.strip()) for key, value in row.items() if key and value and value.strip())
+                 for row in rows]
+        return {}, sites
+
+    import yaml
+    with open(filename, 'r') as infile:
+        manifest = yaml.safe_load(infile)
+    if isinstance(manifest, list):
+        manifest = {"sites": manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("sites"), list):
+        raise ValueError("Manifest %s has to contain a list of sites." % filename)
+    defaults = flatten_settings(manifest.get("defaults") or {})
+    sites = [flatten_settings(site) for site in manifest["sites"]]
+    return defaults, sites
+
+
+class SiteResult(object):
+    def __init__(self, name):
+        super(SiteResult,self).__init__()
+        self.name = name
+        self.success = False
+        self.message = ""
+        # RunResult of a successful site
+        self.result = None
+
+
+class BatchIssuer(object):
+    def __init__(self, sites, defaults = None, overrides = None, output_dir = "sites", provisioner = None):
+        # overrides (settings of the command line) win over defaults and sites. provisioner is a SiteProvisioner
+        # with the settings files, environment and logger of the batch.
+        super(BatchIssuer,self).__init__()
+        self.sites = sites
+        self.defaults = defaults or {}
+        self.overrides = overrides or {}
+        self.output_dir = output_dir
+        self.provisioner = provisioner if provisioner is not None else SiteProvisioner()
+
+    def site_name(self, site):
+        return str(site.get("name") or site.get("FQDN"))
+
+    def site_settings(self, site):
+        settings = dict(self.defaults)
+        for key, value in site.items():
+            if key in SHARED_SETTINGS:
+                raise ValueError("%s is shared by all sites and cannot be set per site." % key)
+            if key != "name":
+                settings[key] = value
+        if not settings.get("FQDN"):
+            raise ValueError("Site does not specify an FQDN.")
+        site_dir = join(self.output_dir, self.site_name(site))
+        for key, subdir in SITE_DIRECTORIES:
+            settings.setdefault(key, join(site_dir, subdir))
+        # Shared settings given on the command line win over everything in the manifest
+        settings.update(self.overrides)
+        return settings
+
+    def issue_site(self, site):
+        # Returns the RunResult, the serials, database and CA stay with the provisioner for the next site
+        return self.provisioner.provision(self.site_settings(site))
+
+    def run(self):
+        results = []
+        try:
+            for site in self.sites:
+                result = SiteResult(self.site_name(site))
+                results.append(result)
+                print("\n---- Site %s ----" % result.name)
+                try:
+                    result.result = self.issue_site(site)
+                    result.success = result.result is not None
+                except DaemonCertsError as e:
+                    result.message = str(e)
+                    print(e)
+                except Exception as e:
+                    result.message = "%s: %s" % (type(e).__name__, e)
+                    traceback.print_exc()
+        finally:
+            self.provisioner.close()
+        return results
+
+
+def stdout_logger():
+    # Progress messages of the sites on stdout, as printed by single site runs
+    import logging
+    logger = logging.getLogger("DaemonCerts.batch")
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+def write_report(results, outstream):
+    outstream.write("\nBatch issuance report:\n")
+    for result in results:
+        outstream.write("\t%-30s %s %s\n" % (result.name, "OK" if result.success else "FAILED", result.message))
+    failed = len([result for result in results if not result.success])
+    outstream.write("%d sites, %d succeeded, %d failed.\n" % (len(results), len(results) - failed, failed))
+
+
+def batch_main(sysargs):
+    """
+    CreateDaemonCerts.py batch MANIFEST [--output=DIR] [parameter=value ...]
+    Parameters given on the command line apply to all sites, e.g. directory.ca=./CA
+    So do --settings=FILE and --fleet-settings=FILE, the values of the manifest override them.
+    """
+    manifests = [arg for arg in sysargs if not arg.startswith("--") and not "=" in arg]
+    if len(manifests) != 1:
+        print("Usage: CreateDaemonCerts.py batch MANIFEST.yml|MANIFEST.csv [--output=DIR] [parameter=value ...]")
+        return 1
+    output_dir = "sites"
+    for arg in sysargs:
+        if arg.startswith("--output="):
+            output_dir = arg[len("--output="):]
+    # Settings files apply to all sites, below the values of the manifest
+    files = {}
+    overrides = {}
+    for arg in sysargs:
+        name, _, value = arg.partition("=")
+        if name in SETTINGS_FLAGS:
+            files[name] = value
+        elif not arg.startswith("--") and "=" in arg:
+            overrides[name] = value
+    cache_dir = None if "--no-settings-cache" in sysargs else DaemonCertsSettings.default_cache_dir()
+    provisioner = SiteProvisioner(logger=stdout_logger(), settings_file=files.get("--settings"),
+                                  fleet_file=files.get("--fleet-settings"), environ=os.environ, cache_dir=cache_dir)
+
+    defaults, sites = read_manifest(manifests[0])
+    issuer = BatchIssuer(sites, defaults=defaults, overrides=overrides, output_dir=output_dir, provisioner=provisioner)
+    results = issuer.run()
+    write_report(results, sys.stdout)
+    return 0 if all(result.success for result in results) else 2
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+from os.path import join
+
+from DaemonCerts.Errors import CAError
+from DaemonCerts.KeyGenerator import key_from_pem
+
+# The CA key and certificate, loaded and validated once per run.
+# All signing and truststore writing paths use the parsed objects and the PEM kept here.
+# The certificate is an object of the crypto backend (see CryptoBackend), the key a cryptography key.
+
+class CAContext(object):
+    def __init__(self, cert, key = None, backend = None):
+        super(CAContext,self).__init__()
+        self.cert = cert
+        self.key = key
+        self.backend = backend
+        self.cert_pem = backend.dump_certificate(cert)
+        if key is not None:
+            self.validate()
+
+    @staticmethod
+    def cert_path(ca_path):
+        return join(ca_path, "cacert.pem")
+
+    @staticmethod
+    def key_path(ca_path):
+        return join(ca_path, "private", "cakey.pem")
+
+    @classmethod
+    def load(cls, ca_path, require_key = True, backend = None):
+        # With require_key == False only the certificate is loaded, as in INSTALLCSR mode
+        cert_path = cls.cert_path(ca_path)
+        try:
+            with open(cert_path, 'rb') as infile:
+                cert = backend.load_certificate(infile.read())
+        except (IOError, OSError, ValueError, backend.Error) as e:
+            raise CAError("Could not load CA certificate %s: %s" % (cert_path, e))
+        context = cls(cert, backend=backend)
+        if require_key:
+            context.load_key(ca_path)
+        return context
+
+    def load_key(self, ca_path):
+        key_path = self.key_path(ca_path)
+        try:
+            with open(key_path, 'rb') as infile:
+                self.key = key_from_pem(infile.read())
+        except (IOError, OSError, ValueError, TypeError) as e:
+            raise CAError("Could not load CA key %s: %s" % (key_path, e))
+        self.validate()
+
+    def validate(self):
+        if not self.backend.public_key_matches(self.cert, self.key):
+            raise CAError("The CA key does not belong to the CA certificate.")
+        if self.backend.has_expired(self.cert):
+            raise CAError("The CA certificate has expired.")
+
+    def write_cert(self, path, writer):
+        # Writes the CA certificate through writer (an OutputWriter), e.g. into a truststore
+        writer.write(path, self.cert_pem)
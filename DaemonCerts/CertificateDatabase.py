@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from os.path import join
+
+from DaemonCerts.utility.misc_file_functions import mkdir_p
+
+# Certificates issued by the self-signed CA, kept as SQLite database directory.ca/certificates.db.
+# Like the index.txt of openssl ca, but with one indexed row per certificate:
+#   serial, dn, san, daemon (server name or CA), site (GCID of the issuing run), not_after, fingerprint (sha256 of the DER),
+#   issued and the revocation state (revoked, revoked_at).
+# Times are UTC text (YYYY-MM-DD HH:MM:SS), which sorts like the times themselves.
+# Lookups by serial, DN, site and expiry window use indexes and stay in the millisecond range for large CAs.
+# sqlite3 is imported on first use.
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS certificates (
+        serial INTEGER PRIMARY KEY,
+        dn TEXT NOT NULL,
+        san TEXT,
+        daemon TEXT,
+        site TEXT,
+        not_after TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        issued TEXT NOT NULL,
+        revoked INTEGER NOT NULL DEFAULT 0,
+        revoked_at TEXT)""",
+    "CREATE INDEX IF NOT EXISTS certificates_dn ON certificates (dn)",
+    "CREATE INDEX IF NOT EXISTS certificates_site ON certificates (site, daemon)",
+    "CREATE INDEX IF NOT EXISTS certificates_not_after ON certificates (not_after)",
+    "CREATE INDEX IF NOT EXISTS certificates_fingerprint ON certificates (fingerprint)"
+]
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def format_time(value):
+    # datetime (UTC) -> database text
+    return value.strftime(TIME_FORMAT)
+
+class CertificateDatabase(object):
+    FILENAME = "certificates.db"
+
+    def __init__(self, ca_path):
+        super(CertificateDatabase,self).__init__()
+        self.ca_path = ca_path
+        self.path = join(ca_path, self.FILENAME)
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            import sqlite3
+            mkdir_p(self.ca_path)
+            # Concurrent runs sharing the CA wait for each other's transactions
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.row_factory = sqlite3.Row
+            with self._connection:
+                for statement in SCHEMA:
+                    self._connection.execute(statement)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def add(self, serial, dn, san, daemon, site, not_after, fingerprint, issued = None):
+        # not_after and issued are datetimes (UTC), issued defaults to now
+        import datetime
+        issued = issued or datetime.datetime.utcnow()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO certificates (serial, dn, san, daemon, site, not_after, fingerprint, issued) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (serial, dn, san, daemon, site, format_time(not_after), fingerprint, format_time(issued)))
+
+    def add_many(self, rows):
+        # rows: [(serial, dn, san, daemon, site, not_after, fingerprint, issued), ...] in a single transaction
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO certificates (serial, dn, san, daemon, site, not_after, fingerprint, issued) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [row[:5] + (format_time(row[5]), row[6], format_time(row[7])) for row in rows])
+
+    def revoke(self, serial, when = None):
+        # Returns False, if the serial is unknown
+        import datetime
+        when = when or datetime.datetime.utcnow()
+        with self.connection:
+            cursor = self.connection.execute("UPDATE certificates SET revoked = 1, revoked_at = ? WHERE serial = ?",
+                                             (format_time(when), serial))
+        return cursor.rowcount > 0
+
+    def _select(self, where, parameters):
+        cursor = self.connection.execute("SELECT * FROM certificates WHERE %s ORDER BY serial" % where, parameters)
+        return [dict(row) for row in cursor]
+
+    def by_serial(self, serial):
+        rows = self._select("serial = ?", (serial,))
+        return rows[0] if rows else None
+
+    def by_dn(self, dn):
+        return self._select("dn = ?", (dn,))
+
+    def by_fingerprint(self, fingerprint):
+        return self._select("fingerprint = ?", (fingerprint,))
+
+    def by_site(self, site, daemon = None):
+        if daemon is None:
+            return self._select("site = ?", (site,))
+        return self._select("site = ? AND daemon = ?", (site, daemon))
+
+    def expiring(self, before, after = None, include_revoked = False):
+        # Certificates with not_after in [after, before), after and before are datetimes (UTC)
+        where = "not_after < ?"
+        parameters = [format_time(before)]
+        if after is not None:
+            where += " AND not_after >= ?"
+            parameters.append(format_time(after))
+        if not include_revoked:
+            where += " AND revoked = 0"
+        return self._select(where, parameters)
+
+    def current(self, site):
+        # The newest certificate (highest serial) of every daemon of site
+        cursor = self.connection.execute("SELECT * FROM certificates AS c WHERE site = ? AND serial = "
+                                         "(SELECT MAX(serial) FROM certificates WHERE site = c.site AND daemon = c.daemon) "
+                                         "ORDER BY serial", (site,))
+        return [dict(row) for row in cursor]
+
+    def current_expiring(self, site, before):
+        # The newest certificates of the daemons of site, which are not revoked and expire before before (UTC datetime)
+        return [row for row in self.current(site) if not row["revoked"] and row["not_after"] < format_time(before)]
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM certificates").fetchone()[0]
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import difflib
+from os.path import join
+
+from DaemonCerts.Errors import DaemonCertsError
+from DaemonCerts.KeyGenerator import key_matches
+from DaemonCerts.utility.property_file_functions import plan_property_file
+
+# Dry run of DaemonCerts.main: computes, which files would change and which certificates would be issued,
+# using the same settings, outputs and run manifest as a real run. No keys are generated, nothing is written.
+#
+# The plan is a dict:
+# { "camode" : ..., "ca" : {"action", "path", "serial"}, "certs" : [ {"server", "action", "key", "serial", "dn", "reason"}, ... ],
+#   "files" : [ {"path", "kind", "action", "changes" : [ {"key", "old", "new"}, ... ], "diff" : [...]}, ... ],
+#   "unchanged" : number of unchanged outputs, "errors" : [ ... ] }
+# Only changing files are listed. Random values (see DaemonCerts.random_string) are shown as <SCRAMBLE>.
+# Keystores, certificates, keys and truststores of an issued, reissued, installed or requested certificate
+# (see DaemonCerts.cert_output_paths) are listed with "server" and "serial" of the certificate.
+
+PLAN_FLAGS = ["--plan", "--json"]
+
+class ChangePlanner(object):
+    def __init__(self, dc):
+        super(ChangePlanner,self).__init__()
+        self.dc = dc
+        self.dcs = dc.dcs
+        self.camode = self.dcs.get_value("CAMODE")
+        self.files = []
+        self.unchanged = 0
+        self.errors = []
+
+    def mask(self, value):
+        if value is None:
+            return None
+        for scrambled in self.dc.scrambled:
+            value = value.replace(scrambled, "<SCRAMBLE>")
+        return value
+
+    def add_file(self, path, kind, action, changes = None, diff = None, server = None, serial = None):
+        entry = {"path" : path, "kind" : kind, "action" : action}
+        if server is not None:
+            entry["server"] = server
+            entry["serial"] = serial
+        if changes is not None:
+            entry["changes"] = [{"key" : key, "old" : self.mask(old), "new" : self.mask(new)} for key, old, new in changes]
+        if diff is not None:
+            entry["diff"] = diff
+        self.files.append(entry)
+
+    def plan_output(self, key, path, content):
+        # Whole files written by DaemonCerts.write_output
+        if key is not None and self.dc.manifest.is_current(key, self.dc.input_fingerprint(content)):
+            self.unchanged += 1
+            return
+        if not os.path.isfile(path):
+            self.add_file(path, "file", "create")
+            return
+        with open(path, 'rb') as infile:
+            old = infile.read()
+        new = content if isinstance(content, bytes) else content.encode("UTF-8")
+        if old == new:
+            self.unchanged += 1
+            return
+        try:
+            diff = list(difflib.unified_diff(old.decode("UTF-8").splitlines(), new.decode("UTF-8").splitlines(),
+                                             "old", "new", lineterm=""))
+        except UnicodeDecodeError:
+            diff = None
+        self.add_file(path, "file", "modify", diff=diff)
+
+    def plan_ca(self):
+        ca_path = self.dcs.get_value("directory.ca")
+        cacert_path = join(ca_path, "cacert.pem")
+        if os.path.isfile(cacert_path):
+            return {"action" : "keep", "path" : cacert_path, "serial" : None}
+        if self.camode == "SELFSIGNED":
+            return {"action" : "create", "path" : cacert_path, "serial" : None}
+        if self.camode == "INSTALLCSR":
+            self.errors.append("The certificate of the CA is missing: %s" % cacert_path)
+        return {"action" : "missing", "path" : cacert_path, "serial" : None}
+
+    def plan_cert(self, server, ca_exists):
+        dc = self.dc
+        entry = {"server" : server, "action" : None, "key" : "keep", "serial" : None, "dn" : None, "reason" : None}
+        manifest_key = "cert:%s" % server
+        if ca_exists and self.camode != "CSR" and dc.cert_is_current(server):
+            entry["action"] = "keep"
+            entry["dn"] = dc.manifest.get_extra(manifest_key)["dn"]
+            return entry
+
+        p12_path = dc.get_p12_path(server)
+        key = cert = None
+        if not os.path.isfile(p12_path):
+            entry["key"] = "generate"
+        elif self.camode != "INSTALLCSR":
+            # A key of the wrong type or size is replaced (see gen_or_update_server_cert and gen_csr)
+            with open(p12_path, 'rb') as infile:
+                key, cert = dc.crypto.load_pkcs12(infile.read(), self.dcs.get_value('KeystorePass.%s' % server))
+            if not key_matches(key, *dc.get_key_parameters()):
+                entry["key"] = "generate"
+
+        if self.camode == "CSR":
+            entry["action"] = "request"
+            entry["dn"] = dc.expected_dn(server)
+        elif self.camode == "INSTALLCSR":
+            entry["action"] = "install"
+            mypem = join(self.dcs.get_value("directory.csrs"), server.lower() + ".pem")
+            if not os.path.isfile(mypem):
+                self.errors.append("Could not find the certificate of server %s: %s" % (server, mypem))
+            else:
+                with open(mypem, 'rb') as infile:
+                    cert = dc.crypto.load_certificate(infile.read())
+                entry["dn"] = dc.name_to_rfc4514(dc.crypto.subject_components(cert))
+            if entry["key"] == "generate":
+                self.errors.append("The keystore of server %s is missing: %s" % (server, p12_path))
+        elif entry["key"] == "generate":
+            entry["action"] = "reissue" if os.path.isfile(p12_path) else "issue"
+            entry["dn"] = dc.expected_dn(server)
+        else:
+            # An existing certificate is kept, unless it changed or expires soon (see DaemonCerts.reissue_reason)
+            entry["reason"] = dc.reissue_reason(server, key, cert) if ca_exists else "the CA is created"
+            entry["action"] = "keep" if entry["reason"] is None else "reissue"
+            entry["dn"] = dc.expected_dn(server)
+        return entry
+
+    def plan_cert_files(self, entry, ca_exists):
+        # Files written for the certificate of entry (see plan_cert). Keystores and certificates always change, PKCS#12 is salted.
+        # Truststores only change with the CA, keys only if a new one is generated.
+        if entry["action"] == "keep":
+            return
+        paths = self.dc.cert_output_paths(entry["server"])
+        if self.camode == "CSR":
+            # Only the keystore with the key, besides the request
+            paths = paths[:1]
+        for path, kind in paths:
+            exists = os.path.isfile(path)
+            if exists and kind == "key" and entry["key"] == "keep":
+                self.unchanged += 1
+                continue
+            if exists and kind == "truststore" and ca_exists:
+                with open(path, 'rb') as infile:
+                    if infile.read() == self.dc.get_ca(require_key=False).cert_pem:
+                        self.unchanged += 1
+                        continue
+            self.add_file(path, kind, "modify" if exists else "create", server=entry["server"], serial=entry["serial"])
+
+    def plan_xml(self):
+        dc = self.dc
+        existing = {}
+        for filename, attrib_and_value_dict in dc.static_xml_changes.items():
+            fingerprint = dc.input_fingerprint(attrib_and_value_dict, os.path.isfile(filename))
+            if dc.manifest.is_current("xml:%s" % filename, fingerprint):
+                self.unchanged += 1
+            elif os.path.isfile(filename):
+                existing[filename] = attrib_and_value_dict
+            else:
+                instructions = ""
+                for xpath, value in attrib_and_value_dict["values"]:
+                    instructions += "Change value of path <%s> to: <%s>\n" % (xpath, value)
+                for xpath, attrib, value in attrib_and_value_dict["attrib"]:
+                    instructions += "Change attribute <%s> of path <%s> to: <%s>\n" % (attrib, xpath, value)
+                self.plan_output(None, filename + ".instructions.txt", instructions)
+
+        if not existing:
+            # Nothing to parse, lxml is not needed
+            return
+        from DaemonCerts.XMLEditEngine import XMLEditEngine
+        engine = XMLEditEngine(existing)
+        for filename in sorted(existing):
+            try:
+                changes = engine.plan(filename)
+            except DaemonCertsError as e:
+                self.errors.append(str(e))
+                continue
+            if changes:
+                self.add_file(filename, "xml", "modify",
+                              [(xpath if attrib is None else "%s@%s" % (xpath, attrib), old, new)
+                               for xpath, attrib, old, new in changes])
+            else:
+                self.unchanged += 1
+
+    def plan_plain(self, plain_changes):
+        # plain_changes: [(manifest key, filename, changelist), ...] in the order of the real run
+        dc = self.dc
+        by_file = {}
+        order = []
+        for key, filename, changelist in plain_changes:
+            if dc.manifest.is_current(key, dc.input_fingerprint(changelist)):
+                continue
+            if not filename in by_file:
+                by_file[filename] = []
+                order.append(filename)
+            by_file[filename] += changelist
+        for filename in order:
+            changes = plan_property_file(filename, by_file[filename])
+            if changes:
+                self.add_file(filename, "plain", "modify" if os.path.isfile(filename) else "create", changes)
+            else:
+                self.unchanged += 1
+
+    def plan(self):
+        dc = self.dc
+        plan = {"camode" : self.camode, "ca" : None, "certs" : [], "files" : self.files, "unchanged" : 0, "errors" : self.errors}
+        if not self.camode in ["SELFSIGNED","CSR","INSTALLCSR"]:
+            self.errors.append("CAMODE has to be either SELFSIGNED, CSR or INSTALLCSR")
+            return plan
+        try:
+            dc.check_key_parameters()
+        except ValueError as e:
+            self.errors.append(str(e))
+            return plan
+
+        ca = self.plan_ca()
+        ca_exists = ca["action"] == "keep"
+        serial = dc.get_serials().peek()
+        if ca["action"] == "create":
+            ca["serial"] = serial
+            serial += 1
+        plan["ca"] = ca
+
+        support_path_dir = self.dcs.get_value("directory.support")
+        self.plan_output("support:arguments", join(support_path_dir, "installer_arguments.txt"), dc.get_arguments_text())
+
+        dn_list = []
+        for server in dc.servers:
+            entry = self.plan_cert(server, ca_exists)
+            if entry["action"] in ["issue", "reissue"]:
+                entry["serial"] = serial
+                serial += 1
+            plan["certs"].append(entry)
+            dn_list.append((server, entry["dn"]))
+            if ca_exists or self.camode != "INSTALLCSR":
+                self.plan_cert_files(entry, ca_exists)
+
+        if self.camode == "CSR":
+            csr_dir = self.dcs.get_value("directory.csrs")
+            for server in dc.servers:
+                csr_path = join(csr_dir, server.lower()) + ".pem.csr"
+                self.add_file(csr_path, "file", "modify" if os.path.isfile(csr_path) else "create")
+        if self.camode == "CSR" or not ca_exists and self.camode == "INSTALLCSR":
+            # The real run stops after the CSRs or without a CA certificate
+            plan["unchanged"] = self.unchanged
+            return plan
+
+        trustedpem = join(self.dcs.get_value("directory.certs"), "trusted", "cacert.pem")
+        if ca_exists:
+            self.plan_output("support:trustedpem", trustedpem, dc.get_ca(require_key=False).cert_pem)
+        else:
+            self.add_file(trustedpem, "file", "modify" if os.path.isfile(trustedpem) else "create")
+
+        plain_changes = []
+        for server, dn in dn_list:
+            files, hook_changes = dc.dn_hook_outputs(server, dn)
+            for key, path, content in files:
+                self.plan_output(key, path, content)
+            plain_changes += hook_changes
+        for key, path, content in dc.dn_list_outputs(dn_list):
+            self.plan_output(key, path, content)
+
+        self.plan_xml()
+        plain_changes += [("plain:%s" % filename, filename, changelist) for filename, changelist in dc.get_plainfile_changes().items()]
+        self.plan_plain(plain_changes)
+        for key, path, content in dc.config_outputs(dn_list):
+            self.plan_output(key, path, content)
+        self.plan_output("support:urlinfo", join(support_path_dir, "urlinfo.txt"), dc.get_url_info())
+
+        plan["unchanged"] = self.unchanged
+        return plan
+
+
+def write_plan(plan, outstream):
+    ca = plan["ca"]
+    if ca is not None and ca["action"] != "keep":
+        outstream.write("CA %s: %s%s\n" % (ca["action"], ca["path"], "" if ca["serial"] is None else " (serial %d)" % ca["serial"]))
+    for cert in plan["certs"]:
+        if cert["action"] == "keep":
+            continue
+        serial = "" if cert["serial"] is None else ", serial %d" % cert["serial"]
+        reason = "" if cert["reason"] is None else ", %s" % cert["reason"]
+        outstream.write("Certificate %s: %s (key: %s%s%s) DN: <%s>\n" % (cert["server"], cert["action"], cert["key"], serial, reason, cert["dn"]))
+    for entry in plan["files"]:
+        certificate = ""
+        if "server" in entry:
+            certificate = " (%s of server %s%s)" % (entry["kind"], entry["server"], "" if entry["serial"] is None else ", serial %d" % entry["serial"])
+        outstream.write("File %s: %s%s\n" % (entry["path"], entry["action"], certificate))
+        for change in entry.get("changes", []):
+            outstream.write("    %s: <%s> -> <%s>\n" % (change["key"], change["old"], change["new"]))
+        for line in entry.get("diff") or []:
+            outstream.write("    %s\n" % line)
+    for error in plan["errors"]:
+        outstream.write("Error: %s\n" % error)
+    changed_certs = len([cert for cert in plan["certs"] if cert["action"] != "keep"])
+    outstream.write("%d certificates and %d files would change, %d outputs are up to date.\n" %
+                    (changed_certs, len(plan["files"]), plan["unchanged"]))
+
+
+def plan_main(sysargs):
+    """
+    CreateDaemonCerts.py --plan [--json] parameter=value ...
+    Prints the changes a run with the same parameters would make. Returns 2, if the run would fail.
+    """
+    from DaemonCerts.DaemonCerts import DaemonCerts
+    dc = DaemonCerts([arg for arg in sysargs if not arg in PLAN_FLAGS])
+    plan = ChangePlanner(dc).plan()
+    if "--json" in sysargs:
+        json.dump(plan, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        write_plan(plan, sys.stdout)
+    return 2 if plan["errors"] else 0
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+import binascii
+
+from DaemonCerts.KeyGenerator import key_to_pem, key_from_pem
+
+# Certificates, requests and PKCS#12 keystores.
+# DaemonCerts describes a certificate as a CertSpec and leaves the encoding to a backend (setting crypto.backend):
+# - cryptography: the X.509 and PKCS#12 builders of the cryptography library. Default.
+# - pyopenssl: the OpenSSL.crypto module, which was used up to now. Most of it is deprecated upstream.
+# Private keys are cryptography key objects for both backends (see KeyGenerator).
+# Certificates and requests are objects of the backend and only handed back to it.
+#
+# Both backends write the same certificates for the same inputs: version 3, the subject in the given order,
+# the extensions of the CertSpec, sha256 signatures (none for Ed25519) and PKCS#12 keystores with 3DES and
+# 2048 iterations. The MAC of the cryptography backend is SHA1, as pyOpenSSL wrote it with OpenSSL 1.x
+# (OpenSSL 3 uses SHA256), which all Java versions read.
+# benchmarks/compare_backends.py checks this.
+
+BACKENDS = ["cryptography", "pyopenssl"]
+PKCS12_ITERATIONS = 2048
+
+class CertSpec(object):
+    def __init__(self):
+        super(CertSpec,self).__init__()
+        # [(attribute, value), ...] in the order of the DN. Attributes are the OpenSSL short names C, ST, L, O, OU, CN.
+        self.subject = []
+        # [(name, critical, value), ...] in OpenSSL config syntax, e.g. ("subjectAltName", False, "DNS:host, email:admin@host")
+        self.extensions = []
+
+    def add_extensions(self, extensions):
+        self.extensions += list(extensions)
+
+    def get_extension(self, name):
+        # Value of the first extension called name or None
+        for extension_name, _, value in self.extensions:
+            if extension_name == name:
+                return value
+        return None
+
+
+def _years_to_seconds(years):
+    return years * 365 * 24 * 60 * 60
+
+
+class CryptographyBackend(object):
+    name = "cryptography"
+    # Ed25519 keys sign without digest, which the builders support
+    signs_ed25519 = True
+    Error = ValueError
+
+    def __init__(self):
+        super(CryptographyBackend,self).__init__()
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+        self.x509 = x509
+        self.name_oids = {
+            "C" : NameOID.COUNTRY_NAME,
+            "ST" : NameOID.STATE_OR_PROVINCE_NAME,
+            "L" : NameOID.LOCALITY_NAME,
+            "O" : NameOID.ORGANIZATION_NAME,
+            "OU" : NameOID.ORGANIZATIONAL_UNIT_NAME,
+            "CN" : NameOID.COMMON_NAME,
+            "emailAddress" : NameOID.EMAIL_ADDRESS
+        }
+        self.oid_names = dict((oid, attribute) for attribute, oid in self.name_oids.items())
+        self.key_usages = {
+            "serverAuth" : ExtendedKeyUsageOID.SERVER_AUTH,
+            "clientAuth" : ExtendedKeyUsageOID.CLIENT_AUTH,
+            "codeSigning" : ExtendedKeyUsageOID.CODE_SIGNING,
+            "emailProtection" : ExtendedKeyUsageOID.EMAIL_PROTECTION,
+            "timeStamping" : ExtendedKeyUsageOID.TIME_STAMPING,
+            "OCSPSigning" : ExtendedKeyUsageOID.OCSP_SIGNING
+        }
+
+    def _name(self, subject):
+        x509 = self.x509
+        return x509.Name([x509.NameAttribute(self.name_oids[attribute], value) for attribute, value in subject])
+
+    def _general_name(self, entry):
+        x509 = self.x509
+        kind, _, value = entry.strip().partition(":")
+        if kind == "DNS":
+            return x509.DNSName(value)
+        if kind == "email":
+            return x509.RFC822Name(value)
+        if kind == "URI":
+            return x509.UniformResourceIdentifier(value)
+        if kind == "IP":
+            import ipaddress
+            return x509.IPAddress(ipaddress.ip_address(value))
+        raise ValueError("Unsupported subjectAltName entry: %s" % entry)
+
+    def _extension(self, name, value):
+        # OpenSSL config syntax -> extension object
+        x509 = self.x509
+        parts = [part.strip() for part in value.split(",")]
+        if name == "basicConstraints":
+            path_length = None
+            for part in parts:
+                if part.lower().startswith("pathlen:"):
+                    path_length = int(part.split(":")[1])
+            return x509.BasicConstraints(ca="CA:TRUE" in [part.upper() for part in parts], path_length=path_length)
+        if name == "extendedKeyUsage":
+            return x509.ExtendedKeyUsage([self.key_usages[part] for part in parts])
+        if name == "subjectAltName":
+            return x509.SubjectAlternativeName([self._general_name(part) for part in parts])
+        raise ValueError("Extension %s is not supported by the cryptography backend." % name)
+
+    def _add_extensions(self, builder, spec):
+        for name, critical, value in spec.extensions:
+            builder = builder.add_extension(self._extension(name, value), critical=critical)
+        return builder
+
+    @staticmethod
+    def _digest(key):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        if isinstance(key, ed25519.Ed25519PrivateKey):
+            return None
+        return hashes.SHA256()
+
+    def create_certificate(self, spec, key, serial, years, issuer_cert = None, issuer_key = None, public_key = None):
+        # Self-signed by key, if no issuer is given. public_key (e.g. of a request, see request_public_key)
+        # is certified instead of the one of key, key can then be None.
+        x509 = self.x509
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        subject = self._name(spec.subject)
+        builder = x509.CertificateBuilder().subject_name(subject)
+        builder = builder.issuer_name(issuer_cert.subject if issuer_cert is not None else subject)
+        builder = builder.public_key(public_key or key.public_key()).serial_number(serial)
+        builder = builder.not_valid_before(now).not_valid_after(now + datetime.timedelta(seconds=_years_to_seconds(years)))
+        builder = self._add_extensions(builder, spec)
+        signing_key = issuer_key if issuer_cert is not None else key
+        return builder.sign(signing_key, self._digest(signing_key))
+
+    def create_csr(self, spec, key):
+        builder = self.x509.CertificateSigningRequestBuilder().subject_name(self._name(spec.subject))
+        builder = self._add_extensions(builder, spec)
+        return builder.sign(key, self._digest(key))
+
+    def request_public_key(self, pem):
+        # Public key of a PEM request, ValueError if the request is not signed by its key
+        csr = self.x509.load_pem_x509_csr(pem)
+        if not csr.is_signature_valid:
+            raise ValueError("The signature of the certificate request is invalid.")
+        return csr.public_key()
+
+    def load_certificate(self, pem):
+        return self.x509.load_pem_x509_certificate(pem)
+
+    def dump_certificate(self, cert):
+        from cryptography.hazmat.primitives import serialization
+        return cert.public_bytes(serialization.Encoding.PEM)
+
+    def dump_csr(self, csr):
+        from cryptography.hazmat.primitives import serialization
+        return csr.public_bytes(serialization.Encoding.PEM)
+
+    def subject_components(self, cert):
+        # [(attribute, value), ...] of the subject of a certificate or request in the order of the DN
+        return [(self.oid_names.get(attribute.oid, attribute.oid.dotted_string), attribute.value) for attribute in cert.subject]
+
+    def public_key_matches(self, cert, key):
+        from cryptography.hazmat.primitives import serialization
+        spki = lambda public_key : public_key.public_bytes(serialization.Encoding.DER,
+                                                           serialization.PublicFormat.SubjectPublicKeyInfo)
+        return spki(cert.public_key()) == spki(key.public_key())
+
+    def has_expired(self, cert):
+        return cert.not_valid_after < datetime.datetime.utcnow()
+
+    def matches_spec(self, cert, spec):
+        # True, if cert has the subject and exactly the extensions of spec
+        if self.subject_components(cert) != list(spec.subject):
+            return False
+        expected = [(self._extension(name, value).oid.dotted_string, critical, self._extension(name, value))
+                    for name, critical, value in spec.extensions]
+        actual = [(extension.oid.dotted_string, extension.critical, extension.value) for extension in cert.extensions]
+        sort_key = lambda extension : extension[0]
+        return sorted(expected, key=sort_key) == sorted(actual, key=sort_key)
+
+    def issued_by(self, cert, issuer_cert):
+        # True, if cert names issuer_cert as issuer and carries a valid signature of its key
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
+        if cert.issuer != issuer_cert.subject:
+            return False
+        public_key = issuer_cert.public_key()
+        try:
+            if isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(cert.signature, cert.tbs_certificate_bytes, padding.PKCS1v15(), cert.signature_hash_algorithm)
+            elif isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(cert.signature, cert.tbs_certificate_bytes, ec.ECDSA(cert.signature_hash_algorithm))
+            else:
+                public_key.verify(cert.signature, cert.tbs_certificate_bytes)
+        except (InvalidSignature, TypeError):
+            return False
+        return True
+
+    def not_after(self, cert):
+        # naive datetime in UTC
+        return cert.not_valid_after
+
+    def serial(self, cert):
+        return cert.serial_number
+
+    def fingerprint(self, cert):
+        # sha256 of the DER encoding, lower case hex
+        from cryptography.hazmat.primitives import hashes
+        return binascii.hexlify(cert.fingerprint(hashes.SHA256())).decode("ascii")
+
+    def export_pkcs12(self, key, cert, passphrase):
+        # cert can be None for keystores holding only the key (CSR mode)
+        from cryptography.hazmat.primitives import serialization, hashes
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        password = passphrase.encode("UTF-8")
+        try:
+            encryption = (serialization.PrivateFormat.PKCS12.encryption_builder()
+                          .kdf_rounds(PKCS12_ITERATIONS)
+                          .key_cert_algorithm(pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+                          .hmac_hash(hashes.SHA1())
+                          .build(password))
+        except AttributeError:
+            # cryptography < 38 always uses 3DES
+            encryption = serialization.BestAvailableEncryption(password)
+        return pkcs12.serialize_key_and_certificates(None, key, cert, None, encryption)
+
+    def load_pkcs12(self, data, passphrase):
+        # Returns (key, cert), cert is None for keystores holding only the key
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        key, cert, _ = pkcs12.load_key_and_certificates(data, passphrase.encode("UTF-8"))
+        return key, cert
+
+
+class PyOpenSSLBackend(object):
+    name = "pyopenssl"
+    # pyOpenSSL always signs with a digest, Ed25519 does not take one
+    signs_ed25519 = False
+
+    def __init__(self):
+        super(PyOpenSSLBackend,self).__init__()
+        from OpenSSL import crypto
+        self.crypto = crypto
+        self.Error = crypto.Error
+        self._checker = None
+
+    def _pkey(self, key):
+        # PKey.from_cryptography_key does not support all key types, PEM does
+        return self.crypto.load_privatekey(self.crypto.FILETYPE_PEM, key_to_pem(key))
+
+    def _apply_spec(self, cert, spec, version):
+        cert.set_version(version)
+        subject = cert.get_subject()
+        for attribute, value in spec.subject:
+            setattr(subject, attribute, value)
+        cert.add_extensions([self.crypto.X509Extension(name.encode("UTF-8"), critical, value.encode("UTF-8"))
+                             for name, critical, value in spec.extensions])
+
+    def create_certificate(self, spec, key, serial, years, issuer_cert = None, issuer_key = None, public_key = None):
+        cert = self.crypto.X509()
+        # X509 Version 3 has version number 2! It's the logical choice
+        self._apply_spec(cert, spec, 2)
+        cert.set_serial_number(serial)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(_years_to_seconds(years))
+        if public_key is not None:
+            from cryptography.hazmat.primitives import serialization
+            cert.set_pubkey(self.crypto.load_publickey(self.crypto.FILETYPE_PEM, public_key.public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)))
+        else:
+            cert.set_pubkey(self._pkey(key))
+        if issuer_cert is None:
+            cert.set_issuer(cert.get_subject())
+            cert.sign(self._pkey(key), 'sha256')
+        else:
+            cert.set_issuer(issuer_cert.get_subject())
+            cert.sign(self._pkey(issuer_key), 'sha256')
+        return cert
+
+    def create_csr(self, spec, key):
+        csr = self.crypto.X509Req()
+        # Requests only know version 1, which has version number 0 (RFC 2986)
+        self._apply_spec(csr, spec, 0)
+        csr.set_pubkey(self._pkey(key))
+        csr.sign(self._pkey(key), digest="sha256")
+        return csr
+
+    def request_public_key(self, pem):
+        # Keys are cryptography objects for both backends
+        return self._cryptography().request_public_key(pem)
+
+    def load_certificate(self, pem):
+        return self.crypto.load_certificate(self.crypto.FILETYPE_PEM, pem)
+
+    def dump_certificate(self, cert):
+        return self.crypto.dump_certificate(self.crypto.FILETYPE_PEM, cert)
+
+    def dump_csr(self, csr):
+        return self.crypto.dump_certificate_request(self.crypto.FILETYPE_PEM, csr)
+
+    def subject_components(self, cert):
+        return [(attribute.decode("UTF-8"), value.decode("UTF-8")) for attribute, value in cert.get_subject().get_components()]
+
+    def public_key_matches(self, cert, key):
+        from cryptography.hazmat.primitives import serialization
+        key_pem = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        return self.crypto.dump_publickey(self.crypto.FILETYPE_PEM, cert.get_pubkey()) == key_pem
+
+    def has_expired(self, cert):
+        return cert.has_expired()
+
+    def _cryptography(self):
+        # Certificate comparisons are done on cryptography objects (X509.to_cryptography)
+        if self._checker is None:
+            self._checker = CryptographyBackend()
+        return self._checker
+
+    def matches_spec(self, cert, spec):
+        return self._cryptography().matches_spec(cert.to_cryptography(), spec)
+
+    def issued_by(self, cert, issuer_cert):
+        return self._cryptography().issued_by(cert.to_cryptography(), issuer_cert.to_cryptography())
+
+    def serial(self, cert):
+        return cert.get_serial_number()
+
+    def not_after(self, cert):
+        return datetime.datetime.strptime(cert.get_notAfter().decode("ascii"), "%Y%m%d%H%M%SZ")
+
+    def fingerprint(self, cert):
+        return cert.digest("sha256").decode("ascii").replace(":", "").lower()
+
+    def export_pkcs12(self, key, cert, passphrase):
+        pfx = self.crypto.PKCS12()
+        pfx.set_privatekey(self._pkey(key))
+        if cert is not None:
+            pfx.set_certificate(cert)
+        return pfx.export(passphrase.encode("UTF-8"), iter=PKCS12_ITERATIONS)
+
+    def load_pkcs12(self, data, passphrase):
+        p12 = self.crypto.load_pkcs12(data, passphrase.encode("UTF-8"))
+        key = key_from_pem(self.crypto.dump_privatekey(self.crypto.FILETYPE_PEM, p12.get_privatekey()))
+        return key, p12.get_certificate()
+
+
+# The classes only import their library, when they are instantiated
+BACKEND_CLASSES = {"cryptography" : CryptographyBackend, "pyopenssl" : PyOpenSSLBackend}
+
+def get_crypto_backend(name):
+    if name in BACKEND_CLASSES:
+        return BACKEND_CLASSES[name]()
+    raise ValueError("crypto.backend has to be one of %s, %s was requested." % (", ".join(BACKENDS), name))
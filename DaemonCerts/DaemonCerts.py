@@ -4,30 +4,60 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import sys
-import atexit
-from lxml import etree
-
-from OpenSSL import crypto
-
-from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings
+import datetime
+
+from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings, SETTINGS_FLAGS
+from DaemonCerts.KeyGenerator import generate_key, generate_keys, check_key_parameters, key_matches, key_to_pem
+from DaemonCerts.CryptoBackend import CertSpec, BACKEND_CLASSES, get_crypto_backend
+from DaemonCerts.KeyPool import get_keypool
+from DaemonCerts.CAContext import CAContext
+from DaemonCerts.RunManifest import RunManifest
+from DaemonCerts.SerialAllocator import SerialAllocator
+from DaemonCerts.CertificateDatabase import CertificateDatabase
 from DaemonCerts.UNITYInitializerWriter import write_groovy_script, write_unity_module
 from DaemonCerts.VOConfigWriter import write_vo_config
+from DaemonCerts.RunResult import RunResult
+from DaemonCerts.Errors import CAError, SettingsError, MissingInputError, XMLEditError
 from DaemonCerts.utility.misc_file_functions import mkdir_p
+from DaemonCerts.utility.property_file_functions import patch_property_file
+from DaemonCerts.utility.AbstractSettings import SettingsValidationError
+from DaemonCerts.utility.OutputWriter import OutputWriter
+from DaemonCerts.utility.Timings import Timings, NullTimings, timed
 
 import os, shutil
 from os.path import join,sep
 
+# not_after of self-signed certificates in the run manifest
+NOT_AFTER_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 
 class DaemonCerts(object):
-    def __init__(self,sysargs):
+    def __init__(self,sysargs,settings=None,logger=None,progress=None):
+        """
+        sysargs is the command line. With settings (finalized DaemonCertsSettings, see SiteProvisioner) DaemonCerts is
+        used as a library: sysargs only holds flags such as --timings, errors raise DaemonCertsError instead of exiting,
+        messages go to logger (default: logger DaemonCerts) and progress(event, details) is called for every
+        CA, certificate and request.
+        """
         super(DaemonCerts,self).__init__()
-        self.dcs = DaemonCertsSettings()
-        try:
-            self.dcs.parse_eq_args(sysargs, createdicts=False)
-        except Exception as e:
-            self.write_info_text()
-            raise
-        self.dcs.finalize()
+        self.embedded = settings is not None
+        self._logger = logger
+        self.progress = progress
+        if self.embedded:
+            self.dcs = settings
+        else:
+            self.dcs = DaemonCertsSettings()
+            try:
+                self.dcs.parse_command_line(sysargs)
+            except Exception as e:
+                self.write_info_text()
+                raise
+            try:
+                self.dcs.finalize()
+            except SettingsValidationError as e:
+                # Reported before anything is generated, all invalid values at once
+                print("%s\nQuitting." % e)
+                sys.exit(5)
 
         self.servers = [ "GATEWAY",
                          "XUUDB",
@@ -40,10 +70,33 @@ class DaemonCerts(object):
                        ]
 
         FQDN = self.dcs.get_value("FQDN")
-        if FQDN == "unicore.sample-fqdn.com" or len(sysargs) == 0:
+        if self.embedded and FQDN == "unicore.sample-fqdn.com":
+            raise SettingsError("FQDN has to be set, it still has the sample value %s." % FQDN)
+        if not self.embedded and (FQDN == "unicore.sample-fqdn.com" or len(sysargs) == 0):
             self.write_info_text()
             sys.exit(0)
 
+        # Crypto backend, created on first use: plans of runs without certificates never load its library.
+        # The name was checked with the other settings (see DaemonCertsSettings).
+        self._crypto = None
+        self.keypool = get_keypool(self.dcs)
+        # SerialAllocator of the self-signed CA, created on first use. It can be shared between instances signing with the same CA.
+        self.serials = None
+        # CertificateDatabase of the self-signed CA, opened on first use
+        self.database = None
+        # CAContext, loaded on first use. It can be shared between instances signing with the same CA.
+        self.ca = None
+        # Values of random_string. They are not inputs of the outputs, see input_fingerprint.
+        self.scrambled = set()
+        # Serials signed by this instance: { name : serial }, name is a server or CA
+        self.issued = {}
+        self.manifest = RunManifest(join(self.dcs.get_value("directory.support"), RunManifest.FILENAME),
+                                    enabled=self.dcs.get_value("incremental"))
+        # All generated files are written through this writer, see OutputWriter
+        self.writer = OutputWriter(fsync=self.dcs.get_value("output.fsync"))
+        # Flags such as --timings, they are not settings
+        self.options = [arg for arg in sysargs if arg.startswith("--")]
+        self.timings = Timings() if "--timings" in self.options else NullTimings()
 
         unipath = self.dcs.get_value("directory.unicore")
         #builds: unicore_path/daemon_name/conf/filename:
@@ -290,16 +343,39 @@ class DaemonCerts(object):
         import random
         import string
         randstring = ''.join(random.sample(string.ascii_letters, length))
+        self.scrambled.add(randstring)
         return randstring
 
+    def input_fingerprint(self, *inputs):
+        # Random values are different in every run, the fingerprint therefore only sees a placeholder.
+        def mask(value):
+            if isinstance(value, (list, tuple)):
+                return [mask(entry) for entry in value]
+            if isinstance(value, dict):
+                return dict((key, mask(entry)) for key, entry in value.items())
+            if value in self.scrambled:
+                return "<SCRAMBLE>"
+            return value
+        return self.manifest.fingerprint(*mask(list(inputs)))
+
+    def write_output(self, key, path, content):
+        # Writes content (str or bytes) to path, unless the previous run wrote the same content there.
+        fingerprint = self.input_fingerprint(content)
+        if self.manifest.is_current(key, fingerprint):
+            return False
+        self.writer.write(path, content)
+        self.manifest.record(key, fingerprint, [path])
+        return True
+
+    # Extensions are (name, critical, value) in OpenSSL config syntax, see CryptoBackend.CertSpec
     def get_san_extension_ca(self,san_string):
-        return [ crypto.X509Extension(b"basicConstraints", False, b"CA:TRUE"), crypto.X509Extension(b"subjectAltName", False, san_string.encode("UTF-8")) ]
+        return [ ("basicConstraints", False, "CA:TRUE"), ("subjectAltName", False, san_string) ]
 
     def get_san_extension(self,san_string):
-        #crypto.X509Extension(b"keyUsage", False, b"Digital Signature, Non Repudiation, Key Encipherment"),
-        return [ crypto.X509Extension(b"basicConstraints", False, b"CA:FALSE"),
-                 crypto.X509Extension(b'extendedKeyUsage', False, b'serverAuth, clientAuth'),
-                 crypto.X509Extension(b"subjectAltName", False, san_string.encode("UTF-8")) ]
+        #("keyUsage", False, "Digital Signature, Non Repudiation, Key Encipherment"),
+        return [ ("basicConstraints", False, "CA:FALSE"),
+                 ("extendedKeyUsage", False, "serverAuth, clientAuth"),
+                 ("subjectAltName", False, san_string) ]
 
     def make_ca_dir(self):
         ca_path = self.dcs.get_value('directory.ca')
@@ -320,11 +396,49 @@ class DaemonCerts(object):
         mkdir_p(unity_path)
         return cert_path,unity_path
 
-    def write_serial(self):
-        ca_path = self.make_ca_dir()
-        serialpath = join(ca_path, "serial")
-        with open(serialpath, 'w') as serialfile:
-            serialfile.write("%s\n"% hex(self.serial)[2:])
+    def get_serials(self):
+        if self.serials is None:
+            self.serials = SerialAllocator(self.dcs.get_value('directory.ca'), block_size=self.dcs.get_value("serial.block"))
+        return self.serials
+
+    def get_database(self):
+        if self.database is None:
+            self.database = CertificateDatabase(self.dcs.get_value('directory.ca'))
+        return self.database
+
+    def record_issued(self, serial, name, cert, spec):
+        # Every certificate signed by the self-signed CA goes to the issued log and the certificate database
+        dn = self.name_to_rfc4514(self.crypto.subject_components(cert))
+        self.issued[name] = serial
+        self.get_serials().record(serial, name, dn)
+        self.get_database().add(serial, dn, spec.get_extension("subjectAltName"), name, self.dcs.get_value("GCID"),
+                                self.crypto.not_after(cert), self.crypto.fingerprint(cert))
+        return dn
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            import logging
+            self._logger = logging.getLogger("DaemonCerts")
+        return self._logger
+
+    def report(self, message):
+        # Progress messages: stdout on the command line, the logger in library use
+        if self.embedded:
+            self.logger.info(message)
+        else:
+            print(message)
+
+    def notify(self, event, **details):
+        if self.progress is not None:
+            self.progress(event, details)
+
+    def fail(self, error, exit_code = 5, message = None):
+        # Library use raises error. The command line prints message (default: the error) and exits with exit_code, as it always did.
+        if self.embedded:
+            raise error
+        print(message if message is not None else error)
+        sys.exit(exit_code)
 
     def write_info_text(self):
         help_message="""
@@ -368,40 +482,52 @@ class DaemonCerts(object):
 """
         return message
 
-    def cleanup(self):
-        CAMODE=self.dcs.get_value("CAMODE")
-        if CAMODE == 'SELFSIGNED':
-            self.write_serial()
-
     def main(self):
+        # --timings writes the timing spans of the run, --profile a cProfile dump, both into directory.support
+        # Returns the RunResult of the run
+        profiler = None
+        if "--profile" in self.options:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self.timings.span("main"):
+                return self._main()
+        finally:
+            support_path_dir = self.dcs.get_value("directory.support")
+            if profiler is not None:
+                profiler.disable()
+                mkdir_p(support_path_dir)
+                profiler.dump_stats(join(support_path_dir, "profile.pstats"))
+                self.report("Profile written to %s" % join(support_path_dir, "profile.pstats"))
+            if "--timings" in self.options:
+                self.timings.write(join(support_path_dir, "timings.json"), self.writer)
+                self.writer.sync()
+                self.report("Timings written to %s" % join(support_path_dir, "timings.json"))
+
+    def _main(self):
         camode = self.dcs.get_value("CAMODE")
 
         if not camode in ["SELFSIGNED","CSR","INSTALLCSR"]:
-            print("CAMODE has to be either SELFSIGNED, CSR or INSTALLCSR, quitting")
-            sys.exit(5)
+            self.fail(SettingsError("CAMODE has to be either SELFSIGNED, CSR or INSTALLCSR."),
+                      message="CAMODE has to be either SELFSIGNED, CSR or INSTALLCSR, quitting")
+
+        try:
+            self.check_key_parameters()
+        except ValueError as e:
+            self.fail(SettingsError(str(e)), message="%s Quitting." % e)
+
+        result = RunResult(camode)
 
         ca_path = self.make_ca_dir()
         cacert_path = join(ca_path, "cacert.pem")
 
         if camode == 'SELFSIGNED':
-            ca_path = self.dcs.get_value('directory.ca')
-            mkdir_p(ca_path)
-            serialpath = join(ca_path,"serial")
-            self.serial = None
-            if os.path.isfile(serialpath):
-                with open(serialpath,'rt') as serialfile:
-                    for line in serialfile:
-                        self.serial = int(line, 16)
-                        break
-
-            if self.serial is None:
-                self.serial = 1
-
-            atexit.register(self.cleanup)
-
             if not os.path.isfile(cacert_path):
                 dn = self.gen_ca()
-                print("Generated new CA, DN: <%s>"%dn)
+                result.ca_dn = dn
+                self.notify("ca", dn=dn)
+                self.report("Generated new CA, DN: <%s>"%dn)
 
 
 
@@ -409,12 +535,7 @@ class DaemonCerts(object):
         mkdir_p(support_path_dir)
 
         argumentsfile = join(support_path_dir,"installer_arguments.txt")
-        with open(argumentsfile,'w') as out:
-            out.write("The script was called using the following arguments:\n")
-            out.write("CreateDaemonCerts.py %s\n"%(" ".join(self.dcs.get_original_args())))
-
-        xuudb_file = join(support_path_dir,"xuudb_commands.sh")
-        rfc_file = join(support_path_dir,"rfc4514_dns.txt")
+        self.write_output("support:arguments", argumentsfile, self.get_arguments_text())
 
         dn_list = []
 
@@ -423,74 +544,114 @@ class DaemonCerts(object):
             csr_dir = self.dcs.get_value("directory.csrs")
             mkdir_p(csr_dir)
             csr_comm_file = join(csr_dir, "sign_csrs.sh")
-            with open(csr_comm_file,'w') as csr_comms:
-                csr_comms.write("#!/bin/bash\n")
-                csr_comms.write("export DAYS=%d\n"%(self.dcs.get_value("cert.years")*365))
-                csr_comms.write(self.get_message_to_ca_admin())
-                #with open(rfc_file, 'w') as rfc:
-                gcid = self.dcs.get_value("GCID")
-                for server in self.servers:
-                    incsr = "%s.pem.csr"%server.lower()
-                    csr_comms.write('echo "Certificate request %s contains: "\n' % (incsr))
-                    csr_comms.write("openssl req -in %s -noout -text  -reqopt no_pubkey,no_sigdump,no_header,no_version\n\n"%(incsr))
-
-                csr_comms.write("exit 0 # Remove this line to actually sign the certificates using your CA.\n\n")
-                for server in self.servers:
-                    dn = self.gen_csr(server)
-                    print("Generated csr for server %s DN: <%s>" % (server,dn))
-                    #xcom = "bin/admin.sh adddn %s \"%s\" nobody server" %(gcid,dn)
-                    #xuudb_com.write("%s\n"%xcom)
-                    #rfc.write("%s\n"%dn)
-                    #self.dn_hooks(server,dn)
-                    #dn_list.append((server,dn))
-                    incsr = "%s.pem.csr"%server.lower()
-                    outpem ="%s.pem" % server.lower()
-                    csr_comms.write("openssl ca -in %s -out %s -days $DAYS\n"%(incsr,outpem))
+            csr_comms = "#!/bin/bash\n"
+            csr_comms += "export DAYS=%d\n"%(self.dcs.get_value("cert.years")*365)
+            csr_comms += self.get_message_to_ca_admin()
+            #with open(rfc_file, 'w') as rfc:
+            gcid = self.dcs.get_value("GCID")
+            for server in self.servers:
+                incsr = "%s.pem.csr"%server.lower()
+                csr_comms += 'echo "Certificate request %s contains: "\n' % (incsr)
+                csr_comms += "openssl req -in %s -noout -text  -reqopt no_pubkey,no_sigdump,no_header,no_version\n\n"%(incsr)
+
+            csr_comms += "exit 0 # Remove this line to actually sign the certificates using your CA.\n\n"
+            for server in self.servers:
+                dn = self.gen_csr(server)
+                result.dns[server] = dn
+                result.keystores[server] = self.get_p12_path(server)
+                result.csrs[server] = join(csr_dir, server.lower()) + ".pem.csr"
+                self.notify("csr", server=server, dn=dn, path=result.csrs[server])
+                self.report("Generated csr for server %s DN: <%s>" % (server,dn))
+                #xcom = "bin/admin.sh adddn %s \"%s\" nobody server" %(gcid,dn)
+                #xuudb_com.write("%s\n"%xcom)
+                #rfc.write("%s\n"%dn)
+                #self.dn_hooks(server,dn)
+                #dn_list.append((server,dn))
+                incsr = "%s.pem.csr"%server.lower()
+                outpem ="%s.pem" % server.lower()
+                csr_comms += "openssl ca -in %s -out %s -days $DAYS\n"%(incsr,outpem)
+            self.writer.write(csr_comm_file, csr_comms)
+            self.writer.sync()
             FQDN = self.dcs.get_value("FQDN")
-            print("\n\n\nGenerated certificate requests in the directory %s. You can now zip \n"
-                  "this directory and mail it to your CA, for example using:\n"
-                  "zip -r %s_certificate_requests.zip %s/\n"
-                  "It contains a file sign_csrs.sh required to sign the csrs." %(csr_dir,FQDN,csr_dir))
-            print("After you get the returned pem files, please put them in the same directory as the csrs.")
-            exit(0)
+            self.report("\n\n\nGenerated certificate requests in the directory %s. You can now zip \n"
+                        "this directory and mail it to your CA, for example using:\n"
+                        "zip -r %s_certificate_requests.zip %s/\n"
+                        "It contains a file sign_csrs.sh required to sign the csrs." %(csr_dir,FQDN,csr_dir))
+            self.report("After you get the returned pem files, please put them in the same directory as the csrs.")
+            # Nothing else is configured before the CA answered
+            return result.finish(self.writer, self.issued)
 
         # Here we save the pem again in the trusted directory:
         trustedpath = self.make_truststore_dir()
         trustedpem = join(trustedpath, "cacert.pem")
         if not os.path.isfile(cacert_path):
             if camode == 'INSTALLCSR':
-                print("Please copy the public key or the certificate chain of the certificate authority to: %s before continuing. No changes were made to the configuration."%(cacert_path))
-                print("Usually you can find this file on the website of the certificate authority.")
-                sys.exit(0)
+                message = ("Please copy the public key or the certificate chain of the certificate authority to: %s before continuing. No changes were made to the configuration."%(cacert_path))
+                self.fail(MissingInputError(message), exit_code=0,
+                          message=message + "\nUsually you can find this file on the website of the certificate authority.")
             else:
-                print("In self signed camode and public certificate %s. Missing, This should be impossible. Please let the developer of UNICOREDaemonCerts know."%cacert_path)
-                sys.exit(0)
-
-        shutil.copy(cacert_path, trustedpem)
-
-        with open(xuudb_file,'w') as xuudb_com:
-            with open(rfc_file, 'w') as rfc:
-                gcid = self.dcs.get_value("GCID")
-                for server in self.servers:
-                    dn =self.gen_or_update_server_cert(server)
-                    print("Generated key for server %s DN: <%s>" % (server,dn))
-                    xcom = "bin/admin.sh adddn %s \"%s\" nobody server" %(gcid,dn)
-                    xuudb_com.write("%s\n"%xcom)
-                    rfc.write("%s\n"%dn)
-                    self.dn_hooks(server,dn)
-                    dn_list.append((server,dn))
-
-
+                self.fail(CAError("The CA certificate %s is missing." % cacert_path), exit_code=0,
+                          message="In self signed camode and public certificate %s. Missing, This should be impossible. Please let the developer of UNICOREDaemonCerts know."%cacert_path)
+
+        self.write_output("support:trustedpem", trustedpem, self.get_ca(require_key=False).cert_pem)
+
+        # Keys are generated up front (in parallel if requested), signing happens in the fixed order below.
+        # Serials, DNs and output files are therefore identical to a sequential run.
+        new_keys = self.pregenerate_keys()
+
+        for server in self.servers:
+            dn =self.gen_or_update_server_cert(server, key=new_keys.get(server))
+            result.dns[server] = dn
+            result.keystores[server] = self.get_p12_path(server)
+            self.notify("certificate", server=server, dn=dn, serial=self.issued.get(server))
+            self.report("Generated key for server %s DN: <%s>" % (server,dn))
+            self.dn_hooks(server,dn)
+            dn_list.append((server,dn))
+        for key, path, content in self.dn_list_outputs(dn_list):
+            self.write_output(key, path, content)
 
         self.post_update(dn_list)
-        with open(join(support_path_dir, "urlinfo.txt"), 'w') as out:
-            gwurl = self.dcs.get_value("Domains.GATEWAY")
-            unityurl = self.dcs.get_value("Domains.UNITY")
-            port = self.dcs.get_value("Port.GATEWAY")
-            gcid = self.dcs.get_value("GCID")
-            wf_gcid = self.dcs.get_value("WF-GCID")
-            cert = join(self.dcs.get_value("directory.certs"),'trusted','cacert.pem')
-            infostring = """To setup REST Clients, the following two URLs are required:
+        if self.keypool is not None:
+            stats = self.keypool.stats()
+            self.report("Key pool %s: %d hits, %d misses, %d keys left." % (self.keypool.slot, stats["hits"], stats["misses"], self.keypool.available()))
+        infostring = self.get_url_info()
+        result.info = infostring
+        self.report(infostring)
+        self.write_output("support:urlinfo", join(support_path_dir, "urlinfo.txt"), infostring)
+
+        with self.timings.span("save_manifest"):
+            self.writer.sync()
+            self.manifest.save(self.writer)
+        self.report("%d files written, %d files unchanged." % (len(self.writer.written), len(self.writer.unchanged)))
+        return result.finish(self.writer, self.issued)
+
+
+    def get_arguments_text(self):
+        return ("The script was called using the following arguments:\n"
+                "CreateDaemonCerts.py %s\n"%(" ".join(arg for arg in self.dcs.get_original_args()
+                                                        if not arg.startswith("--") or arg.split("=")[0] in SETTINGS_FLAGS)))
+
+    def dn_list_outputs(self,dn_list):
+        # Returns [(manifest key, path, content), ...] of the support files listing the server DNs
+        support_path_dir = self.dcs.get_value("directory.support")
+        gcid = self.dcs.get_value("GCID")
+        xuudb_com = ""
+        rfc = ""
+        for server,dn in dn_list:
+            xcom = "bin/admin.sh adddn %s \"%s\" nobody server" %(gcid,dn)
+            xuudb_com += "%s\n"%xcom
+            rfc += "%s\n"%dn
+        return [("support:xuudb", join(support_path_dir,"xuudb_commands.sh"), xuudb_com),
+                ("support:rfc4514", join(support_path_dir,"rfc4514_dns.txt"), rfc)]
+
+    def get_url_info(self):
+        gwurl = self.dcs.get_value("Domains.GATEWAY")
+        unityurl = self.dcs.get_value("Domains.UNITY")
+        port = self.dcs.get_value("Port.GATEWAY")
+        gcid = self.dcs.get_value("GCID")
+        wf_gcid = self.dcs.get_value("WF-GCID")
+        cert = join(self.dcs.get_value("directory.certs"),'trusted','cacert.pem')
+        infostring = """To setup REST Clients, the following two URLs are required:
    Base URI: https://%s:%d/%s/rest/core
    Workflow Link: https://%s:%d/%s/rest/workflows
             
@@ -500,87 +661,169 @@ class DaemonCerts(object):
    They also require access to the following truststore: %s
    Please distribute this file and the truststore to all your users.
             """ %(gwurl,port,gcid,
-                  gwurl,port,wf_gcid,
-                  unityurl,
-                  gwurl,port,
-                  cert)
-            print(infostring)
-            out.write(infostring)
-
+              gwurl,port,wf_gcid,
+              unityurl,
+              gwurl,port,
+              cert)
+        return infostring
+
+    def get_p12_path(self,server):
+        return join(self.dcs.get_value('directory.certs'), server.lower()) + ".p12"
+
+    def cert_output_paths(self, server):
+        # [(path, kind), ...] of the files gen_or_update_server_cert writes for server, kind is keystore, certificate, key or truststore
+        paths = [(self.get_p12_path(server), "keystore")]
+        unicore_dir = self.dcs.get_value("directory.unicore")
+        if server == "UNITY":
+            unity_pki_dir = join(unicore_dir, "unity", "conf", "pki")
+            paths += [(join(self.dcs.get_value('directory.certs'), "unity", "unity.pem"), "certificate"),
+                      (join(unity_pki_dir, "unity.p12"), "keystore"),
+                      (join(unity_pki_dir, "trusted-ca", "truststore.pem"), "truststore")]
+        if server == "TSI":
+            server_confdir = join(unicore_dir, "tsi_selected", "conf")
+            paths += [(join(server_confdir, "tsi-truststore.pem"), "truststore"),
+                      (join(server_confdir, "tsi-cert.pem"), "certificate"),
+                      (join(server_confdir, "tsi-key.pem"), "key")]
+        return paths
+
+    @timed("pregenerate_keys")
+    def pregenerate_keys(self):
+        # Returns { server : key } for all servers, which do not have a keystore yet.
+        # Only in SELFSIGNED mode new keys are required during this step.
+        if self.dcs.get_value("CAMODE") != "SELFSIGNED":
+            return {}
+        missing = [server for server in self.servers if not os.path.isfile(self.get_p12_path(server))]
+        keys = {}
+        if self.keypool is not None:
+            for server in missing:
+                key = self.keypool.take()
+                if key is not None:
+                    keys[server] = key
+            missing = [server for server in missing if not server in keys]
+        workers = self.dcs.get_value("keygen.workers")
+        keytype, keysize = self.get_key_parameters()
+        keys.update(zip(missing, generate_keys(len(missing), workers=workers, keytype=keytype, keysize=keysize)))
+        return keys
+
+    def get_key_parameters(self, ca = False):
+        # Returns (keytype, keysize) of the daemon keys or, with ca == True, of the self-signed CA key
+        if ca:
+            return self.dcs.get_value("cert.ca_keytype"), self.dcs.get_value("cert.ca_keysize")
+        return self.dcs.get_value("cert.keytype"), self.dcs.get_value("cert.keysize")
+
+    def check_key_parameters(self):
+        camode = self.dcs.get_value("CAMODE")
+        keytype, keysize = self.get_key_parameters()
+        # Asked of the backend class, plans do not need the backend itself
+        signs_ed25519 = BACKEND_CLASSES[self.dcs.get_value("crypto.backend")].signs_ed25519
+        # CSRs are signed by the daemon key itself
+        check_key_parameters(keytype, keysize, signing=(camode == "CSR" and not signs_ed25519))
+        if camode == "SELFSIGNED":
+            ca_keytype, ca_keysize = self.get_key_parameters(ca=True)
+            check_key_parameters(ca_keytype, ca_keysize, signing=not signs_ed25519)
+
+    def new_key(self, ca = False):
+        # Takes a key from the key pool, if configured, else generates a new one
+        keytype, keysize = self.get_key_parameters(ca)
+        keypool = get_keypool(self.dcs, keytype, keysize)
+        if keypool is not None:
+            return keypool.get_key()
+        return generate_key(keytype, keysize)
+
+    @property
+    def crypto(self):
+        if self._crypto is None:
+            self._crypto = get_crypto_backend(self.dcs.get_value("crypto.backend"))
+        return self._crypto
 
     def update_xml(self,filename,attrib_and_value_dict):
-        tree = None
-        if os.path.isfile(filename):
-            with open(filename,'r') as xmlin:
-                tree = etree.parse(xmlin)
-
-            for xpath,value in attrib_and_value_dict["values"]:
-                print("Changing File <%s>, Path <%s> to: %s"%(filename,xpath,value))
-                self.change_xml_value(tree,xpath,value)
-
-            for xpath,attrib,value in attrib_and_value_dict["attrib"]:
-                print("Changing File <%s>, Path:Attribute <%s>:<%s> to: %s" % (filename, xpath, attrib, value))
-                self.change_xml_attrib(tree,xpath,attrib,value)
-
-            with open(filename, 'w') as xmlout:
-                xmlout.write(etree.tostring(tree,encoding="UTF-8").decode("UTF-8"))
-        #Else we just write out the instructions
-        else:
-            mkdir_p(os.path.dirname(filename))
-            with open(filename + ".instructions.txt",'w') as xmlout:
-                for xpath, value in attrib_and_value_dict["values"]:
-                    print("Writing Instructions in File <%s>, Path <%s> to: %s" % (filename, xpath, value))
-                    xmlout.write("Change value of path <%s> to: <%s>\n"%(xpath,value))
-                for xpath, attrib, value in attrib_and_value_dict["attrib"]:
-                    print("Writing Instructions in File <%s>, Path:Attribute <%s>:<%s> to: %s" % (filename, xpath, attrib, value))
-                    xmlout.write("Change attribute <%s> of path <%s> to: <%s>\n" % (attrib, xpath, value))
-
-    def change_xml_value(self,tree,xpath_expression,value):
-        #xpath_expression: "//eng:Property[@name='CLASSICTSI.ssl.disable']"
-        #value is string
-        root = tree.getroot()
-        test = tree.find(xpath_expression, namespaces=root.nsmap)
-        test.text = value
-
-    def change_xml_attrib(self,tree,xpath_expression,attrib,value):
-        #xpath_expression: "//eng:Property[@name='CLASSICTSI.ssl.disable']"
-        #attrib is string
-        #value is string
-        root = tree.getroot()
-        xmlnode = tree.find(xpath_expression, namespaces=root.nsmap)
-        xmlnode.attrib[attrib] = value
-
-
-    def post_update(self,dn_list):
-        for filename,attrib_and_value_dict in self.static_xml_changes.items():
-            self.update_xml(filename,attrib_and_value_dict)
-        for filename, changelist in self.static_plainfile_changes.items():
-            for key,value in changelist:
-                self.create_add_change_plain(filename,key,value)
+        self.update_xml_files({filename : attrib_and_value_dict})
+
+    @timed("update_xml_files")
+    def update_xml_files(self,xml_changes):
+        # Existing files are edited in parallel by the XMLEditEngine. For missing files we just write out the instructions.
+        # lxml is imported here, so --help and invalid settings do not pay for it
+        from DaemonCerts.XMLEditEngine import XMLEditEngine
+        existing = [filename for filename in xml_changes if os.path.isfile(filename)]
+        for filename in existing:
+            edit_count = len(xml_changes[filename]["values"]) + len(xml_changes[filename]["attrib"])
+            self.report("Changing File <%s>: %d values and attributes" % (filename, edit_count))
+        XMLEditEngine(dict((filename, xml_changes[filename]) for filename in existing),
+                      writer=self.writer).apply_all(existing)
+
+        for filename, attrib_and_value_dict in xml_changes.items():
+            if filename in existing:
+                continue
+            instructions = ""
+            for xpath, value in attrib_and_value_dict["values"]:
+                self.report("Writing Instructions in File <%s>, Path <%s> to: %s" % (filename, xpath, value))
+                instructions += "Change value of path <%s> to: <%s>\n"%(xpath,value)
+            for xpath, attrib, value in attrib_and_value_dict["attrib"]:
+                self.report("Writing Instructions in File <%s>, Path:Attribute <%s>:<%s> to: %s" % (filename, xpath, attrib, value))
+                instructions += "Change attribute <%s> of path <%s> to: <%s>\n" % (attrib, xpath, value)
+            self.writer.write(filename + ".instructions.txt", instructions)
+
+    def get_plainfile_changes(self):
+        # static_plainfile_changes plus the changes depending on directory.userfiles
+        plainfile_changes = dict((filename, list(changelist)) for filename, changelist in self.static_plainfile_changes.items())
+        if "$" in self.dcs.get_value("directory.userfiles"):
+            uaspath = self._get_path("unicorex", "uas.config")
+            plainfile_changes[uaspath].append(("coreServices.sms.factory.DEFAULT.type", "VARIABLE"))
+            plainfile_changes[uaspath].append(("coreServices.defaultsms.type","VARIABLE"))
+        return plainfile_changes
 
+    def config_outputs(self,dn_list):
+        # Returns [(manifest key, path, content), ...] of the vo.config files and the unity config
         cert_dir = self.dcs.get_value("directory.certs")
         pem_rel_loc = join(cert_dir, "unity", "unity.pem")
         pem_abs_loc = os.path.abspath(pem_rel_loc)
         unity_fqdn = self.dcs.get_value("Domains.UNITY")
         gateway_fqdn = self.dcs.get_value("Domains.GATEWAY")
         gateway_port = self.dcs.get_value("Port.GATEWAY")
+        outputs = []
         for component,vofile in self.vo_paths:
-            with open(vofile,'wt') as out:
-                out.write(write_vo_config(pem_abs_loc,component,unity_fqdn,gateway_fqdn,gateway_port))
+            outputs.append(("vo:%s" % vofile, vofile,
+                            write_vo_config(pem_abs_loc,component,unity_fqdn,gateway_fqdn,gateway_port)))
 
         #Finally we write the unity config:
         unity_conf_dir = join(self.dcs.get_value("directory.unicore"),"unity","conf")
-        content_init_file = join(unity_conf_dir,"scripts")
-        mkdir_p(content_init_file)
-        content_init_file = join(content_init_file,"unicoreServerContentInitializer.groovy")
-        with open(content_init_file,'w') as out:
-            out.write(write_groovy_script(dn_list))
-
-        module_init_file = join(unity_conf_dir,"modules")
-        mkdir_p(module_init_file)
-        module_init_file = join(module_init_file,"unicoreQuickstart.module")
-        with open(module_init_file,'w') as out:
-            out.write(write_unity_module())
+        content_init_file = join(unity_conf_dir,"scripts","unicoreServerContentInitializer.groovy")
+        outputs.append(("unity:groovy", content_init_file, write_groovy_script(dn_list)))
+        module_init_file = join(unity_conf_dir,"modules","unicoreQuickstart.module")
+        outputs.append(("unity:module", module_init_file, write_unity_module()))
+        return outputs
+
+    @timed("post_update")
+    def post_update(self,dn_list):
+        # Every output is only written, if its inputs changed since the last run (see RunManifest)
+        xml_changes = {}
+        xml_fingerprints = {}
+        for filename,attrib_and_value_dict in self.static_xml_changes.items():
+            fingerprint = self.input_fingerprint(attrib_and_value_dict, os.path.isfile(filename))
+            if not self.manifest.is_current("xml:%s" % filename, fingerprint):
+                xml_changes[filename] = attrib_and_value_dict
+                xml_fingerprints[filename] = fingerprint
+        try:
+            self.update_xml_files(xml_changes)
+        except XMLEditError as e:
+            self.fail(e, message="%s Quitting." % e)
+        for filename, fingerprint in xml_fingerprints.items():
+            written = filename if os.path.isfile(filename) else filename + ".instructions.txt"
+            self.manifest.record("xml:%s" % filename, fingerprint, [written])
+
+        userfiles_directory = self.dcs.get_value("directory.userfiles")
+        if "$" in userfiles_directory:
+            self.report("Detected variable in userfiles_directory. Will not generate the directories. Please make sure this variable does not contain braces like these: {}")
+
+        for filename, changelist in self.get_plainfile_changes().items():
+            fingerprint = self.input_fingerprint(changelist)
+            if self.manifest.is_current("plain:%s" % filename, fingerprint):
+                continue
+            self.apply_plain_changes(filename,changelist)
+            self.manifest.record("plain:%s" % filename, fingerprint, [filename])
+
+        for key, path, content in self.config_outputs(dn_list):
+            self.write_output(key, path, content)
 
         unicorex_conf_dir = join(self.dcs.get_value("directory.unicore"), "unicorex", "conf")
         simpleidb = join(unicorex_conf_dir,'simpleidb')
@@ -590,13 +833,7 @@ class DaemonCerts(object):
         if os.path.isfile(simpleidb):
             shutil.move(simpleidb,sidbdir)
 
-        userfiles_directory = self.dcs.get_value("directory.userfiles")
-        if "$" in userfiles_directory:
-            print("Detected variable in userfiles_directory. Will not generate the directories. Please make sure this variable does not contain braces like these: {}")
-            uaspath = self._get_path("unicorex", "uas.config")
-            self.create_add_change_plain(uaspath, "coreServices.sms.factory.DEFAULT.type", "VARIABLE")
-            self.create_add_change_plain(uaspath, "coreServices.defaultsms.type","VARIABLE")
-        else:
+        if not "$" in userfiles_directory:
             filespacedir = join(self.dcs.get_value("directory.userfiles"),"storage")
             mkdir_p(filespacedir)
             os.chmod(filespacedir,0o1777)
@@ -608,93 +845,64 @@ class DaemonCerts(object):
             os.chmod(filespacedir,0o1777)
 
     def create_add_change_plain(self,filename,key,value):
-        print("File: <%s>, Changing value of key <%s> to <%s>" % (filename, key, value))
-        if os.path.isfile(filename):
-            found = False
-            outname = filename + '_new'
-            with open(filename, 'rt') as myin:
-                with open(outname,'wt') as myout:
-                    for line in myin:
-                        if "=" in line:
-                            splitline = line.split("=")
-                            keypruned = splitline[0].replace(" ","")
-                            if keypruned == key or keypruned == "#%s"%key:
-                                if found:
-                                    #If we have keys twice, we skip.
-                                    continue
-                                found = True
-                                if value == "<UnComment>":
-                                    if line.startswith("#"):
-                                        myout.write(line[1:])
-                                    else:
-                                        myout.write(line)
-                                elif value == "<Comment>":
-                                    if line.startswith("#"):
-                                        myout.write(line)
-                                    else:
-                                        myout.write("#%s"%line)
-                                else:
-                                    myout.write("%s=%s\n" % (key, value))
-
-                            else:
-                                myout.write(line)
-                        else:
-                            myout.write(line)
-                    if not found:
-                        if not "Comment" in value:
-                            myout.write("%s=%s\n" % (key, value))
-            shutil.move(outname,filename)
-        else:
-            mkdir_p(os.path.dirname(filename))
-            with open(filename,'a') as out:
-                out.write("%s=%s\n"%(key,value))
-
-    def dn_hooks(self,server,dn):
-        #Here we write specific template files for the servers, where specific DNs are required, such as ACLs.
+        self.apply_plain_changes(filename,[(key,value)])
+
+    @timed("apply_plain_changes", with_argument=True)
+    def apply_plain_changes(self,filename,changelist):
+        # All changes to one file are applied in a single pass, see patch_property_file
+        for key,value in changelist:
+            self.report("File: <%s>, Changing value of key <%s> to <%s>" % (filename, key, value))
+        patch_property_file(filename,changelist,writer=self.writer)
+
+    def dn_hook_outputs(self,server,dn):
+        # Returns ([(manifest key, path, content), ...], [(manifest key, path, changelist), ...]) of the files,
+        # which depend on the DN of server
         unicore_dir = self.dcs.get_value("directory.unicore")
-        server_confdir = join(unicore_dir,server.lower(),"conf")
-
         if server == 'XUUDB':
-            mkdir_p(server_confdir)
-            acl_file = join(server_confdir,"xuudb.acl")
-            with open(acl_file,'wt') as acl:
-                acl.write("%s\n"%dn)
-
-        elif server == 'UNICOREX':
+            acl_file = join(unicore_dir,"xuudb","conf","xuudb.acl")
+            return [("dn_hook:XUUDB", acl_file, "%s\n"%dn)], []
+        if server == 'UNICOREX':
             #UNICOREX DN has to be known by TSI:
-            tsi_confdir = join(unicore_dir,"tsi_selected","conf")
-            mkdir_p(tsi_confdir)
-            tsi_conffile = join(tsi_confdir,"tsi.properties")
-            self.create_add_change_plain(tsi_conffile,"tsi.allowed_dn.1",dn)
+            tsi_conffile = join(unicore_dir,"tsi_selected","conf","tsi.properties")
+            return [], [("dn_hook:UNICOREX", tsi_conffile, [("tsi.allowed_dn.1",dn)])]
+        return [], []
 
-    def get_ca_key(self):
+    @timed("dn_hooks", with_argument=True)
+    def dn_hooks(self,server,dn):
+        #Here we write specific template files for the servers, where specific DNs are required, such as ACLs.
+        files, plain_changes = self.dn_hook_outputs(server,dn)
+        for key, path, content in files:
+            self.write_output(key, path, content)
+        for key, path, changelist in plain_changes:
+            fingerprint = self.input_fingerprint(changelist)
+            if not self.manifest.is_current(key, fingerprint):
+                self.apply_plain_changes(path,changelist)
+                self.manifest.record(key, fingerprint, [path])
+
+    def get_ca(self, require_key = True):
         ca_path = self.dcs.get_value('directory.ca')
-        ca_key_path = join(ca_path,"private","cakey.pem")
-        ca_key_data = ""
-        with open(ca_key_path,'rt') as ca_key_file:
-            ca_key_data = ca_key_file.read()
-        key = crypto.load_privatekey(crypto.FILETYPE_PEM,ca_key_data)
-        return key
+        if self.ca is None:
+            with self.timings.span("load_ca"):
+                self.ca = CAContext.load(ca_path, require_key=require_key, backend=self.crypto)
+        elif require_key and self.ca.key is None:
+            with self.timings.span("load_ca_key"):
+                self.ca.load_key(ca_path)
+        return self.ca
 
-    def get_ca_cert(self):
-        ca_path = self.dcs.get_value('directory.ca')
-        ca_cert_path = join(ca_path,"cacert.pem")
-        with open(ca_cert_path,'r') as ca_cert_file:
-            ca_cert_data = ca_cert_file.read()
-        cert = crypto.load_certificate(crypto.FILETYPE_PEM,ca_cert_data)        
+    def get_ca_key(self):
+        return self.get_ca().key
 
-        return cert
+    def get_ca_cert(self):
+        return self.get_ca(require_key=False).cert
 
+    @timed("gen_ca")
     def gen_ca(self):
         #Here we generate a self-signed CA certificate
         #CN and SAN are set to FQDN.
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
+        key = self.new_key(ca=True)
 
         years = self.dcs.get_value("cert.years")
-        cert = crypto.X509()
-        # X509 Version 3 has version number 2! It's the logical choice
-        cert.set_version(2)
+        spec = CertSpec()
         CERT_C = self.dcs.get_value("cert.Country")
         CERT_ST = self.dcs.get_value("cert.State")
         CERT_L =  self.dcs.get_value("cert.Locality")
@@ -704,164 +912,218 @@ class DaemonCerts(object):
         FQDN = self.dcs.get_value("FQDN")
         SAN = "DNS:%s, email:%s"%(FQDN,CERT_EMAIL)
 
-        cert.get_subject().C = CERT_C
-        cert.get_subject().ST = CERT_ST
-        cert.get_subject().L = CERT_L
-        cert.get_subject().O = CERT_O
-        cert.get_subject().OU = CERT_OU
-        cert.get_subject().CN = FQDN
-        cert.set_serial_number(self.serial)
-        cert.add_extensions(self.get_san_extension_ca(SAN))
+        spec.subject = [("C", CERT_C), ("ST", CERT_ST), ("L", CERT_L), ("O", CERT_O), ("OU", CERT_OU), ("CN", FQDN)]
+        spec.add_extensions(self.get_san_extension_ca(SAN))
 
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(years*365*24*60*60)
-
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(key)
-        cert.sign(key, 'sha256')
-        self.serial+=1
+        serial = self.get_serials().allocate()
+        cert = self.crypto.create_certificate(spec, key, serial, years)
 
         ca_path = self.make_ca_dir()
         cakey_dir = join(ca_path,"private")
         mkdir_p(cakey_dir)
         cakey_filename = join(cakey_dir,"cakey.pem")
-        with open(cakey_filename, "w") as out:
-            out.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key).decode("UTF-8"))
-        os.chmod(cakey_filename, 0o600)
+        self.writer.write(cakey_filename, key_to_pem(key), mode=0o600)
 
         cacert_filename = join(ca_path,"cacert.pem")
-        with open(cacert_filename, "w") as out:
-            out.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("UTF-8"))
+        self.writer.write(cacert_filename, self.crypto.dump_certificate(cert))
+        # The CA has to be on disk, before the first certificate signed by it
+        self.writer.sync()
+
+        self.ca = CAContext(cert, key, backend=self.crypto)
 
-        return self.name_to_rfc4514(cert.get_subject())
+        return self.record_issued(serial, "CA", cert, spec)
 
-    def name_to_rfc4514(self,name):
-        # CN=UNITY,OU=IT Services,O=MyOrganization,L=San Francisco,ST=California,C=US
+    def name_to_rfc4514(self,components):
+        # [(C, US), ..., (CN, UNITY)] -> CN=UNITY,OU=IT Services,O=MyOrganization,L=San Francisco,ST=California,C=US
         # RFC4514 is RFC2253 with unicode support and some extra tags we don't care about.
         estring = ""
-        for topic,content in reversed(name.get_components()):
-            estring += "%s=%s,"%(topic.decode("UTF-8"),content.decode("UTF-8"))
+        for topic,content in reversed(components):
+            estring += "%s=%s,"%(topic,content)
         estring = estring[:-1]
         #TODO: This section still requires escaping of special characters noted in rfc4514
         return estring
 
-    def set_cert_attributes(self,server,cert):
-        # X509 Version 3 has version number 2! It's the logical choice
-        cert.set_version(2)
+    def expected_dn(self,server):
+        # DN of a certificate issued for server with the current settings. No key is required.
+        spec = CertSpec()
+        self.set_cert_attributes(server,spec)
+        return self.name_to_rfc4514(spec.subject)
+
+    def set_cert_attributes(self,server,cert,fqdn=None):
+        # cert is a CertSpec, the crypto backend turns it into a certificate or request
+        # fqdn defaults to Domains.<server>
         CERT_C = self.dcs.get_value("cert.Country")
         CERT_ST = self.dcs.get_value("cert.State")
         CERT_L = self.dcs.get_value("cert.Locality")
         CERT_O = self.dcs.get_value("cert.Organization")
         CERT_OU = self.dcs.get_value("cert.OrganizationalUnit")
         CERT_EMAIL = self.dcs.get_value("cert.email")
-        FQDN = self.dcs.get_value("Domains.%s" % server)
+        FQDN = fqdn or self.dcs.get_value("Domains.%s" % server)
 
         SAN = "DNS:%s, email:%s" % (FQDN, CERT_EMAIL)
 
-        cert.get_subject().C = CERT_C
-        cert.get_subject().ST = CERT_ST
-        cert.get_subject().L = CERT_L
-        cert.get_subject().O = CERT_O
-        cert.get_subject().OU = CERT_OU
-        cert.get_subject().CN = server
+        cert.subject = [("C", CERT_C), ("ST", CERT_ST), ("L", CERT_L), ("O", CERT_O), ("OU", CERT_OU), ("CN", server)]
         cert.add_extensions(self.get_san_extension(SAN))
 
 
+    @timed("gen_csr", with_argument=True)
     def gen_csr(self,server):
         certpath, unity_path = self.make_cert_dirs()
         priv_key_path = join(certpath, server.lower()) + ".p12"
         passphrase = self.dcs.get_value('KeystorePass.%s' % server)
+        key = None
         if os.path.isfile(priv_key_path):
             key = self.load_private_key_p12(priv_key_path,passphrase)
-        else:
-            key = crypto.PKey()
-            key.generate_key(crypto.TYPE_RSA, 2048)
-        pfx = crypto.PKCS12Type()
-        pfx.set_privatekey(key)
-        #pfx.set_certificate(cert)
-        pfxdata = pfx.export(passphrase)
-        with open(priv_key_path, 'wb') as pfxfile:
-            pfxfile.write(pfxdata)
-        os.chmod(priv_key_path, 0o600)
-
-        cert = crypto.X509Req()
-        self.set_cert_attributes(server,cert)
-        cert.set_pubkey(key)
-        cert.sign(key,digest="sha256")
+            if not key_matches(key, *self.get_key_parameters()):
+                self.report("Key of server %s does not match cert.keytype and cert.keysize. Generating a new key." % server)
+                key = None
+        if key is None:
+            key = self.new_key()
+        pfxdata = self.crypto.export_pkcs12(key, None, passphrase)
+        self.writer.write(priv_key_path, pfxdata, mode=0o600)
+
+        spec = CertSpec()
+        self.set_cert_attributes(server,spec)
+        cert = self.crypto.create_csr(spec, key)
 
         csr_dir = self.dcs.get_value("directory.csrs")
         mkdir_p(csr_dir)
         csr_path = join(csr_dir, server.lower()) + ".pem.csr"
 
-        with open(csr_path,'wb') as out:
-            out.write(crypto.dump_certificate_request(crypto.FILETYPE_PEM, cert))
+        self.writer.write(csr_path, self.crypto.dump_csr(cert))
 
-        return self.name_to_rfc4514(cert.get_subject())
+        return self.name_to_rfc4514(self.crypto.subject_components(cert))
 
     def load_private_key_p12(self,path,passphrase):
         with open(path,'rb') as int:
-            p12 = crypto.load_pkcs12(int.read(),passphrase)
-            return p12.get_privatekey()
+            key, cert = self.crypto.load_pkcs12(int.read(),passphrase)
+            return key
+
+    def reissue_reason(self, server, key, cert):
+        # Why the existing certificate cert of server has to be signed again, None if it can be kept
+        if cert is None:
+            return "the keystore holds no certificate"
+        spec = CertSpec()
+        self.set_cert_attributes(server, spec)
+        if not self.crypto.matches_spec(cert, spec):
+            return "subject or extensions changed"
+        if not self.crypto.public_key_matches(cert, key):
+            return "the key changed"
+        if not self.crypto.issued_by(cert, self.get_ca_cert()):
+            return "it was not issued by the current CA"
+        if self.renewal_due(self.crypto.not_after(cert)):
+            return "it expires within cert.renewdays"
+        return None
+
+    def renewal_due(self, not_after):
+        remaining = not_after - datetime.datetime.utcnow()
+        return remaining < datetime.timedelta(days=self.dcs.get_value("cert.renewdays"))
+
+    def cert_is_current(self, server):
+        # The certificate of server has the inputs of the last run and does not expire within cert.renewdays
+        manifest_key = "cert:%s" % server
+        if not self.manifest.is_current(manifest_key, self.cert_fingerprint(server)):
+            return False
+        not_after = self.manifest.get_extra(manifest_key).get("not_after")
+        return not_after is None or not self.renewal_due(datetime.datetime.strptime(not_after, NOT_AFTER_FORMAT))
 
     def load_certificate(self,path):
         with open(path,'rb') as int:
-            print("Loading",path)
-            return crypto.load_certificate(crypto.FILETYPE_PEM,int.read())
+            self.report("Loading %s" % path)
+            return self.crypto.load_certificate(int.read())
+
+    def cert_fingerprint(self,server):
+        # All inputs of the keystore and PEM files of a server
+        camode = self.dcs.get_value("CAMODE")
+        inputs = [camode,
+                  self.get_key_parameters(),
+                  self.dcs.get_value('KeystorePass.%s' % server),
+                  self.dcs.get_value("Domains.%s" % server),
+                  [self.dcs.get_value("cert.%s" % field) for field in
+                   ["Country", "State", "Locality", "Organization", "OrganizationalUnit", "email", "years"]],
+                  self.dcs.get_value("directory.unicore"),
+                  self.dcs.get_value("directory.certs"),
+                  self.get_ca(require_key=False).cert_pem]
+        if camode == 'INSTALLCSR':
+            mypem = join(self.dcs.get_value("directory.csrs"),server.lower()+".pem")
+            inputs.append(RunManifest.hash_file(mypem) if os.path.isfile(mypem) else None)
+        return self.input_fingerprint(*inputs)
 
-    def gen_or_update_server_cert(self,server):
+    @timed("gen_or_update_server_cert", with_argument=True)
+    def gen_or_update_server_cert(self,server,key=None):
+        # key can be handed in, if it was generated beforehand (see pregenerate_keys)
         certpath, unity_path = self.make_cert_dirs()
         priv_key_path = join(certpath, server.lower()) + ".p12"
         passphrase = self.dcs.get_value('KeystorePass.%s' % server)
         camode = self.dcs.get_value("CAMODE")
+
+        fingerprint = self.cert_fingerprint(server)
+        manifest_key = "cert:%s" % server
+        if self.cert_is_current(server):
+            self.report("Certificate of server %s is up to date." % server)
+            return self.manifest.get_extra(manifest_key)["dn"]
+        written = [path for path, kind in self.cert_output_paths(server)]
+
+        existing_cert = None
         if os.path.isfile(priv_key_path):
-            key = self.load_private_key_p12(priv_key_path,passphrase)
-        else:
+            with open(priv_key_path, 'rb') as infile:
+                existing_pfxdata = infile.read()
+            existing_key, existing_cert = self.crypto.load_pkcs12(existing_pfxdata, passphrase)
+            if camode != "SELFSIGNED" or key_matches(existing_key, *self.get_key_parameters()):
+                key = existing_key
+            else:
+                self.report("Key of server %s does not match cert.keytype and cert.keysize. Generating a new key." % server)
+                key = None
+                existing_cert = None
+        if key is None:
             # create a key pair for server and sign it using the CA.
             # CN is daemon name, SAN is FQDN
             # In the special case of Unity we also write the PEM, as we need it for unicorex and probably the workflow server.
-            assert(camode == "SELFSIGNED")
+            if camode != "SELFSIGNED":
+                # The key of an external CA's certificate comes from the keystore written in CSR mode
+                message = "Could not find the keystore %s with the key of server %s. With CAMODE=%s please run CAMODE=CSR first." % (priv_key_path, server, camode)
+                self.fail(SettingsError(message), message=message + " Exiting.")
             # We only do this in this step in case we have our own CA
-            key = crypto.PKey()
-            key.generate_key(crypto.TYPE_RSA, 2048)
+            key = self.new_key()
 
-        ca_cert = self.get_ca_cert()
+        ca = self.get_ca(require_key=(camode == 'SELFSIGNED'))
+        pfxdata = None
         if camode == 'INSTALLCSR':
             csrdir = self.dcs.get_value("directory.csrs")
             mypem = join(csrdir,server.lower()+".pem")
             if not os.path.isfile(mypem):
-                print("Could not find file %s. Please make sure you have the files of the certificate authority at the correct place and restart. Exiting."%mypem)
-                sys.exit(5)
+                message = "Could not find file %s. Please make sure you have the files of the certificate authority at the correct place and restart."%mypem
+                self.fail(MissingInputError(message), message=message + " Exiting.")
             cert = self.load_certificate(mypem)
         else:
             #self signed mode
-            assert(self.dcs.get_value("CAMODE") == "SELFSIGNED")
-            ca_key= self.get_ca_key()
-            years = self.dcs.get_value("cert.years")
-            cert = crypto.X509()
-            self.set_cert_attributes(server,cert)
-
-            cert.set_serial_number(self.serial)
-            cert.gmtime_adj_notBefore(0)
-            cert.gmtime_adj_notAfter(years * 365 * 24 * 60 * 60)
-
-            cert.set_issuer(ca_cert.get_subject())
-            cert.set_pubkey(key)
-            cert.sign(ca_key, 'sha256')
-            self.serial += 1
-
-        pfx = crypto.PKCS12Type()
-        pfx.set_privatekey(key)
-        pfx.set_certificate(cert)
-        pfxdata = pfx.export(passphrase)
-        with open(priv_key_path, 'wb') as pfxfile:
-            pfxfile.write(pfxdata)
-        os.chmod(priv_key_path, 0o600)
+            if camode != "SELFSIGNED":
+                message = "Certificates of CAMODE=%s are not signed here, only CAMODE=SELFSIGNED and INSTALLCSR install certificates." % camode
+                self.fail(SettingsError(message), message=message + " Exiting.")
+            reason = self.reissue_reason(server, key, existing_cert) if existing_cert is not None else None
+            if existing_cert is not None and reason is None:
+                # Same certificate, same keystore: no serial is used up and the daemons do not reload anything
+                cert = existing_cert
+                pfxdata = existing_pfxdata
+                self.report("Keeping certificate of server %s, valid until %s." % (server, self.crypto.not_after(cert)))
+            else:
+                if reason is not None:
+                    self.report("Reissuing certificate of server %s: %s." % (server, reason))
+                years = self.dcs.get_value("cert.years")
+                spec = CertSpec()
+                self.set_cert_attributes(server,spec)
+                serial = self.get_serials().allocate()
+                cert = self.crypto.create_certificate(spec, key, serial, years, issuer_cert=ca.cert, issuer_key=ca.key)
+                self.record_issued(serial, server, cert, spec)
+
+        if pfxdata is None:
+            pfxdata = self.crypto.export_pkcs12(key, cert, passphrase)
+        self.writer.write(priv_key_path, pfxdata, mode=0o600)
 
         if server == "UNITY":
             # Unity PEM needs to be "trusted" as saml assertion issuer by unicorex
             unity_cert_path = join(unity_path,"unity.pem")
-            with open(unity_cert_path,'w') as out:
-                out.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("UTF-8"))
+            self.writer.write(unity_cert_path, self.crypto.dump_certificate(cert))
 
             # Unity defaults to a jks truststore:
             unicore_dir = self.dcs.get_value("directory.unicore")
@@ -869,14 +1131,11 @@ class DaemonCerts(object):
             unity_truststore_path = join(unity_pki_dir,"trusted-ca")
             mkdir_p(unity_truststore_path)
             unity_privatekey = join(unity_pki_dir,"unity.p12")
-            with open(unity_privatekey, 'wb') as pfxfile:
-                pfxfile.write(pfxdata)
-            os.chmod(unity_privatekey, 0o600)
+            self.writer.write(unity_privatekey, pfxdata, mode=0o600)
 
             mkdir_p(unity_truststore_path)
             unity_truststore_path = join(unity_truststore_path,"truststore.pem")
-            with open(unity_truststore_path,'w') as out:
-                out.write(crypto.dump_certificate(crypto.FILETYPE_PEM, ca_cert).decode("UTF-8"))
+            ca.write_cert(unity_truststore_path, self.writer)
 
         if server == "TSI":
             # TSI needs its cert and key both in PEM format
@@ -886,16 +1145,18 @@ class DaemonCerts(object):
             tsi_cert_path = join(server_confdir, "tsi-cert.pem")
 
             tsi_truststore_path = join(server_confdir, "tsi-truststore.pem")
-            with open(tsi_truststore_path,'w') as out:
-                out.write(crypto.dump_certificate(crypto.FILETYPE_PEM, ca_cert).decode("UTF-8"))
+            ca.write_cert(tsi_truststore_path, self.writer)
 
-            with open(tsi_cert_path, 'w') as out:
-                out.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("UTF-8"))
+            self.writer.write(tsi_cert_path, self.crypto.dump_certificate(cert))
 
             tsi_key_path = join(server_confdir, "tsi-key.pem")
-            tsi_passphrase = self.dcs.get_value("KeystorePass.TSI")
-            with open(tsi_key_path, 'w') as out:
-                out.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key, passphrase=tsi_passphrase.encode("UTF-8")).decode("UTF-8"))
-            os.chmod(tsi_key_path, 0o600)
-
-        return self.name_to_rfc4514(cert.get_subject())
+            # The key was always written unencrypted: pyOpenSSL ignored KeystorePass.TSI, as no cipher was given.
+            self.writer.write(tsi_key_path, key_to_pem(key), mode=0o600)
+
+        dn = self.name_to_rfc4514(self.crypto.subject_components(cert))
+        extra = {"dn" : dn}
+        if camode == "SELFSIGNED":
+            # Lets the next run check the renewal window without loading the keystore
+            extra["not_after"] = self.crypto.not_after(cert).strftime(NOT_AFTER_FORMAT)
+        self.manifest.record(manifest_key, fingerprint, written, extra)
+        return dn
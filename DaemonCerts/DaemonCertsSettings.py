@@ -3,27 +3,55 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-from DaemonCerts.utility.AbstractSettings import AbstractSettings
+import os
+
+from DaemonCerts.utility.AbstractSettings import AbstractSettings, Int, Port, FQDN, Path, Enum, Country
+from DaemonCerts.KeyGenerator import KEYTYPES
+from DaemonCerts.CryptoBackend import BACKENDS
 
 # Settings parser, parses equality args, such as Domains.UNITY="FQDN"
+# Defaults are (name, default, explanation[, type]). Without type, the type follows from the default (see AbstractSettings).
+
+# Command line flags naming settings files, they are passed on to reruns and batch sites
+SETTINGS_FLAGS = ["--settings", "--fleet-settings"]
 
 class DaemonCertsSettings(AbstractSettings):
+    env_prefix = "DAEMONCERTS_"
+    secret_settings = r"^(KeystorePass\..*|AdminPass)$"
+
     def __init__(self):
         super(DaemonCertsSettings,self).__init__("DaemonCerts")
 
+    def parse_command_line(self,sysargs):
+        """
+        Applies all settings sources of a command line, each overriding the previous one:
+        --fleet-settings=FILE, --settings=FILE, DAEMONCERTS_* environment variables and parameter=value.
+        The settings files are cached (see AbstractSettings.load_layers), unless --no-settings-cache is given.
+        """
+        files = {}
+        for arg in sysargs:
+            flag, _, value = arg.partition("=")
+            if flag in SETTINGS_FLAGS:
+                files[flag] = value
+        cache_dir = None if "--no-settings-cache" in sysargs else self.default_cache_dir()
+        self.load_layers(fleet_file=files.get("--fleet-settings"), site_file=files.get("--settings"),
+                         environ=os.environ, args=[arg for arg in sysargs if not arg.startswith("--")],
+                         cache_dir=cache_dir)
+        self.original_args = sysargs
+
     def _set_defaults(self):
         defaults = [
-            ('FQDN' , "unicore.sample-fqdn.com", "FQDN of the main UNICORE server running most server daemons"),
-
-            ('Domains.UNITY','sameas:FQDN',"FQDN of the machine running UNITY"),
-            ('Domains.UNICOREX','sameas:FQDN',"FQDN of the machine running UNICOREX"),
-            ('Domains.REGISTRY','sameas:FQDN',"FQDN of the machine running REGISTRY"),
-            ('Domains.XUUDB','sameas:FQDN',"FQDN of the machine running XUUDB"),
-            ('Domains.GATEWAY','sameas:FQDN',"FQDN of the machine running GATEWAY"),
-            ('Domains.WORKFLOW','sameas:FQDN',"FQDN of the machine running WORKFLOW"),
-            ('Domains.SERVORCH','sameas:FQDN',"FQDN of the machine running SERVORCH"),
-            ('Domains.TSI','sameas:FQDN',"FQDN of the machine running TSI"),
-            ('Port.GATEWAY',8080,"Port of the Gateway server, this port needs to be opened."),
+            ('FQDN' , "unicore.sample-fqdn.com", "FQDN of the main UNICORE server running most server daemons", FQDN()),
+
+            ('Domains.UNITY','sameas:FQDN',"FQDN of the machine running UNITY", FQDN()),
+            ('Domains.UNICOREX','sameas:FQDN',"FQDN of the machine running UNICOREX", FQDN()),
+            ('Domains.REGISTRY','sameas:FQDN',"FQDN of the machine running REGISTRY", FQDN()),
+            ('Domains.XUUDB','sameas:FQDN',"FQDN of the machine running XUUDB", FQDN()),
+            ('Domains.GATEWAY','sameas:FQDN',"FQDN of the machine running GATEWAY", FQDN()),
+            ('Domains.WORKFLOW','sameas:FQDN',"FQDN of the machine running WORKFLOW", FQDN()),
+            ('Domains.SERVORCH','sameas:FQDN',"FQDN of the machine running SERVORCH", FQDN()),
+            ('Domains.TSI','sameas:FQDN',"FQDN of the machine running TSI", FQDN()),
+            ('Port.GATEWAY',8080,"Port of the Gateway server, this port needs to be opened.", Port()),
             ('KeystorePass.UNITY','the!uvos',"Password for the p12 keystore holding the certificate of UNITY"),
             ('KeystorePass.UNICOREX','the!njs',"Password for the p12 keystore holding the certificate of UNICOREX"),
             ('KeystorePass.REGISTRY','the!registry',"Password for the p12 keystore holding the certificate of REGISTRY"),
@@ -33,34 +61,55 @@ class DaemonCertsSettings(AbstractSettings):
             ('KeystorePass.SERVORCH','the!servorch',"Password for the p12 keystore holding the certificate of SERVORCH"),
             ('KeystorePass.TSI','the!tsi',"Password for the p12 keystore holding the certificate of TSI"),
 
-            ('cert.years', 50 , "Years these certificates should be valid, i.e. years until admin retirement"),
+            ('cert.years', 50 , "Years these certificates should be valid, i.e. years until admin retirement", Int(minimum=1)),
+            ('cert.renewdays', 30, "Existing daemon certificates are kept, unless their subject, extensions, key or CA changed or they expire within this many days.", Int(minimum=0)),
             ('cert.email','admin@unicore.com',"Email for the Cert authority and other certs"),
-            ('cert.Country', 'US', "C-Field in the DN, e.g., US, DE, GB, etc. Maximum two letters!"),
+            ('cert.Country', 'US', "C-Field in the DN, e.g., US, DE, GB, etc. Maximum two letters!", Country()),
             ('cert.Locality', 'San Francisco', "L-Field in the DN, Locality, i.e., City."),
             ('cert.State', 'California', "ST-Field in the DN, State."),
             ('cert.Organization', 'MyOrganization', "O-Field in the DN. Your company"),
             ('cert.OrganizationalUnit', 'IT Services',"OU-Field in the DN. Where the Admin works in. For example IT Services."),
 
-            ('lifetime.default',8035200,"Lifetime until jobs are deleted. Default are 3 months."),
+            ('cert.keytype', 'RSA', "Key type of the daemon keys: RSA, ECDSA or Ed25519. Ed25519 requires all UNICORE components to support it.", Enum(*KEYTYPES)),
+            ('cert.keysize', 2048, "Key size of the daemon keys. RSA: bits (at least 2048). ECDSA: 256 (P-256) or 384 (P-384). Ignored for Ed25519.", Int(minimum=0)),
+            ('cert.ca_keytype', 'sameas:cert.keytype', "Key type of the self-signed CA key: RSA, ECDSA or Ed25519 (only with crypto.backend=cryptography). Defaults to cert.keytype.", Enum(*KEYTYPES)),
+            ('crypto.backend', 'cryptography', "Library writing certificates, requests and keystores: cryptography or pyopenssl. Both write the same files, pyopenssl is deprecated upstream.", Enum(*BACKENDS)),
+            ('cert.ca_keysize', 'sameas:cert.keysize', "Key size of the self-signed CA key. Defaults to cert.keysize.", Int(minimum=0)),
+
+            ('incremental', True, "Only regenerate outputs, whose inputs changed since the last run. The manifest of the last run is kept in directory.support. Use incremental=False to regenerate everything."),
+            ('output.fsync', True, "Flush generated files to disk before they replace the old ones. Use output.fsync=False on slow network filesystems, if a crash during the run is no concern."),
+            ('serial.block', 1, "Number of CA serials a run reserves at once. Larger blocks take the lock on directory.ca/serial less often, unused serials of a block are skipped.", Int(minimum=1)),
+            ('renew.interval', 3600, "Seconds between two expiry checks of CreateDaemonCerts.py renew-daemon.", Int(minimum=1)),
+            ('renew.hook', '', "Command run by renew-daemon after it renewed a certificate, e.g. a restart of the daemon. It gets DAEMONCERTS_SERVER, DAEMONCERTS_DN and DAEMONCERTS_KEYSTORE in its environment."),
+            ('service.socket', './daemoncerts.sock', "Unix socket of CreateDaemonCerts.py serve, only accessible to its owner. Empty: listen on 127.0.0.1:service.port instead, where every local user can request certificates.", Path(empty=True)),
+            ('service.port', 8765, "Port of CreateDaemonCerts.py serve on 127.0.0.1, if service.socket is empty.", Port()),
+            ('service.batch', 32, "Maximum number of queued requests CreateDaemonCerts.py serve signs together, with one serial reservation and one database transaction.", Int(minimum=1)),
+            ('keygen.workers', 1, "Number of processes generating missing daemon keys in parallel. 1 generates them one after another, 0 uses one process per CPU.", Int(minimum=0)),
+            ('keypool.directory', '', "Directory of the pool of pre-generated keys. Empty: no pool, keys are generated during the run.", Path(empty=True)),
+            ('keypool.lowwater', 8, "The key pool filler refills the pool, once less keys than this are left.", Int(minimum=0)),
+            ('keypool.cap', 32, "The key pool filler refills the pool up to this number of keys.", Int(minimum=1)),
+            ('keypool.interval', 60, "Seconds between two checks of the key pool filler.", Int(minimum=1)),
+
+            ('lifetime.default',8035200,"Lifetime until jobs are deleted. Default are 3 months.", Int(minimum=0)),
             ('lifetime.workflow','sameas:lifetime.default',"Lifetime until jobs are deleted. Defaults to lifetime.default (3 months)."),
 
             ('GCID','CLUSTER-SITE','GCID of the UNICORE/X.'),
             ('WF-GCID', 'WORKFLOW-SITE', 'GCID of the WORKFLOW server.'),
 
-            ('AUTHSERVER','UNITY','Auth using UNITY or XUUDB (case sensitive, can only be one of the two words)'),
-            ('CAMODE', 'SELFSIGNED', 'Mode of the CA. SELFSIGNED generates a new self-signed CA in the directory.ca directory. CSR generates certificate requests and exits the setup. INSTALLCSR is the second step after getting a response from the CA.'),
+            ('AUTHSERVER','UNITY','Auth using UNITY or XUUDB (case sensitive, can only be one of the two words)', Enum("UNITY", "XUUDB")),
+            ('CAMODE', 'SELFSIGNED', 'Mode of the CA. SELFSIGNED generates a new self-signed CA in the directory.ca directory. CSR generates certificate requests and exits the setup. INSTALLCSR is the second step after getting a response from the CA.', Enum("SELFSIGNED", "CSR", "INSTALLCSR")),
             ('AdminPass','<SCRAMBLE>','Initial password of the unity admin user. Default: Random password. Will be found in cleartext in unityServer.conf'),
 
-            ('directory.certs','./unicore/certs','Directory where all the certificates will be put'),
-            ('directory.ca', './CA', 'Directory where the self signed CA will be put'),
-            ('directory.csrs', './csrs', 'Directory where the certificate requests will be put, only in CSR mode.'),
-            ('directory.support', './supportfiles', 'Directory where supporting information will be put'),
-            ('directory.unicore', './unicore', 'Directory where changes to the template configurations should be put'),
-            ('directory.userfiles', './userfiles', 'Directory, where job storage will be put during processing. Has to be fast and accesible to all users. UNICORE user has to have write access during creation.')
+            ('directory.certs','./unicore/certs','Directory where all the certificates will be put', Path()),
+            ('directory.ca', './CA', 'Directory where the self signed CA will be put', Path()),
+            ('directory.csrs', './csrs', 'Directory where the certificate requests will be put, only in CSR mode.', Path()),
+            ('directory.support', './supportfiles', 'Directory where supporting information will be put', Path()),
+            ('directory.unicore', './unicore', 'Directory where changes to the template configurations should be put', Path()),
+            ('directory.userfiles', './userfiles', 'Directory, where job storage will be put during processing. Has to be fast and accesible to all users. UNICORE user has to have write access during creation.', Path())
         ]
 
-        for valuename,default,explanation in defaults:
-            self._add_default(valuename,default,explanation)
+        for default in defaults:
+            self._add_default(*default)
 
     def finalize(self):
         super(DaemonCertsSettings,self)._finish_parsing()
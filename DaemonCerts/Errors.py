@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+# Exceptions raised by DaemonCerts. All of them derive from DaemonCertsError.
+
+class DaemonCertsError(Exception):
+    pass
+
+class CAError(DaemonCertsError):
+    # The CA key or certificate is missing, unreadable or inconsistent
+    pass
+
+class XMLEditError(DaemonCertsError):
+    # An XPath of static_xml_changes does not match the template
+    pass
+
+class SettingsError(DaemonCertsError):
+    # The settings are invalid or incomplete, e.g. FQDN still has the sample value
+    pass
+
+class MissingInputError(DaemonCertsError):
+    # A file the run needs is missing, e.g. a certificate of the external CA in INSTALLCSR mode
+    pass
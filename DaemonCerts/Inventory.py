@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import datetime
+import binascii
+from os.path import join
+
+from DaemonCerts.utility.OutputWriter import OutputWriter
+
+# Inventory of the certificates below one or many UNICORE trees:
+#   CreateDaemonCerts.py inventory [DIR ...] [--json | --prometheus=FILE] [--workers=N] [--cache=FILE | --no-cache] [parameter=value ...]
+# Without DIR the trees of the settings are scanned: directory.certs, directory.unicore/tsi_selected/conf and
+# directory.unicore/unity/conf/pki. Every *.p12 and *.pem file is read, keystores are opened with KeystorePass.<NAME>
+# (gateway.p12 -> KeystorePass.GATEWAY) and, if that fails, with the other keystore passwords.
+#
+# One entry per certificate: {"path", "subject", "san", "serial", "not_after", "keytype", "fingerprint"}.
+# Unreadable files give an entry with "error" instead. The entries of a file are cached by path, mtime and size
+# (default: ~/.cache/daemoncerts/inventory.json), repeated scans only read changed files. Files are read in
+# a process pool, if more than one worker is requested (default: one per CPU) and enough files changed.
+
+NOT_AFTER_FORMAT = "%Y-%m-%d %H:%M:%S"
+CACHE_VERSION = 1
+# Files read per worker task, bigger chunks keep the pool overhead low on large trees
+CHUNKSIZE = 16
+
+def default_roots(dcs):
+    unicore_dir = dcs.get_value("directory.unicore")
+    return [dcs.get_value("directory.certs"), join(unicore_dir, "tsi_selected", "conf"), join(unicore_dir, "unity", "conf", "pki")]
+
+def find_files(roots):
+    # Sorted absolute paths of all keystores and PEM files below roots, every file only once
+    found = set()
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(".p12") or filename.endswith(".pem"):
+                    found.add(os.path.abspath(join(dirpath, filename)))
+    return sorted(found)
+
+def _key_type(public_key):
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return "RSA-%d" % public_key.key_size
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        return "ECDSA-%d" % public_key.curve.key_size
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return "Ed25519"
+    return type(public_key).__name__
+
+def describe_certificate(path, cert):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    # Written like the subjectAltName of the settings (see DaemonCerts.get_san_extension)
+    prefixes = {x509.DNSName : "DNS", x509.RFC822Name : "email", x509.UniformResourceIdentifier : "URI", x509.IPAddress : "IP"}
+    try:
+        names = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        san = ["%s:%s" % (prefixes.get(type(name), type(name).__name__), name.value) for name in names]
+    except x509.ExtensionNotFound:
+        san = []
+    return {"path" : path,
+            "subject" : cert.subject.rfc4514_string(),
+            "san" : san,
+            "serial" : cert.serial_number,
+            "not_after" : cert.not_valid_after.strftime(NOT_AFTER_FORMAT),
+            "keytype" : _key_type(cert.public_key()),
+            "fingerprint" : binascii.hexlify(cert.fingerprint(hashes.SHA256())).decode("ascii")}
+
+def keystore_certificates(data, passphrase):
+    # Certificates of a PKCS#12 keystore, raises ValueError for a wrong passphrase.
+    # cryptography validates the private key while loading it, which takes most of the time for RSA keys.
+    # OpenSSL.crypto, if installed, does not and is used instead: only the certificates are needed here.
+    try:
+        from OpenSSL import crypto
+    except ImportError:
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        key, cert, chain = pkcs12.load_key_and_certificates(data, passphrase.encode("UTF-8"))
+        return [one for one in [cert] + list(chain or []) if one is not None]
+    try:
+        p12 = crypto.load_pkcs12(data, passphrase.encode("UTF-8"))
+    except crypto.Error as e:
+        raise ValueError(str(e))
+    certs = [p12.get_certificate()] + list(p12.get_ca_certificates() or [])
+    return [one.to_cryptography() for one in certs if one is not None]
+
+def read_file(parameters):
+    # (path, [passphrase, ...]) -> entries of all certificates in the file. Runs in the worker processes.
+    path, passphrases = parameters
+    from cryptography import x509
+    try:
+        with open(path, 'rb') as infile:
+            data = infile.read()
+        if path.endswith(".p12"):
+            for passphrase in passphrases:
+                try:
+                    certs = keystore_certificates(data, passphrase)
+                except ValueError:
+                    continue
+                return [describe_certificate(path, cert) for cert in certs]
+            return [{"path" : path, "error" : "none of the KeystorePass passwords opens the keystore"}]
+        marker = b"-----BEGIN CERTIFICATE-----"
+        blocks = [marker + block for block in data.split(marker)[1:]]
+        return [describe_certificate(path, x509.load_pem_x509_certificate(block)) for block in blocks]
+    except (IOError, OSError, ValueError) as e:
+        return [{"path" : path, "error" : str(e)}]
+
+def passphrases_for(path, keystore_passwords):
+    # The password of the daemon named like the file first
+    name = os.path.basename(path)[:-len(".p12")].upper() if path.endswith(".p12") else None
+    first = [keystore_passwords[name]] if name in keystore_passwords else []
+    return first + sorted(set(keystore_passwords.values()) - set(first))
+
+class Inventory(object):
+    def __init__(self, keystore_passwords, cache_path = None, workers = 0):
+        super(Inventory,self).__init__()
+        self.keystore_passwords = dict((str(name), str(value)) for name, value in keystore_passwords.items())
+        self.cache_path = cache_path
+        self.workers = workers
+        self.cached = 0
+        self.read = 0
+
+    def _load_cache(self):
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as infile:
+                content = json.load(infile)
+        except ValueError:
+            return {}
+        return content["files"] if content.get("version") == CACHE_VERSION else {}
+
+    def _save_cache(self, files):
+        if self.cache_path is None:
+            return
+        writer = OutputWriter(fsync=False)
+        writer.write(self.cache_path, json.dumps({"version" : CACHE_VERSION, "files" : files}, sort_keys=True), mode=0o600)
+
+    def _read_all(self, paths):
+        # {path : entries}, in a process pool for more than one worker
+        tasks = [(path, passphrases_for(path, self.keystore_passwords)) for path in paths]
+        if self.workers == 1 or len(tasks) <= CHUNKSIZE:
+            return dict(zip(paths, map(read_file, tasks)))
+        from concurrent.futures import ProcessPoolExecutor
+        max_workers = self.workers if self.workers > 0 else None
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(paths, pool.map(read_file, tasks, chunksize=CHUNKSIZE)))
+
+    def scan(self, roots):
+        # Entries of all certificates below roots, sorted by expiry
+        cache = self._load_cache()
+        files = {}
+        changed = []
+        for path in find_files(roots):
+            stat = os.stat(path)
+            state = {"mtime" : stat.st_mtime, "size" : stat.st_size}
+            cached = cache.get(path)
+            if cached is not None and cached["mtime"] == state["mtime"] and cached["size"] == state["size"]:
+                files[path] = cached
+            else:
+                files[path] = state
+                changed.append(path)
+        for path, entries in self._read_all(changed).items():
+            files[path]["entries"] = entries
+        self.read = len(changed)
+        self.cached = len(files) - len(changed)
+
+        # Files, which could not be read, are tried again next time
+        cache.update((path, state) for path, state in files.items() if not any("error" in entry for entry in state["entries"]))
+        for path in [path for path in cache if not path in files and not os.path.exists(path)]:
+            del cache[path]
+        self._save_cache(cache)
+
+        entries = [entry for path in sorted(files) for entry in files[path]["entries"]]
+        return sorted(entries, key=lambda entry : (not "error" in entry, entry.get("not_after", ""), entry["path"]))
+
+
+def days_left(entry, now = None):
+    now = now or datetime.datetime.utcnow()
+    not_after = datetime.datetime.strptime(entry["not_after"], NOT_AFTER_FORMAT)
+    return (not_after - now).total_seconds() / 86400.0
+
+def write_table(entries, outstream):
+    outstream.write("%-6s %-19s %-10s %-10s %-60s %s\n" % ("Days", "Not after", "Key", "Serial", "Subject", "Path"))
+    for entry in entries:
+        if "error" in entry:
+            outstream.write("%-6s %-19s %-10s %-10s %-60s %s\n" % ("-", "-", "-", "-", "ERROR: %s" % entry["error"], entry["path"]))
+            continue
+        outstream.write("%-6d %-19s %-10s %-10d %-60s %s\n" % (days_left(entry), entry["not_after"], entry["keytype"],
+                                                                entry["serial"], entry["subject"], entry["path"]))
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def prometheus_metrics(entries, duration):
+    # Text exposition format for the textfile collector of the node exporter
+    epoch = datetime.datetime(1970, 1, 1)
+    lines = ["# HELP daemoncerts_certificate_not_after_seconds Expiry of the certificate as unix time.",
+             "# TYPE daemoncerts_certificate_not_after_seconds gauge"]
+    for entry in entries:
+        if "error" in entry:
+            continue
+        not_after = datetime.datetime.strptime(entry["not_after"], NOT_AFTER_FORMAT)
+        lines.append('daemoncerts_certificate_not_after_seconds{path="%s",subject="%s",serial="%d",keytype="%s"} %d' %
+                     (_label(entry["path"]), _label(entry["subject"]), entry["serial"], _label(entry["keytype"]),
+                      (not_after - epoch).total_seconds()))
+    lines += ["# HELP daemoncerts_inventory_errors Files, which could not be read.",
+              "# TYPE daemoncerts_inventory_errors gauge",
+              "daemoncerts_inventory_errors %d" % len([entry for entry in entries if "error" in entry]),
+              "# HELP daemoncerts_inventory_duration_seconds Duration of the last inventory scan.",
+              "# TYPE daemoncerts_inventory_duration_seconds gauge",
+              "daemoncerts_inventory_duration_seconds %.3f" % duration]
+    return "\n".join(lines) + "\n"
+
+
+def inventory_main(sysargs):
+    """
+    CreateDaemonCerts.py inventory [DIR ...] [--json | --prometheus=FILE] [--workers=N] [--cache=FILE | --no-cache] [parameter=value ...]
+    Lists all certificates below the trees, soonest expiry first. Returns 2, if any file could not be read.
+    """
+    from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings, SETTINGS_FLAGS
+    from DaemonCerts.utility.AbstractSettings import AbstractSettings, SettingsValidationError
+    options = {"--prometheus" : None, "--workers" : "0",
+               "--cache" : join(AbstractSettings.default_cache_dir(), "inventory.json")}
+    for arg in sysargs:
+        if "=" in arg and arg.split("=")[0] in options:
+            option, value = arg.split("=", 1)
+            options[option] = value
+    roots = [arg for arg in sysargs if not arg.startswith("--") and not "=" in arg]
+    settings_args = [arg for arg in sysargs if "=" in arg and (not arg.startswith("--") or arg.split("=")[0] in SETTINGS_FLAGS)]
+
+    dcs = DaemonCertsSettings()
+    dcs.parse_command_line(settings_args)
+    try:
+        dcs.finalize()
+    except SettingsValidationError as e:
+        print(e)
+        return 1
+
+    start = time.time()
+    inventory = Inventory(dcs.get_value("KeystorePass"),
+                          cache_path=None if "--no-cache" in sysargs else options["--cache"],
+                          workers=int(options["--workers"]))
+    entries = inventory.scan(roots or default_roots(dcs))
+    duration = time.time() - start
+
+    if options["--prometheus"] is not None:
+        OutputWriter(fsync=False).write(options["--prometheus"], prometheus_metrics(entries, duration))
+        print("%d certificates, metrics written to %s" % (len(entries), options["--prometheus"]))
+    elif "--json" in sysargs:
+        json.dump(entries, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        write_table(entries, sys.stdout)
+        sys.stdout.write("%d certificates in %d files (%d from the cache) in %.2f s.\n" %
+                         (len([entry for entry in entries if not "error" in entry]), inventory.read + inventory.cached,
+                          inventory.cached, duration))
+    return 2 if any("error" in entry for entry in entries) else 0
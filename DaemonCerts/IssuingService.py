@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import json
+import stat
+import signal
+import asyncio
+import datetime
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.CryptoBackend import CertSpec
+from DaemonCerts.KeyGenerator import generate_keys, key_to_pem
+from DaemonCerts.RenewalDaemon import log
+from DaemonCerts.Errors import CAError
+from DaemonCerts.utility.AbstractSettings import FQDN
+
+# Local certificate issuing service of the self-signed CA:
+#   CreateDaemonCerts.py serve parameter=value ...
+# Settings and CA are loaded once. The service speaks HTTP/1.1 (one request per connection) on the Unix socket
+# service.socket, accessible to its owner only, or, if that is empty, on 127.0.0.1:service.port:
+#   GET /ca       the CA certificate (PEM)
+#   GET /status   counters (JSON)
+#   POST /issue   JSON {"daemon": "TSI", "fqdn": "node17.example.com", "site": "NODE17", "format": "pem", "passphrase": "...", "csr": "..."}
+# daemon is one of the UNICORE servers, fqdn defaults to Domains.<daemon>, site (stored in the certificate database) is optional.
+# Without csr a new key is generated and the reply is key, certificate and CA certificate as PEM or, with
+# "format": "pkcs12", a keystore protected by passphrase (default KeystorePass.<daemon>) as written by a run.
+# With csr only the public key of the request is used, the reply is certificate and CA certificate as PEM.
+# Subject and extensions always come from set_cert_attributes, the certificates are the ones a run would issue.
+# Serial and DN are returned in the headers X-DaemonCerts-Serial and X-DaemonCerts-DN.
+#
+# Requests are queued. All requests waiting when the signer becomes free are issued together: their keys are generated
+# in the process pool of keygen.workers (or taken from the key pool), the serials are reserved with one lock of
+# directory.ca/serial and the certificates are recorded in one transaction. At most service.batch requests form a batch.
+
+FORMATS = ["pem", "pkcs12"]
+# Bytes
+MAX_BODY = 64 * 1024
+# Seconds a client has to send its request
+READ_TIMEOUT = 30
+REASONS = {200 : "OK", 400 : "Bad Request", 404 : "Not Found", 405 : "Method Not Allowed", 408 : "Request Timeout",
+           413 : "Payload Too Large", 500 : "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super(HTTPError,self).__init__(message)
+        self.status = status
+
+
+class IssueRequest(object):
+    def __init__(self, daemon, fqdn, site = None, format = "pem", passphrase = None, public_key = None):
+        super(IssueRequest,self).__init__()
+        self.daemon = daemon
+        self.fqdn = fqdn
+        self.site = site
+        self.format = format
+        self.passphrase = passphrase
+        # Public key of a certificate request, None: a new key is generated
+        self.public_key = public_key
+
+
+class IssueResult(object):
+    def __init__(self, serial, dn, content_type, content):
+        super(IssueResult,self).__init__()
+        self.serial = serial
+        self.dn = dn
+        self.content_type = content_type
+        self.content = content
+
+
+class Issuer(object):
+    # Issues batches of IssueRequests with the CA of a DaemonCerts instance. Only used from one thread at a time.
+    def __init__(self, dc):
+        super(Issuer,self).__init__()
+        self.dc = dc
+        self.workers = dc.dcs.get_value("keygen.workers")
+        self.keygen_pool = None
+        if self.workers != 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self.keygen_pool = ProcessPoolExecutor(max_workers=self.workers if self.workers > 0 else None)
+
+    def close(self):
+        if self.keygen_pool is not None:
+            self.keygen_pool.shutdown()
+
+    def new_keys(self, count):
+        # Keys of the key pool first, as in DaemonCerts.pregenerate_keys
+        keys = []
+        keypool = self.dc.keypool
+        while keypool is not None and len(keys) < count:
+            key = keypool.take()
+            if key is None:
+                break
+            keys.append(key)
+        keytype, keysize = self.dc.get_key_parameters()
+        return keys + generate_keys(count - len(keys), workers=self.workers, keytype=keytype, keysize=keysize, pool=self.keygen_pool)
+
+    def issue_batch(self, requests):
+        # Returns an IssueResult for every request, or the exception, if that request failed. The others are issued anyway.
+        dc = self.dc
+        ca = dc.get_ca()
+        years = dc.dcs.get_value("cert.years")
+        # Subjects and extensions first: keys and serials are only spent on requests, which can be issued
+        results = [None] * len(requests)
+        specs = {}
+        for index, request in enumerate(requests):
+            try:
+                spec = CertSpec()
+                dc.set_cert_attributes(request.daemon, spec, request.fqdn)
+                specs[index] = spec
+            except Exception as e:
+                results[index] = e
+        valid = sorted(specs)
+        keys = self.new_keys(len([index for index in valid if requests[index].public_key is None]))
+        first = dc.get_serials().reserve(len(valid)) if valid else None
+        issued = datetime.datetime.utcnow()
+        entries, rows = [], []
+        for serial, index in enumerate(valid, first):
+            request, spec = requests[index], specs[index]
+            key = keys.pop() if request.public_key is None else None
+            try:
+                cert = dc.crypto.create_certificate(spec, key, serial, years, issuer_cert=ca.cert, issuer_key=ca.key,
+                                                    public_key=request.public_key)
+                dn = dc.name_to_rfc4514(dc.crypto.subject_components(cert))
+                if request.format == "pkcs12":
+                    content_type, content = "application/x-pkcs12", dc.crypto.export_pkcs12(key, cert, request.passphrase)
+                else:
+                    content_type, content = "application/x-pem-file", dc.crypto.dump_certificate(cert) + ca.cert_pem
+                    if key is not None:
+                        content = key_to_pem(key) + content
+            except Exception as e:
+                # The serial stays unused
+                results[index] = e
+                continue
+            entries.append((serial, request.daemon, dn))
+            rows.append((serial, dn, spec.get_extension("subjectAltName"), request.daemon, request.site,
+                         dc.crypto.not_after(cert), dc.crypto.fingerprint(cert), issued))
+            results[index] = IssueResult(serial, dn, content_type, content)
+        if entries:
+            dc.get_serials().record_many(entries)
+            dc.get_database().add_many(rows)
+        return results
+
+
+async def read_request(reader):
+    # Returns (method, path, body)
+    try:
+        method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length.")
+    if length > MAX_BODY:
+        raise HTTPError(413, "Requests are limited to %d bytes." % MAX_BODY)
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method, path.split("?")[0], body
+
+
+def format_response(status, content_type, content, headers = None):
+    head = ["HTTP/1.1 %d %s" % (status, REASONS[status]),
+            "Content-Type: %s" % content_type,
+            "Content-Length: %d" % len(content),
+            "Connection: close"]
+    for name, value in sorted((headers or {}).items()):
+        head.append("%s: %s" % (name, value))
+    return ("\r\n".join(head) + "\r\n\r\n").encode("UTF-8") + content
+
+
+class IssuingService(object):
+    def __init__(self, issuer, batch_size = 32):
+        super(IssuingService,self).__init__()
+        self.issuer = issuer
+        self.dc = issuer.dc
+        self.batch_size = batch_size
+        self.queue = None
+        from concurrent.futures import ThreadPoolExecutor
+        # Signing, serials and the database stay in one thread, the event loop keeps accepting requests
+        self.signer = ThreadPoolExecutor(max_workers=1)
+        self.counters = {"issued" : 0, "failed" : 0, "batches" : 0, "largest_batch" : 0, "failed_batches" : 0}
+
+    def parse_issue_request(self, body):
+        dc = self.dc
+        try:
+            data = json.loads(body.decode("UTF-8"))
+        except ValueError:
+            raise HTTPError(400, "The body has to be a JSON object.")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "The body has to be a JSON object.")
+        for name in ["daemon", "fqdn", "site", "format", "passphrase", "csr"]:
+            if data.get(name) is not None and not isinstance(data[name], str):
+                raise HTTPError(400, "%s has to be a string." % name)
+        daemon = data.get("daemon")
+        if not daemon in dc.servers:
+            raise HTTPError(400, "daemon has to be one of %s." % ", ".join(dc.servers))
+        fqdn = data.get("fqdn") or dc.dcs.get_value("Domains.%s" % daemon)
+        try:
+            fqdn = FQDN().check(fqdn)
+        except ValueError:
+            raise HTTPError(400, "fqdn %s is not a fully qualified domain name." % fqdn)
+        format = data.get("format") or "pem"
+        if not format in FORMATS:
+            raise HTTPError(400, "format has to be one of %s." % ", ".join(FORMATS))
+        public_key = None
+        if data.get("csr") is not None:
+            if format == "pkcs12":
+                raise HTTPError(400, "PKCS#12 bundles need the private key, which is not part of a certificate request.")
+            try:
+                public_key = dc.crypto.request_public_key(data["csr"].encode("ascii"))
+            except (ValueError, TypeError, UnicodeError) as e:
+                raise HTTPError(400, "Could not load the certificate request: %s" % e)
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            if isinstance(public_key, rsa.RSAPublicKey) and public_key.key_size < 2048:
+                raise HTTPError(400, "RSA keys need to have at least 2048 bits, the request has %d." % public_key.key_size)
+        passphrase = data.get("passphrase") or dc.dcs.get_value("KeystorePass.%s" % daemon)
+        return IssueRequest(daemon, fqdn, site=data.get("site"), format=format, passphrase=passphrase, public_key=public_key)
+
+    async def dispatch(self, method, path, body):
+        # Returns (status, content_type, content, headers)
+        routes = {"/ca" : "GET", "/status" : "GET", "/issue" : "POST"}
+        if not path in routes:
+            raise HTTPError(404, "Unknown path %s, the service knows %s." % (path, ", ".join(sorted(routes))))
+        if method != routes[path]:
+            raise HTTPError(405, "%s only supports %s." % (path, routes[path]))
+        if path == "/ca":
+            return 200, "application/x-pem-file", self.dc.get_ca().cert_pem, {}
+        if path == "/status":
+            status = dict(self.counters, queued=self.queue.qsize())
+            return 200, "application/json", json.dumps(status, sort_keys=True).encode("UTF-8"), {}
+        request = self.parse_issue_request(body)
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((request, future))
+        result = await future
+        return 200, result.content_type, result.content, {"X-DaemonCerts-Serial" : str(result.serial), "X-DaemonCerts-DN" : result.dn}
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await asyncio.wait_for(read_request(reader), READ_TIMEOUT)
+                status, content_type, content, headers = await self.dispatch(method, path, body)
+            except HTTPError as e:
+                status, content_type, content, headers = e.status, "text/plain", ("%s\n" % e).encode("UTF-8"), {}
+            except asyncio.TimeoutError:
+                status, content_type, content, headers = 408, "text/plain", b"Timeout reading the request.\n", {}
+            except asyncio.IncompleteReadError:
+                return
+            except Exception as e:
+                log("Request failed: %s: %s" % (type(e).__name__, e))
+                status, content_type, content, headers = 500, "text/plain", b"Issuing failed, see the log of the service.\n", {}
+            writer.write(format_response(status, content_type, content, headers))
+            await writer.drain()
+        except (ConnectionError, OSError):
+            # The client went away
+            pass
+        finally:
+            writer.close()
+
+    async def batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.signer, self.issuer.issue_batch, [request for request, _ in batch])
+            except Exception as e:
+                self.counters["failed_batches"] += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.counters["batches"] += 1
+                self.counters["largest_batch"] = max(self.counters["largest_batch"], len(batch))
+                for (_, future), result in zip(batch, results):
+                    failed = isinstance(result, Exception)
+                    self.counters["failed" if failed else "issued"] += 1
+                    if future.done():
+                        continue
+                    if failed:
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def serve(self, socket_path = None, port = 8765):
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        if socket_path:
+            if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                # Left behind by a service, which did not stop cleanly
+                os.remove(socket_path)
+            # The socket is created accessible to its owner only
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            finally:
+                os.umask(umask)
+            log("Issuing certificates on %s." % socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host="127.0.0.1", port=port)
+            log("Issuing certificates on 127.0.0.1:%d, every local user can request certificates." % port)
+        batcher = asyncio.ensure_future(self.batcher())
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        log("Stopping.")
+        server.close()
+        await server.wait_closed()
+        # Requests already queued are still answered
+        await self.queue.join()
+        batcher.cancel()
+        self.signer.shutdown()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def serve_main(sysargs):
+    """
+    CreateDaemonCerts.py serve parameter=value ...
+    Issues certificates of the self-signed CA over HTTP on service.socket or 127.0.0.1:service.port.
+    """
+    dc = DaemonCerts(sysargs)
+    if dc.dcs.get_value("CAMODE") != "SELFSIGNED":
+        print("serve requires CAMODE=SELFSIGNED, an external CA cannot sign here. Quitting.")
+        return 1
+    try:
+        dc.check_key_parameters()
+    except ValueError as e:
+        print("%s Quitting." % e)
+        return 1
+    try:
+        dc.get_ca()
+    except CAError as e:
+        print("%s Please create the CA with a run of CreateDaemonCerts.py first. Quitting." % e)
+        return 1
+    issuer = Issuer(dc)
+    service = IssuingService(issuer, batch_size=dc.dcs.get_value("service.batch"))
+    try:
+        asyncio.run(service.serve(dc.dcs.get_value("service.socket"), dc.dcs.get_value("service.port")))
+    finally:
+        issuer.close()
+    return 0
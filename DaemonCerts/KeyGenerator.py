@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+# Key generation helpers. RSA key generation is by far the most expensive step of a run,
+# therefore keys for several daemons can be generated in a process pool.
+# Keys are private key objects of the cryptography library, whichever crypto backend is used (see CryptoBackend).
+
+DEFAULT_KEYTYPE = "RSA"
+DEFAULT_KEYSIZE = 2048
+
+KEYTYPES = ["RSA", "ECDSA", "Ed25519"]
+# keysize -> curve
+ECDSA_CURVES = {
+    256 : "SECP256R1",
+    384 : "SECP384R1"
+}
+
+def check_key_parameters(keytype, keysize, signing = False):
+    """
+    Raises a ValueError for unsupported combinations.
+    signing has to be True for keys, which sign certificates or requests themselves (CA and CSR keys),
+    if the crypto backend cannot sign with Ed25519 keys.
+    """
+    if not keytype in KEYTYPES:
+        raise ValueError("Key type %s is not supported. Supported types: %s" % (keytype, ", ".join(KEYTYPES)))
+    if keytype == "RSA" and keysize < 2048:
+        raise ValueError("RSA keys need to have at least 2048 bits, %s was requested." % keysize)
+    if keytype == "ECDSA" and not keysize in ECDSA_CURVES:
+        raise ValueError("ECDSA keys support the key sizes %s (P-256 and P-384), %s was requested." %
+                         (" and ".join(str(size) for size in sorted(ECDSA_CURVES)), keysize))
+    if keytype == "Ed25519" and signing:
+        raise ValueError("Ed25519 keys can only sign certificates or requests with crypto.backend=cryptography. "
+                         "Please choose RSA or ECDSA for the CA (cert.ca_keytype) and for certificate requests.")
+
+def key_to_pem(key):
+    # Unencrypted PKCS#8 PEM, as written by OpenSSL
+    from cryptography.hazmat.primitives import serialization
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+def key_from_pem(pem):
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_private_key(pem, password=None)
+
+def generate_key(keytype = DEFAULT_KEYTYPE, keysize = DEFAULT_KEYSIZE):
+    # Unsupported types and sizes raise the ValueError of check_key_parameters
+    check_key_parameters(keytype, keysize)
+    if keytype == "RSA":
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        return rsa.generate_private_key(public_exponent=65537, key_size=keysize)
+    if keytype == "ECDSA":
+        from cryptography.hazmat.primitives.asymmetric import ec
+        curve = getattr(ec, ECDSA_CURVES[keysize])
+        return ec.generate_private_key(curve())
+    if keytype == "Ed25519":
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        return ed25519.Ed25519PrivateKey.generate()
+
+def key_matches(key, keytype, keysize):
+    # True if key is of the given type and size
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+    if keytype == "RSA":
+        return isinstance(key, rsa.RSAPrivateKey) and key.key_size == keysize
+    if keytype == "ECDSA":
+        return isinstance(key, ec.EllipticCurvePrivateKey) and key.curve.key_size == keysize
+    if keytype == "Ed25519":
+        return isinstance(key, ed25519.Ed25519PrivateKey)
+    return False
+
+def _generate_key_pem(parameters):
+    # Key objects cannot be pickled, worker processes therefore hand back PEM
+    keytype, keysize = parameters
+    return key_to_pem(generate_key(keytype, keysize))
+
+def generate_keys(count, workers = 1, keytype = DEFAULT_KEYTYPE, keysize = DEFAULT_KEYSIZE, pool = None):
+    """
+    Generates count keys. With workers != 1 the keys are generated in a process pool,
+    workers == 0 uses one process per CPU. The order of the returned list is deterministic.
+    pool is an existing ProcessPoolExecutor, which long-running callers keep instead of starting one per call.
+    """
+    if count <= 0:
+        return []
+    if (workers == 1 and pool is None) or count == 1 or keytype != "RSA":
+        # Only RSA keys are expensive enough to be worth the pool.
+        return [generate_key(keytype, keysize) for _ in range(count)]
+
+    if pool is not None:
+        return [key_from_pem(pem) for pem in pool.map(_generate_key_pem, [(keytype, keysize)] * count)]
+    from concurrent.futures import ProcessPoolExecutor
+    max_workers = min(workers, count) if workers > 0 else None
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pems = list(pool.map(_generate_key_pem, [(keytype, keysize)] * count))
+    return [key_from_pem(pem) for pem in pems]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+from os.path import join
+
+from DaemonCerts.KeyGenerator import generate_key, generate_keys, check_key_parameters, key_to_pem, key_from_pem, \
+    DEFAULT_KEYTYPE, DEFAULT_KEYSIZE
+from DaemonCerts.utility.misc_file_functions import mkdir_p
+
+# Pool of pre-generated private keys.
+# Layout: keypool.directory/<keytype>-<keysize>/<uuid>.pem, keypool.directory/ed25519/<uuid>.pem
+# A key is taken by renaming it to a name unique to the taking process. rename is atomic,
+# therefore every key is handed out exactly once, even if several runs share the pool.
+
+class KeyPool(object):
+    def __init__(self, directory, keysize = DEFAULT_KEYSIZE, keytype = DEFAULT_KEYTYPE):
+        super(KeyPool,self).__init__()
+        self.directory = directory
+        if keytype == "Ed25519":
+            # Ed25519 keys have a fixed size
+            self.slot = join(directory, keytype.lower())
+        else:
+            self.slot = join(directory, "%s-%d" % (keytype.lower(), keysize))
+        self.keysize = keysize
+        self.keytype = keytype
+
+    def _make_dirs(self):
+        for path in [self.directory, self.slot]:
+            mkdir_p(path)
+            os.chmod(path, 0o700)
+
+    def _key_files(self):
+        try:
+            return sorted(name for name in os.listdir(self.slot) if name.endswith(".pem"))
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return []
+            raise
+
+    def available(self):
+        return len(self._key_files())
+
+    def _update_stats(self, **increments):
+        # Counters are shared between all processes using the pool, therefore they are updated under a lock.
+        self._make_dirs()
+        with open(join(self.slot, ".lock"), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            stats = self.stats()
+            for counter, increment in increments.items():
+                stats[counter] = stats.get(counter, 0) + increment
+            statsfile = join(self.slot, "stats.json")
+            with open(statsfile + "_new", 'w') as out:
+                json.dump(stats, out)
+            os.rename(statsfile + "_new", statsfile)
+        return stats
+
+    def stats(self):
+        statsfile = join(self.slot, "stats.json")
+        if not os.path.isfile(statsfile):
+            return {"hits": 0, "misses": 0, "added": 0}
+        with open(statsfile, 'r') as infile:
+            return json.load(infile)
+
+    def take(self):
+        # Returns a key from the pool or None if the pool is empty
+        for name in self._key_files():
+            keyfile = join(self.slot, name)
+            claimed = "%s.taken-%d" % (keyfile, os.getpid())
+            try:
+                os.rename(keyfile, claimed)
+            except OSError as exc:
+                # Somebody else was faster
+                if exc.errno == errno.ENOENT:
+                    continue
+                raise
+            with open(claimed, 'rb') as infile:
+                key = key_from_pem(infile.read())
+            os.remove(claimed)
+            self._update_stats(hits=1)
+            return key
+        self._update_stats(misses=1)
+        return None
+
+    def get_key(self):
+        # Returns a key from the pool, falls back to generating one inline
+        key = self.take()
+        if key is None:
+            key = generate_key(self.keytype, self.keysize)
+        return key
+
+    def put(self, key):
+        self._make_dirs()
+        import uuid
+        name = join(self.slot, "%s.pem" % uuid.uuid4().hex)
+        tmpname = join(self.slot, ".%s.tmp" % uuid.uuid4().hex)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(key_to_pem(key))
+        # Only complete keys become visible under the .pem name
+        os.rename(tmpname, name)
+
+    def fill(self, low_water, cap, workers = 1):
+        # Refills the pool up to cap, once it dropped below low_water. Returns the number of added keys.
+        available = self.available()
+        if available >= low_water:
+            return 0
+        # cap below low_water would give a negative count
+        missing = max(0, cap - available)
+        if missing == 0:
+            return 0
+        for key in generate_keys(missing, workers=workers, keytype=self.keytype, keysize=self.keysize):
+            self.put(key)
+        self._update_stats(added=missing)
+        return missing
+
+
+def get_keypool(dcs, keytype = None, keysize = None):
+    # Returns the KeyPool configured in the settings or None if no pool is configured.
+    # Without keytype and keysize, the pool of the daemon key type (cert.keytype, cert.keysize) is returned.
+    directory = dcs.get_value("keypool.directory")
+    if not directory:
+        return None
+    if keytype is None:
+        keytype = dcs.get_value("cert.keytype")
+        keysize = dcs.get_value("cert.keysize")
+    return KeyPool(directory, keysize=keysize, keytype=keytype)
+
+
+def fill_main(sysargs):
+    """
+    Background filler: CreateDaemonCerts.py keypool-fill [--once] [--stats] keypool.directory=DIR ...
+    Keeps the pool between keypool.lowwater and keypool.cap keys of type cert.keytype and size cert.keysize,
+    checking every keypool.interval seconds.
+    """
+    from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings
+    from DaemonCerts.utility.AbstractSettings import SettingsValidationError
+    dcs = DaemonCertsSettings()
+    dcs.parse_command_line(sysargs)
+    try:
+        dcs.finalize()
+    except SettingsValidationError as e:
+        print(e)
+        return 1
+
+    pool = get_keypool(dcs)
+    if pool is None:
+        print("Please specify keypool.directory=DIR for the key pool.")
+        return 1
+    check_key_parameters(pool.keytype, pool.keysize)
+
+    if "--stats" in sysargs:
+        stats = pool.stats()
+        print("Key pool %s: %d keys available, %d hits, %d misses, %d keys added." %
+              (pool.slot, pool.available(), stats["hits"], stats["misses"], stats["added"]))
+        return 0
+
+    low_water = dcs.get_value("keypool.lowwater")
+    cap = dcs.get_value("keypool.cap")
+    if cap < low_water:
+        print("keypool.cap (%d) has to be at least keypool.lowwater (%d)." % (cap, low_water))
+        return 1
+    interval = dcs.get_value("keypool.interval")
+    workers = dcs.get_value("keygen.workers")
+    while True:
+        added = pool.fill(low_water, cap, workers=workers)
+        if added > 0:
+            print("Added %d keys to key pool %s." % (added, pool.slot))
+            sys.stdout.flush()
+        if "--once" in sysargs:
+            return 0
+        time.sleep(interval)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import signal
+import datetime
+import subprocess
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.CryptoBackend import CertSpec
+from DaemonCerts.RunManifest import RunManifest
+from DaemonCerts.CertificateDatabase import format_time
+from DaemonCerts.Errors import DaemonCertsError
+
+# Resident renewal of the daemon certificates of one site (self-signed CA only):
+#   CreateDaemonCerts.py renew-daemon [--once] parameter=value ...
+# The settings are parsed and the CA is loaded once. Every renew.interval seconds the certificate database
+# (see CertificateDatabase) is asked for the newest certificates of the site (GCID) expiring within cert.renewdays.
+# Only those are renewed, through DaemonCerts.gen_or_update_server_cert, i.e. with the same keys, serial allocation
+# and outputs as a full run. After every renewal renew.hook is run, e.g. to restart the daemon.
+# SIGHUP reloads the settings (command line, settings files, environment), SIGTERM and SIGINT stop the daemon.
+# The CA certificate itself is not renewed.
+#
+# Certificates issued before the database existed are added to it on start, if they were signed by the CA.
+
+def log(message):
+    print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+    sys.stdout.flush()
+
+class RenewalDaemon(object):
+    def __init__(self, sysargs):
+        super(RenewalDaemon,self).__init__()
+        self.sysargs = sysargs
+        self.dc = None
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def load(self):
+        # (Re)creates the DaemonCerts instance. CA context, serial allocator and database are kept, if the CA and the
+        # crypto backend stay the same. Until the new instance has loaded its CA and indexed the site, the previous one stays in use.
+        previous = self.dc
+        dc = DaemonCerts(self.sysargs)
+        if dc.dcs.get_value("CAMODE") != "SELFSIGNED":
+            raise ValueError("renew-daemon requires CAMODE=SELFSIGNED, the certificates of an external CA cannot be renewed here.")
+        shared = previous is not None and all(previous.dcs.get_value(name) == dc.dcs.get_value(name)
+                                              for name in ["directory.ca", "crypto.backend"])
+        if shared:
+            dc.ca = previous.ca
+            dc.serials = previous.serials
+            dc.database = previous.database
+        try:
+            dc.get_ca()
+            self.index_site(dc)
+        except BaseException:
+            if not shared and dc.database is not None:
+                dc.database.close()
+            raise
+        if previous is not None and not shared and previous.database is not None:
+            previous.database.close()
+        self.dc = dc
+
+    def index_site(self, dc):
+        # Adds the certificates of the site, which are not in the database yet
+        site = dc.dcs.get_value("GCID")
+        known = set(row["daemon"] for row in dc.get_database().current(site))
+        for server in dc.servers:
+            p12_path = dc.get_p12_path(server)
+            if server in known or not os.path.isfile(p12_path):
+                continue
+            with open(p12_path, 'rb') as infile:
+                key, cert = dc.crypto.load_pkcs12(infile.read(), dc.dcs.get_value("KeystorePass.%s" % server))
+            if cert is None or not dc.crypto.issued_by(cert, dc.get_ca_cert()):
+                continue
+            spec = CertSpec()
+            dc.set_cert_attributes(server, spec)
+            dn = dc.name_to_rfc4514(dc.crypto.subject_components(cert))
+            dc.get_database().add(dc.crypto.serial(cert), dn,
+                                  spec.get_extension("subjectAltName") if dc.crypto.matches_spec(cert, spec) else None,
+                                  server, site, dc.crypto.not_after(cert), dc.crypto.fingerprint(cert))
+            log("Indexed certificate of server %s, valid until %s." % (server, dc.crypto.not_after(cert)))
+
+    def due(self):
+        # Servers of the site, whose newest certificate expires within cert.renewdays
+        dc = self.dc
+        before = datetime.datetime.utcnow() + datetime.timedelta(days=dc.dcs.get_value("cert.renewdays"))
+        rows = dc.get_database().current_expiring(dc.dcs.get_value("GCID"), before)
+        return [row["daemon"] for row in rows if row["daemon"] in dc.servers]
+
+    def renew(self, server):
+        # Returns False, if gen_or_update_server_cert kept the certificate, e.g. because the database entry was outdated
+        dc = self.dc
+        # Full runs might have written the manifest in between
+        dc.manifest = RunManifest(dc.manifest.path, enabled=dc.manifest.enabled)
+        # The manifest would consider the certificate up to date, its inputs did not change
+        dc.manifest.forget("cert:%s" % server)
+        # Holds the serial of server only, if a new certificate is signed
+        dc.issued.pop(server, None)
+        dn = dc.gen_or_update_server_cert(server)
+        dc.writer.sync()
+        dc.manifest.save(dc.writer)
+        if dc.issued.get(server) is None:
+            log("Certificate of server %s was not renewed, the one in %s does not expire within cert.renewdays." %
+                (server, dc.get_p12_path(server)))
+            return False
+        log("Renewed certificate of server %s, DN: <%s>." % (server, dn))
+        self.run_hook(server, dn)
+        return True
+
+    def run_hook(self, server, dn):
+        hook = self.dc.dcs.get_value("renew.hook")
+        if not hook:
+            return
+        environment = dict(os.environ)
+        environment.update({"DAEMONCERTS_SERVER" : server, "DAEMONCERTS_DN" : dn,
+                            "DAEMONCERTS_KEYSTORE" : self.dc.get_p12_path(server)})
+        returncode = subprocess.call(hook, shell=True, env=environment)
+        if returncode != 0:
+            log("renew.hook exited with code %d for server %s." % (returncode, server))
+
+    def check(self):
+        # Returns the number of renewed certificates
+        renewed = 0
+        for server in self.due():
+            try:
+                if self.renew(server):
+                    renewed += 1
+            except Exception as e:
+                log("Renewing the certificate of server %s failed: %s: %s" % (server, type(e).__name__, e))
+        return renewed
+
+    def next_due(self):
+        # Time (UTC) at which the next certificate of the site enters the renewal window, None if there is none
+        dc = self.dc
+        rows = [row for row in dc.get_database().current(dc.dcs.get_value("GCID")) if row["daemon"] in dc.servers and not row["revoked"]]
+        if not rows:
+            return None
+        earliest = min(row["not_after"] for row in rows)
+        return datetime.datetime.strptime(earliest, "%Y-%m-%d %H:%M:%S") - datetime.timedelta(days=dc.dcs.get_value("cert.renewdays"))
+
+    def _on_hup(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def sleep(self, seconds):
+        # Wakes up early for signals
+        end = time.time() + seconds
+        while time.time() < end and not self.reload_requested and not self.stop_requested:
+            time.sleep(min(1.0, end - time.time()))
+
+    def run(self, once = False):
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self.load()
+        while True:
+            renewed = self.check()
+            next_due = self.next_due()
+            log("%d certificates renewed, next renewal due %s." %
+                (renewed, "never" if next_due is None else format_time(next_due) + " UTC"))
+            if once:
+                return 0
+            self.sleep(self.dc.dcs.get_value("renew.interval"))
+            if self.stop_requested:
+                log("Stopping.")
+                return 0
+            if self.reload_requested:
+                self.reload_requested = False
+                log("Reloading settings.")
+                try:
+                    self.load()
+                except (Exception, SystemExit) as e:
+                    # The old settings stay active
+                    log("Reloading the settings failed, keeping the previous ones: %s" % e)
+
+
+def renew_daemon_main(sysargs):
+    """
+    CreateDaemonCerts.py renew-daemon [--once] parameter=value ...
+    Renews the certificates of the site, which expire within cert.renewdays, every renew.interval seconds.
+    """
+    daemon = RenewalDaemon([arg for arg in sysargs if arg != "--once"])
+    try:
+        return daemon.run(once="--once" in sysargs)
+    except (ValueError, DaemonCertsError) as e:
+        print("%s Quitting." % e)
+        return 1
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import json
+
+# Manifest of the previous run, kept in directory.support.
+# Every output (or group of outputs) is recorded under a key together with a fingerprint of its inputs
+# and the state of the written files. If the inputs did not change and the files are still the ones
+# we wrote, the output does not have to be generated again.
+#
+# Files are compared by size and mtime first and only hashed, if those differ from the recorded ones.
+
+class RunManifest(object):
+    FILENAME = "run_manifest.json"
+    VERSION = 1
+
+    def __init__(self, path, enabled = True):
+        super(RunManifest,self).__init__()
+        self.path = path
+        self.enabled = enabled
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as infile:
+                    content = json.load(infile)
+                if content.get("version") == self.VERSION:
+                    self.entries = content["entries"]
+            except ValueError:
+                # A broken manifest only means, that everything is generated again
+                self.entries = {}
+
+    @staticmethod
+    def fingerprint(*inputs):
+        import hashlib
+        serialized = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("UTF-8")).hexdigest()
+
+    @staticmethod
+    def hash_file(path):
+        import hashlib
+        sha = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 16), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @classmethod
+    def file_state(cls, path, recorded = None):
+        # Returns [size, mtime_ns, sha256] or None, if the file does not exist.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if recorded is not None and recorded[0] == stat.st_size and recorded[1] == stat.st_mtime_ns:
+            return recorded
+        return [stat.st_size, stat.st_mtime_ns, cls.hash_file(path)]
+
+    def is_current(self, key, fingerprint):
+        if not self.enabled:
+            return False
+        entry = self.entries.get(key)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        for path, recorded in entry["files"].items():
+            if recorded is None:
+                return False
+            state = self.file_state(path, recorded)
+            if state is None or state[2] != recorded[2]:
+                return False
+        return True
+
+    def get_extra(self, key):
+        return self.entries[key].get("extra")
+
+    def forget(self, key):
+        # The output of key is generated again by the next run
+        self.entries.pop(key, None)
+
+    def record(self, key, fingerprint, files, extra = None):
+        # The state of the files is taken in save, after all outputs have been written.
+        self.entries[key] = {
+            "fingerprint" : fingerprint,
+            "files" : dict((path, None) for path in files),
+            "extra" : extra
+        }
+
+    def save(self, writer):
+        # Several outputs write to the same file (e.g. tsi.properties), therefore all entries are refreshed.
+        for entry in self.entries.values():
+            for path, recorded in entry["files"].items():
+                entry["files"][path] = self.file_state(path, recorded)
+        writer.write(self.path, json.dumps({"version" : self.VERSION, "entries" : self.entries}, indent=1, sort_keys=True))
+        writer.sync()
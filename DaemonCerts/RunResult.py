@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+# Outcome of DaemonCerts.main, e.g. for callers of the library API (see SiteProvisioner).
+
+class RunResult(object):
+    def __init__(self, camode):
+        super(RunResult,self).__init__()
+        self.camode = camode
+        # DN of the CA, if this run generated it
+        self.ca_dn = None
+        # { server : DN } of the certificates (SELFSIGNED, INSTALLCSR) or the requests (CSR)
+        self.dns = {}
+        # { server : path } of the PKCS#12 keystores, in CSR mode they only hold the key
+        self.keystores = {}
+        # { server : path } of the certificate requests, only in CSR mode
+        self.csrs = {}
+        # { name : serial } of the certificates signed in this run, name is a server or CA
+        self.serials = {}
+        # Paths of the files, which were (re)written, and of the outputs, which already had their content
+        self.changed = []
+        self.unchanged = []
+        # Addresses for the clients, see DaemonCerts.get_url_info
+        self.info = None
+
+    def finish(self, writer, issued = None):
+        # Takes the files of writer (OutputWriter) and the signed serials, returns self
+        self.changed = list(writer.written)
+        self.unchanged = list(writer.unchanged)
+        self.serials = dict(issued or {})
+        return self
+
+    def as_dict(self):
+        return {"camode" : self.camode, "ca_dn" : self.ca_dn, "dns" : dict(self.dns), "keystores" : dict(self.keystores), "csrs" : dict(self.csrs),
+                "serials" : dict(self.serials), "changed" : list(self.changed), "unchanged" : list(self.unchanged),
+                "info" : self.info}
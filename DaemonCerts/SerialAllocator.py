@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import fcntl
+from os.path import join
+
+from DaemonCerts.utility.misc_file_functions import mkdir_p
+
+# Serial numbers of the self-signed CA.
+# directory.ca/serial holds the next free serial (hex, as written by openssl ca). It is only read and advanced
+# under an exclusive lock on directory.ca/serial.lock, and advanced before the certificates are signed.
+# Concurrent runs sharing the CA therefore never get the same serial and a crash cannot hand out a serial again.
+# Serials are reserved in blocks of block_size (setting serial.block): larger blocks take the lock less often,
+# the unused rest of a block is skipped.
+#
+# Every issued serial is appended to directory.ca/issued.log, one JSON object per line:
+#   {"serial": 5, "name": "GATEWAY", "dn": "CN=GATEWAY,...", "time": "2020-01-01T12:00:00Z", "pid": 1234}
+
+class SerialAllocator(object):
+    SERIAL_FILE = "serial"
+    LOCK_FILE = "serial.lock"
+    LOG_FILE = "issued.log"
+
+    def __init__(self, ca_path, block_size = 1):
+        super(SerialAllocator,self).__init__()
+        self.ca_path = ca_path
+        self.block_size = max(1, block_size)
+        # Reserved and not yet handed out: serials next .. end-1
+        self.next = None
+        self.end = None
+
+    def _lock(self):
+        mkdir_p(self.ca_path)
+        lockfile = open(join(self.ca_path, self.LOCK_FILE), 'a')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def peek(self):
+        # The next free serial in directory.ca/serial, without reserving it
+        serialpath = join(self.ca_path, self.SERIAL_FILE)
+        if os.path.isfile(serialpath):
+            with open(serialpath, 'rt') as serialfile:
+                for line in serialfile:
+                    return int(line, 16)
+        return 1
+
+    def reserve(self, count):
+        # Reserves count consecutive serials and returns the first one
+        with self._lock():
+            first = self.peek()
+            serialpath = join(self.ca_path, self.SERIAL_FILE)
+            tmpname = "%s.%d.tmp" % (serialpath, os.getpid())
+            with open(tmpname, 'w') as out:
+                out.write("%x\n" % (first + count))
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(tmpname, serialpath)
+        return first
+
+    def allocate(self):
+        if self.next is None or self.next >= self.end:
+            self.next = self.reserve(self.block_size)
+            self.end = self.next + self.block_size
+        serial = self.next
+        self.next += 1
+        return serial
+
+    def record(self, serial, name, dn):
+        self.record_many([(serial, name, dn)])
+
+    def record_many(self, issued):
+        # issued: [(serial, name, dn), ...], appended with one lock and one fsync
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        lines = [json.dumps({"serial" : serial, "name" : name, "dn" : dn, "time" : now, "pid" : os.getpid()}, sort_keys=True) + "\n"
+                 for serial, name, dn in issued]
+        with self._lock():
+            with open(join(self.ca_path, self.LOG_FILE), 'a') as log:
+                log.write("".join(lines))
+                log.flush()
+                os.fsync(log.fileno())
+
+    def issued(self):
+        # All entries of the issued log, oldest first
+        logpath = join(self.ca_path, self.LOG_FILE)
+        if not os.path.isfile(logpath):
+            return []
+        with open(logpath, 'r') as log:
+            return [json.loads(line) for line in log if line.strip()]
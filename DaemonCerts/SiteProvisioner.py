@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings
+from DaemonCerts.Errors import SettingsError
+from DaemonCerts.utility.AbstractSettings import string_types
+
+# Library API: runs of CreateDaemonCerts.py inside a Python process, e.g. a worker provisioning many sites.
+#   provisioner = SiteProvisioner(defaults={"directory.ca" : "/srv/unicore/CA"}, progress=callback)
+#   result = provisioner.provision({"FQDN" : "site1.example.com", "GCID" : "SITE1", "directory.unicore" : ...})
+# Settings are a mapping of the setting names of CreateDaemonCerts.py to values (or strings as on the command line).
+# Nested mappings stand for dotted names: {"Domains" : {"UNITY" : ...}} is {"Domains.UNITY" : ...}.
+# Settings files and DAEMONCERTS_* environment variables only apply, if they are passed (settings_file, fleet_file, environ).
+# Settings files are cached in cache_dir (see AbstractSettings.load_layers, default: no cache).
+# provision returns the RunResult (DNs, keystores, serials, changed files, ...) and raises DaemonCertsError subclasses:
+# SettingsError, CAError, MissingInputError and XMLEditError. Nothing is printed and nothing exits.
+# Messages go to logger (default: logging.getLogger("DaemonCerts")), progress(event, details) is called for
+#   "ca" {"dn"}, "certificate" {"server", "dn", "serial"} (serial None, if the certificate was kept) and "csr" {"server", "dn", "path"}.
+# Sites with the same directory.ca and crypto.backend share the loaded CA, the reserved serials and the certificate
+# database, as in batch runs. Replacing a CA on disk therefore needs a new SiteProvisioner (or close()).
+
+# Values of settings, anything else (lists, objects, ...) is a SettingsError
+SCALAR_TYPES = string_types + (int, float, bool)
+
+def flatten_settings(settings, prefix = ""):
+    # {"Domains" : {"UNITY" : "a"}} -> {"Domains.UNITY" : "a"}
+    flat = {}
+    for key, value in settings.items():
+        dotted = "%s%s" % (prefix, key)
+        if isinstance(value, dict):
+            flat.update(flatten_settings(value, dotted + "."))
+        else:
+            flat[dotted] = value
+    return flat
+
+class SiteProvisioner(object):
+    def __init__(self, defaults = None, logger = None, progress = None, settings_file = None, fleet_file = None, environ = None,
+                 cache_dir = None):
+        super(SiteProvisioner,self).__init__()
+        # Settings of all sites, below the settings passed to provision
+        self.defaults = dict(defaults or {})
+        self.logger = logger
+        self.progress = progress
+        self.settings_file = settings_file
+        self.fleet_file = fleet_file
+        self.environ = environ
+        self.cache_dir = cache_dir
+        # (directory.ca, crypto.backend) -> (serials, database, ca)
+        self.shared = {}
+
+    def make_settings(self, settings):
+        # Finalized DaemonCertsSettings of defaults and settings
+        values = flatten_settings(self.defaults)
+        values.update(flatten_settings(settings))
+        for key, value in values.items():
+            if not isinstance(value, SCALAR_TYPES):
+                raise SettingsError("%s has to be a single value, not %s." % (key, type(value).__name__))
+        args = ["%s=%s" % (key, value) for key, value in values.items()]
+        dcs = DaemonCertsSettings()
+        try:
+            dcs.load_layers(fleet_file=self.fleet_file, site_file=self.settings_file, environ=self.environ, args=args,
+                            cache_dir=self.cache_dir)
+            dcs.finalize()
+        except ValueError as e:
+            # Includes SettingsValidationError, listing every invalid value
+            raise SettingsError(str(e))
+        except KeyError as e:
+            # Unknown setting name
+            raise SettingsError(e.args[0])
+        # Written to installer_arguments.txt
+        dcs.original_args = args
+        return dcs
+
+    def _shared_key(self, dc):
+        return os.path.abspath(dc.dcs.get_value("directory.ca")), dc.dcs.get_value("crypto.backend")
+
+    def provision(self, settings, options = None):
+        """
+        Runs DaemonCerts for one site and returns its RunResult.
+        options are flags of the command line, e.g. ["--timings"].
+        """
+        dc = DaemonCerts(list(options or []), settings=self.make_settings(settings), logger=self.logger, progress=self.progress)
+        key = self._shared_key(dc)
+        if key in self.shared:
+            dc.serials, dc.database, dc.ca = self.shared[key]
+        try:
+            return dc.main()
+        finally:
+            # The rest of the reserved serial block is used by the next site
+            self.shared[key] = (dc.serials, dc.database, dc.ca)
+
+    def close(self):
+        for serials, database, ca in self.shared.values():
+            if database is not None:
+                database.close()
+        self.shared = {}
+
+
+def provision(settings, logger = None, progress = None, options = None):
+    # A single site, see SiteProvisioner
+    provisioner = SiteProvisioner(logger=logger, progress=progress)
+    try:
+        return provisioner.provision(settings, options=options)
+    finally:
+        provisioner.close()
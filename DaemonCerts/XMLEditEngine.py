@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import re
+import threading
+
+from lxml import etree
+
+from DaemonCerts.Errors import XMLEditError
+from DaemonCerts.utility.OutputWriter import OutputWriter
+
+# Applies the edits of a static_xml_changes table:
+# { filename : { "values" : [ ("XPATH","VALUE"), ... ],
+#                "attrib" : [ ("XPATH","ATTRIB","VALUE"), ... ] } }
+#
+# All XPaths are compiled once. XPaths of the form //prefix:tag[@attr='value'] (all of the table)
+# are matched by a single walk over the tree. Other XPaths are evaluated as compiled lxml XPath objects.
+# As with ElementTree.find, the first matching element in document order is changed and the namespace
+# prefixes are the ones of the root element. Unprefixed tags of the simple form are in the default namespace.
+
+SIMPLE_XPATH = re.compile(r"^//(?:(?P<prefix>[\w.-]+):)?(?P<tag>[\w.-]+)\[@(?P<attr>[\w.-]+)='(?P<value>[^']*)'\]$")
+
+class XMLEdit(object):
+    def __init__(self, xpath, attrib, value):
+        # attrib is None for edits of the element text
+        super(XMLEdit,self).__init__()
+        self.xpath = xpath
+        self.attrib = attrib
+        self.value = value
+        self.simple = SIMPLE_XPATH.match(xpath)
+
+    def apply(self, element):
+        if self.attrib is None:
+            element.text = self.value
+        else:
+            element.attrib[self.attrib] = self.value
+
+
+class XMLEditEngine(object):
+    def __init__(self, changes, workers = 4, writer = None):
+        # Files are written through writer (an OutputWriter). The caller syncs it.
+        super(XMLEditEngine,self).__init__()
+        self.workers = workers
+        self.writer = writer if writer is not None else OutputWriter()
+        self.edits = {}
+        for filename, attrib_and_value_dict in changes.items():
+            self.edits[filename] = self.compile_edits(attrib_and_value_dict)
+        # (xpath, namespaces) -> etree.XPath
+        self._xpaths = {}
+        self._xpath_lock = threading.Lock()
+
+    @staticmethod
+    def compile_edits(attrib_and_value_dict):
+        edits = [XMLEdit(xpath, None, value) for xpath, value in attrib_and_value_dict["values"]]
+        edits += [XMLEdit(xpath, attrib, value) for xpath, attrib, value in attrib_and_value_dict["attrib"]]
+        return edits
+
+    def _compiled_xpath(self, xpath, nsmap):
+        namespaces = tuple(sorted((prefix, uri) for prefix, uri in nsmap.items() if prefix is not None))
+        compiled = self._xpaths.get((xpath, namespaces))
+        if compiled is None:
+            compiled = etree.XPath(xpath, namespaces=dict(namespaces))
+            self._xpaths[(xpath, namespaces)] = compiled
+        return compiled
+
+    def match(self, filename, tree, edits):
+        """
+        Returns [(edit, element), ...] in the order of edits.
+        Raises XMLEditError, if any XPath matches nothing.
+        """
+        root = tree.getroot()
+        nsmap = root.nsmap
+        matches = {}
+
+        # { (namespace, tag) : { attr : { value : [edit, ...] } } } for the single tree walk
+        index = {}
+        other_edits = []
+        for edit in edits:
+            if edit.simple is None:
+                other_edits.append(edit)
+                continue
+            prefix = edit.simple.group("prefix")
+            if prefix is not None and not prefix in nsmap:
+                raise XMLEditError("File <%s>: unknown namespace prefix in XPath <%s>" % (filename, edit.xpath))
+            namespace = nsmap.get(prefix)
+            by_attr = index.setdefault((namespace, edit.simple.group("tag")), {})
+            by_attr.setdefault(edit.simple.group("attr"), {}).setdefault(edit.simple.group("value"), []).append(edit)
+
+        if index:
+            # Descendants of the root only, as ElementTree.find("//...")
+            for element in (element for child in root for element in child.iter(tag=etree.Element)):
+                qname = etree.QName(element)
+                by_attr = index.get((qname.namespace, qname.localname))
+                if by_attr is None:
+                    continue
+                for attr, by_value in by_attr.items():
+                    for edit in by_value.get(element.get(attr), []):
+                        if not edit in matches:
+                            matches[edit] = element
+
+        for edit in other_edits:
+            # XPath objects must not be evaluated by several threads at the same time
+            with self._xpath_lock:
+                found = self._compiled_xpath(edit.xpath, nsmap)(tree)
+            if len(found) > 0:
+                matches[edit] = found[0]
+
+        missing = [edit.xpath for edit in edits if not edit in matches]
+        if missing:
+            raise XMLEditError("File <%s>: the following XPaths do not match any element: %s" %
+                               (filename, ", ".join(missing)))
+        return [(edit, matches[edit]) for edit in edits]
+
+    def prepare(self, filename):
+        # Parses filename and matches its edits. Returns (tree, [(edit, element), ...]), nothing is changed yet.
+        tree = etree.parse(filename)
+        return tree, self.match(filename, tree, self.edits[filename])
+
+    def write(self, filename, prepared):
+        # Applies the matched edits of prepare and writes the file. Returns the number of edits.
+        tree, matches = prepared
+        for edit, element in matches:
+            edit.apply(element)
+        self.writer.write(filename, etree.tostring(tree, encoding="UTF-8"))
+        return len(matches)
+
+    def apply(self, filename):
+        # Parses filename, applies all of its edits and writes it again. Returns the number of edits.
+        return self.write(filename, self.prepare(filename))
+
+    def plan(self, filename):
+        # Returns [(xpath, attrib, old value, new value), ...] for the edits, which would change filename. Nothing is written.
+        changes = []
+        for edit, element in self.match(filename, etree.parse(filename), self.edits[filename]):
+            old = element.text if edit.attrib is None else element.get(edit.attrib)
+            if old != edit.value:
+                changes.append((edit.xpath, edit.attrib, old, edit.value))
+        return changes
+
+    def apply_all(self, filenames):
+        # Independent files are processed in parallel. lxml releases the GIL while parsing and serializing.
+        # All files are matched before the first one is written: an XMLEditError leaves every file untouched.
+        filenames = list(filenames)
+        if self.workers <= 1 or len(filenames) <= 1:
+            prepared = [self.prepare(filename) for filename in filenames]
+            return [self.write(filename, entry) for filename, entry in zip(filenames, prepared)]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(filenames))) as pool:
+            prepared = list(pool.map(self.prepare, filenames))
+            return list(pool.map(self.write, filenames, prepared))
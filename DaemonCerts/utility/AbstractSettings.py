@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 import abc
-from six import string_types
-import logging
-import yaml
-import yaml.constructor
-from ast import literal_eval
+import os
+import re
+
+# yaml, logging and the cache and file writing modules are imported on first use: printing the help or
+# validating a command line does not need them (see benchmarks/run_benchmarks.py, startup benchmarks).
+try:
+    string_types = (basestring,)
+except NameError:
+    string_types = (str,)
 
 
 # Abstract Settings base class, handles both a settings format and a commandline parser
 # Override _set_defaults in child class
+# Every default can declare its type (Str, Int, Port, FQDN, ...). Values of a declared type are parsed with one
+# conversion and validated in _finish_parsing, which reports all invalid values at once (SettingsValidationError).
+# load_layers merges the settings sources: defaults < fleet file < site file < environment < command line.
 
 # To use this class, check the code at the end of this file and do the same.
 
@@ -27,22 +34,226 @@ class AttributeDict(OrderedDict):
         # in python2 OrderedDict queries for self.__root, which might be callable.
         # If it is not there, an attributeerror is thrown. We have to catch this.
         # Therefore we check first if the attribute exists in the dict and if not we raise an anonymous attriberror
-        if not attr in self:
-            raise AttributeError()
-
-        returnvalue = self[attr]
-        if isinstance(returnvalue,dict):
-            return AttributeDict(returnvalue)
-        else:
-            return returnvalue
+        # Nested dicts are AttributeDicts already (see set_value and the YAML loader), so they are returned as they are.
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+class SettingsValidationError(ValueError):
+    # All invalid values of a settings object. errors is a list of messages, one per value.
+    def __init__(self, errors):
+        super(SettingsValidationError,self).__init__("Invalid settings:\n\t%s" % "\n\t".join(errors))
+        self.errors = errors
+
+### Setting types. parse converts a command line string, check validates a value (parsed, default or read from file).
+### Both return the value or raise a ValueError with a message for the user.
+class Str(object):
+    description = "a string"
+
+    def _convert(self, string):
+        return string
 
-class OrderedDictYAMLLoader(yaml.Loader):
+    def parse(self, string):
+        try:
+            value = self._convert(string)
+        except ValueError:
+            raise ValueError("is not %s" % self.description)
+        return self.check(value)
+
+    def check(self, value):
+        # Numbers from settings files, e.g. a password 1234, are text as well
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = "%s" % value
+        if not isinstance(value, string_types):
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class Int(Str):
+    description = "an integer"
+
+    def __init__(self, minimum = None, maximum = None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _convert(self, string):
+        return int(string)
+
+    def check(self, value):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("is not %s" % self.description)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError("is smaller than %d" % self.minimum)
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError("is larger than %d" % self.maximum)
+        return value
+
+class Float(Str):
+    description = "a number"
+
+    def _convert(self, string):
+        return float(string)
+
+    def check(self, value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError("is not %s" % self.description)
+        return float(value)
+
+class Bool(Str):
+    description = "True or False"
+    VALUES = {"True" : True, "true" : True, "False" : False, "false" : False}
+
+    def _convert(self, string):
+        return self.VALUES[string] if string in self.VALUES else string
+
+    def check(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class List(Str):
+    description = "a list, e.g. [1,2]"
+
+    def _convert(self, string):
+        from ast import literal_eval
+        try:
+            return literal_eval(string)
+        except SyntaxError:
+            raise ValueError(string)
+
+    def check(self, value):
+        if not isinstance(value, list):
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class Port(Int):
+    description = "a port number"
+
+    def __init__(self):
+        super(Port,self).__init__(1, 65535)
+
+class FQDN(Str):
+    description = "a fully qualified domain name"
+    PATTERN = re.compile(r"^(?=.{1,253}$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*$")
+
+    def check(self, value):
+        value = super(FQDN,self).check(value)
+        if not self.PATTERN.match(value):
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class Path(Str):
+    description = "a path"
+
+    def __init__(self, empty = False):
+        # empty: an empty string is allowed, e.g. to switch a feature off
+        self.empty = empty
+
+    def check(self, value):
+        value = super(Path,self).check(value)
+        if not value and not self.empty or "\0" in value:
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class Enum(Str):
+    def __init__(self, *values):
+        self.values = values
+        self.description = "one of %s" % ", ".join(values)
+
+    def check(self, value):
+        if not value in self.values:
+            raise ValueError("is not %s" % self.description)
+        return value
+
+class Country(Str):
+    description = "a two letter country code, e.g. US or DE"
+
+    def check(self, value):
+        value = super(Country,self).check(value)
+        if len(value) != 2 or not value.isalpha():
+            raise ValueError("is not %s" % self.description)
+        return value
+
+def type_of_default(value):
+    # The type of defaults, which do not declare one
+    if isinstance(value, bool):
+        return Bool()
+    if isinstance(value, int):
+        return Int()
+    if isinstance(value, float):
+        return Float()
+    if isinstance(value, list):
+        return List()
+    return Str()
+
+class SameasGraph(object):
+    """
+    The sameas references between settings, e.g. lifetime.workflow -> lifetime.default.
+    References are resolved in topological order, targets first, so chains resolve in any order of definition.
+    Resolved values are memoized: changing a value only invalidates the values referring to it, directly or through
+    other references.
     """
-    A YAML loader that loads mappings into ordered dictionaries.
+    def __init__(self):
+        self.targets = {}
+        self.dependents = {}
+        self.resolved = set()
+
+    def set(self, valuename, value):
+        # Called for every value set. Returns the names of the references, which have to be resolved again.
+        old_target = self.targets.pop(valuename, None)
+        if old_target is not None:
+            self.dependents[old_target].discard(valuename)
+        if isinstance(value, string_types) and value.startswith("sameas:"):
+            target = value.split(":")[1]
+            self.targets[valuename] = target
+            self.dependents.setdefault(target, set()).add(valuename)
+        outdated = set()
+        stack = [valuename]
+        while stack:
+            for dependent in self.dependents.get(stack.pop(), ()):
+                if not dependent in outdated:
+                    outdated.add(dependent)
+                    stack.append(dependent)
+        self.resolved.discard(valuename)
+        self.resolved -= outdated
+        return outdated
+
+    def order(self):
+        # Returns the unresolved references in topological order and the error messages of all cycles.
+        # References in or behind a cycle are left out.
+        order = []
+        errors = []
+        state = {}
+        for valuename in sorted(self.targets):
+            if not valuename in self.resolved:
+                self._visit(valuename, state, [], order, errors)
+        return order, errors
+
+    def _visit(self, valuename, state, path, order, errors):
+        # state: 1 visiting, 2 done, 3 in or behind a cycle
+        if state.get(valuename) == 1:
+            cycle = path[path.index(valuename):] + [valuename]
+            errors.append("%s is a cycle of sameas references." % " -> ".join(cycle))
+            return False
+        if valuename in state:
+            return state[valuename] == 2
+        state[valuename] = 1
+        target = self.targets[valuename]
+        ok = True
+        if target in self.targets and not target in self.resolved:
+            ok = self._visit(target, state, path + [valuename], order, errors)
+        state[valuename] = 2 if ok else 3
+        if ok:
+            order.append(valuename)
+        return ok
+
+class OrderedDictConstructor(object):
+    """
+    Mixin for YAML loaders, which loads mappings into ordered dictionaries.
     """
 
     def __init__(self, *args, **kwargs):
-        yaml.Loader.__init__(self, *args, **kwargs)
+        super(OrderedDictConstructor,self).__init__(*args, **kwargs)
 
         self.add_constructor(u'tag:yaml.org,2002:map', type(self).construct_yaml_map)
         self.add_constructor(u'tag:yaml.org,2002:omap', type(self).construct_yaml_map)
@@ -54,6 +265,7 @@ class OrderedDictYAMLLoader(yaml.Loader):
         data.update(value)
 
     def construct_mapping(self, node, deep=False):
+        import yaml.constructor
         if isinstance(node, yaml.MappingNode):
             self.flatten_mapping(node)
         else:
@@ -81,21 +293,62 @@ def represent_attributedict(dumper, data):
 
         value.append((node_key, node_value))
 
+    import yaml.nodes
     return yaml.nodes.MappingNode(u'tag:yaml.org,2002:map', value)
 
-yaml.add_representer(AttributeDict, represent_attributedict)
+# "pure": OrderedDictYAMLLoader, "fast": the same on libyaml, if available. Filled by import_yaml.
+YAML_LOADERS = {}
+
+def import_yaml():
+    # Imports yaml. The first call creates the loaders and registers the AttributeDict representer.
+    import yaml
+    if not YAML_LOADERS:
+        class OrderedDictYAMLLoader(OrderedDictConstructor, yaml.Loader):
+            pass
+        YAML_LOADERS["pure"] = OrderedDictYAMLLoader
+        # libyaml parses much faster. Both loaders construct the same AttributeDicts.
+        if hasattr(yaml, "CLoader"):
+            class OrderedDictCYAMLLoader(OrderedDictConstructor, yaml.CLoader):
+                pass
+            YAML_LOADERS["fast"] = OrderedDictCYAMLLoader
+        else:
+            YAML_LOADERS["fast"] = OrderedDictYAMLLoader
+        yaml.add_representer(AttributeDict, represent_attributedict)
+    return yaml
 
 class AbstractSettings(object):
     my_instance = None
+    # Environment variables PREFIX + name with "." -> "__" and "-" -> "_" override settings, e.g. PREFIX_Port__GATEWAY.
+    # None: no environment layer.
+    env_prefix = None
+    # Regular expression of the names of passwords and other secrets. Settings files setting one of them are not cached.
+    secret_settings = None
     def __init__(self,name,logger = None):
         self.original_args = None
-        self.logger = logger or logging.getLogger(__name__)
+        self._logger = logger
         self.name = name
         self.settings_container = AttributeDict()
         self.explanations = AttributeDict()
+        # valuename -> setting type, see _add_default
+        self.types = {}
+        # Values of the command line, which could not be parsed. Reported together with the invalid values in _finish_parsing.
+        self._errors = []
+        # sameas references, resolved by _finish_parsing
+        self._sameas = SameasGraph()
+        # Flat index "a.b.c" -> value, built by _finish_parsing. It also contains every nested dict ("a", "a.b"),
+        # which are the dicts of settings_container themselves. The settings are frozen afterwards, only override
+        # can change single values.
+        self._index = None
         self._set_defaults()
         pass
 
+    @property
+    def logger(self):
+        if self._logger is None:
+            import logging
+            self._logger = logging.getLogger(__name__)
+        return self._logger
+
     def get_original_args(self):
         return self.original_args
 
@@ -114,6 +367,7 @@ class AbstractSettings(object):
             return False
 
         try:
+            from ast import literal_eval
             mylist = literal_eval(string)
             if isinstance(mylist,list):
                 return mylist
@@ -135,47 +389,193 @@ class AbstractSettings(object):
         tempini.dump_to_file(outfile)
 
     @classmethod
-    def get_instance(cls,filename = "settings.yml", commandline_args = None):
-
+    def get_instance(cls,filename = "settings.yml", commandline_args = None, fleet_filename = None):
+        # The settings file is a layer of its own and gets the effective settings written back, if they changed.
         if cls.my_instance == None:
             cls.my_instance = cls()
-            cls.my_instance.read_from_file(filename)
-            if (commandline_args != None):
-                cls.my_instance.parse_args(commandline_args)
+            cls.my_instance.load_layers(fleet_file=fleet_filename,
+                                        site_file=filename if os.path.isfile(filename) else None,
+                                        environ=os.environ,
+                                        args=commandline_args or [])
             cls.my_instance._finish_parsing()
             cls.my_instance.dump_to_file(filename)
 
         return cls.my_instance
 
+    def load_layers(self, fleet_file = None, site_file = None, environ = None, args = None, cache_dir = None):
+        """
+        Applies the settings sources over the defaults, each overriding the previous one:
+        fleet_file (YAML, shared by all sites), site_file (YAML), environ (see env_prefix) and args (name=value).
+        The values of the files are cached in cache_dir (see default_cache_dir, None: no cache).
+        """
+        files = [filename for filename in [fleet_file, site_file] if filename]
+        if files:
+            for valuename, value in self._file_values(files, cache_dir):
+                self._apply_value(valuename, value, "settings file")
+        if environ is not None:
+            for valuename, value in self._environment_values(environ):
+                self._apply_value(valuename, value, "environment")
+        if args:
+            self.parse_eq_args(args, createdicts=False)
+
+    @staticmethod
+    def default_cache_dir():
+        return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "daemoncerts")
+
+    def _apply_value(self, valuename, value, source):
+        if not valuename in self.types:
+            self._errors.append("%s=%s from the %s is not a setting of %s." % (valuename, value, source, self.name))
+            return
+        if isinstance(value, string_types):
+            value = self._parse_value(valuename, value)
+        self.set_value(valuename, value)
+
+    def _environment_values(self, environ):
+        if self.env_prefix is None:
+            return []
+        values = []
+        for valuename in sorted(self.types):
+            env_name = self.env_prefix + valuename.replace(".", "__").replace("-", "_")
+            for candidate in [env_name, env_name.upper()]:
+                if candidate in environ:
+                    values.append((valuename, environ[candidate]))
+                    break
+        return values
+
+    def _file_values(self, files, cache_dir):
+        # [(valuename, value), ...] of all files, later files override earlier ones.
+        # The cache is valid, if every file has the same mtime and size or at least the same content hash as before.
+        import hashlib
+        sources = []
+        for filename in files:
+            stat = os.stat(filename)
+            sources.append({"path" : os.path.abspath(filename), "mtime" : stat.st_mtime, "size" : stat.st_size, "sha256" : None})
+        cache_path = None
+        cached = None
+        if cache_dir is not None:
+            key = hashlib.sha1("\0".join(source["path"] for source in sources).encode("UTF-8")).hexdigest()
+            cache_path = os.path.join(cache_dir, "settings-%s.pickle" % key)
+            cached = self._read_cache(cache_path)
+
+        contents = {}
+        if cached is not None and len(cached["sources"]) == len(sources):
+            unchanged = True
+            for source, cached_source in zip(sources, cached["sources"]):
+                if (source["mtime"], source["size"]) == (cached_source["mtime"], cached_source["size"]):
+                    source["sha256"] = cached_source["sha256"]
+                    continue
+                with open(source["path"], 'rb') as infile:
+                    contents[source["path"]] = infile.read()
+                source["sha256"] = hashlib.sha256(contents[source["path"]]).hexdigest()
+                if source["sha256"] != cached_source["sha256"]:
+                    unchanged = False
+            if unchanged:
+                if contents:
+                    # Touched, but not changed: only the mtimes need an update
+                    self._write_cache(cache_path, sources, cached["values"])
+                return cached["values"]
+
+        merged = AttributeDict()
+        for source in sources:
+            if not source["path"] in contents:
+                with open(source["path"], 'rb') as infile:
+                    contents[source["path"]] = infile.read()
+            source["sha256"] = hashlib.sha256(contents[source["path"]]).hexdigest()
+            loaded = import_yaml().load(contents[source["path"]], YAML_LOADERS["fast"])
+            if loaded is None:
+                continue
+            if not isinstance(loaded, dict):
+                raise ValueError("The settings file %s does not contain a mapping." % source["path"])
+            for valuename, value in self._build_index(loaded, "", {}).items():
+                if not isinstance(value, dict):
+                    merged[valuename] = value
+        values = list(merged.items())
+        if cache_path is not None:
+            if self.secret_settings is not None and any(re.match(self.secret_settings, valuename) for valuename, value in values):
+                # Secrets stay in the settings files only
+                self._remove_cache(cache_path)
+            else:
+                self._write_cache(cache_path, sources, values)
+        return values
+
+    @staticmethod
+    def _read_cache(cache_path):
+        import pickle
+        try:
+            with open(cache_path, 'rb') as infile:
+                # Only files of this user, which nobody else could have changed, are unpickled
+                stat = os.fstat(infile.fileno())
+                if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+                    return None
+                if stat.st_mode & 0o022:
+                    return None
+                return pickle.load(infile)
+        except Exception:
+            # Missing, unreadable or written by an incompatible version: parse the files again
+            return None
+
+    @staticmethod
+    def _write_cache(cache_path, sources, values):
+        import pickle
+        from DaemonCerts.utility.OutputWriter import OutputWriter
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            OutputWriter(fsync=False).write(cache_path, pickle.dumps({"sources" : sources, "values" : values}, 2), mode=0o600)
+        except (IOError, OSError):
+            # The cache is an optimization only
+            pass
+
+    @staticmethod
+    def _remove_cache(cache_path):
+        try:
+            os.remove(cache_path)
+        except (IOError, OSError):
+            pass
+
     def read_from_file(self,filename):
         with open(filename,'r') as infile:
-            self.settings_container = yaml.load(infile,OrderedDictYAMLLoader)
+            self.settings_container = import_yaml().load(infile,YAML_LOADERS["fast"])
+        self._sameas = SameasGraph()
+        for valuename,value in self._build_index(self.settings_container,"",{}).items():
+            if not isinstance(value,dict):
+                self._sameas.set(valuename,value)
 
     def dump_to_file(self,filename):
-        with open(filename,'w') as outfile:
-            outfile.write(yaml.dump(self.settings_container,default_flow_style=False))
+        # The file is only rewritten, if the effective settings changed. Returns True, if it was written.
+        from DaemonCerts.utility.OutputWriter import OutputWriter
+        writer = OutputWriter(fsync=False)
+        return writer.write(filename, import_yaml().dump(self.settings_container,default_flow_style=False))
 
     def as_dict(self):
         return self.settings_container
 
     def __getattr__(self, item):
-        returndict = self.get_value(item)
-        if isinstance(returndict,dict):
-            return AttributeDict(returndict)
-        else:
-            return returndict
+        # Only called for names, which are no attributes of the object. Nested dicts are returned without copy.
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return self.get_value(item)
 
     @abc.abstractmethod
     def _set_defaults(self):
         raise NotImplementedError("Abstract Virtual Method, please implement in child class")
         return
 
-    def _add_default(self,valuename,value,explanation):
-        eq_arg = "%s=%s" %(valuename,value)
+    def _add_default(self,valuename,value,explanation,valuetype = None):
+        # Without valuetype, the type follows from the default. A sameas default has the type of the value it refers to.
         self.explanations[valuename] = explanation
-        self.parse_eq_args([eq_arg],True)
+        if valuetype is None:
+            if isinstance(value,string_types) and value.startswith("sameas:"):
+                valuetype = self.types.get(value.split(":")[1], Str())
+            else:
+                valuetype = type_of_default(value)
+        self.types[valuename] = valuetype
+        self.set_value(valuename,value)
 
     def get_value(self,valuename):
+        if self._index is not None:
+            return self._index[valuename]
         splitname = valuename.split(".")
         current_dict = self.settings_container
         for key in splitname[:-1]:
@@ -184,6 +584,14 @@ class AbstractSettings(object):
 
     #Set Value actually creates the entry:
     def set_value(self,valuename,value):
+        self._check_not_frozen(valuename)
+        self._put(valuename,value)
+        self._sameas.set(valuename,value)
+
+    def _put(self,valuename,value):
+        # Stores a value without looking at references
+        if isinstance(value,dict) and not isinstance(value,AttributeDict):
+            value = AttributeDict(value)
         splitname = valuename.split(".")
         current_dict = self.settings_container
         for key in splitname[:-1]:
@@ -191,6 +599,31 @@ class AbstractSettings(object):
                 current_dict[key] = AttributeDict()
             current_dict = current_dict[key]
         current_dict[splitname[-1]] = value
+        if self._index is not None:
+            self._index[valuename] = value
+
+    def override(self,valuename,value):
+        """
+        Changes a single value after parsing. value is a string as on the command line or a value of the type of the setting.
+        Only the values referring to it (sameas) are resolved again.
+        Returns the names of all changed values. Raises a SettingsValidationError for invalid values.
+        """
+        if self._index is None:
+            raise RuntimeError("override is only possible after parsing, use set_value.")
+        if not valuename in self.types:
+            raise KeyError("The settings module did not contain %s. Please check your input." % valuename)
+        if not (isinstance(value,string_types) and value.startswith("sameas:")):
+            valuetype = self.types[valuename]
+            try:
+                value = valuetype.parse(value) if isinstance(value,string_types) else valuetype.check(value)
+            except ValueError as e:
+                raise SettingsValidationError(["%s=%s %s." % (valuename,value,e)])
+        self._put(valuename,value)
+        outdated = self._sameas.set(valuename,value)
+        order, errors = self._resolve_references()
+        if errors:
+            raise SettingsValidationError(errors)
+        return [valuename] + sorted(outdated)
 
     def print_options(self,outstream):
         outstream.write("%s paramaters: \n" %(self.name))
@@ -213,6 +646,7 @@ class AbstractSettings(object):
     #if args contains abc.def=640.0, self["abc"]["def"]=640.0 will be set
     #with createdicts == False, the dicts have to exist already
     def parse_eq_args(self,args, createdicts = False):
+        self._check_not_frozen(" ".join(args))
         self.original_args = args
         for argtuple in args:
             self.logger.debug("Parsing:",argtuple)
@@ -228,7 +662,9 @@ class AbstractSettings(object):
                     current_dict = current_dict[field]
                 final_key = splitset[0][-1]
                 if final_key in current_dict or createdicts:
-                    current_dict[final_key] = self._cast_string_to_correct_type(splitset[1])
+                    valuename = ".".join(splitset[0])
+                    current_dict[final_key] = self._parse_value(valuename,splitset[1])
+                    self._sameas.set(valuename,current_dict[final_key])
                 else:
                     raise KeyError("The settings module did not contain %s. Please check your input."
                     % argtuple )
@@ -237,18 +673,74 @@ class AbstractSettings(object):
                 pass
 
 
-    def _recursive_helper_finish(self,mydict):
+    def _parse_value(self,valuename,string):
+        # One direct conversion for declared types. Only undeclared values are guessed.
+        if string.startswith("sameas:"):
+            return string
+        valuetype = self.types.get(valuename)
+        if valuetype is None:
+            return self._cast_string_to_correct_type(string)
+        try:
+            return valuetype.parse(string)
+        except ValueError as e:
+            self._errors.append("%s=%s %s." % (valuename,string,e))
+            return string
+
+    def _validate(self,skip):
+        # Returns the messages of all values, which do not match their type. Checked values are stored normalized.
+        # Values in skip are not checked, e.g. references (sameas), which copy checked values, and values, which could not be parsed.
+        errors = []
+        for valuename in sorted(self.types):
+            if valuename in skip:
+                continue
+            value = self.get_value(valuename)
+            try:
+                self._put(valuename,self.types[valuename].check(value))
+            except ValueError as e:
+                errors.append("%s=%s %s." % (valuename,value,e))
+        return errors
+
+    def _resolve_references(self):
+        # Copies the targets of all unresolved sameas references, see SameasGraph. Returns the resolved names and the errors.
+        order, errors = self._sameas.order()
+        resolved = []
+        for valuename in order:
+            target = self._sameas.targets[valuename]
+            if target in self._sameas.targets and not target in self._sameas.resolved:
+                # The target could not be resolved, its error is reported already
+                continue
+            try:
+                value = self.get_value(target)
+            except KeyError:
+                errors.append("%s=sameas:%s refers to an unknown setting." % (valuename,target))
+                continue
+            self._put(valuename,value)
+            self._sameas.resolved.add(valuename)
+            resolved.append(valuename)
+        return resolved, errors
+
+    def _check_not_frozen(self,what):
+        if self._index is not None:
+            raise RuntimeError("The settings of %s are frozen after parsing, %s cannot be set anymore." % (self.name, what))
+
+    def _build_index(self,mydict,prefix,index):
         for key,value in mydict.items():
+            valuename = "%s%s" % (prefix, key)
+            index[valuename] = value
             if isinstance(value, dict):
-                self._recursive_helper_finish(value)
-            else:
-                if isinstance(value,string_types):
-                    if value.startswith("sameas:"):
-                        splitsameas = value.split(":")
-                        mydict[key] = self.get_value(splitsameas[1])
+                self._build_index(value, valuename + ".", index)
+        return index
 
     def _finish_parsing(self):
-        self._recursive_helper_finish(self.settings_container)
+        if self._index is not None:
+            return
+        unparsed = set(error.split("=")[0] for error in self._errors)
+        errors = self._errors + self._validate(set(self._sameas.targets) | unparsed)
+        resolved, reference_errors = self._resolve_references()
+        errors += reference_errors
+        if errors:
+            raise SettingsValidationError(errors)
+        self._index = self._build_index(self.settings_container, "", {})
 
 
 if __name__ == '__main__':
@@ -267,15 +759,15 @@ if __name__ == '__main__':
                 ('simparams.acceptance', 1.0, 'Acceptance factor of simulation'),
                 ('settings.filename','TestSettings.yml','Filename of the file the chosen settings are written to')
                 ]
-            for valuename,default,explanation in defaults:
-                self._add_default(valuename,default,explanation)
+            for default in defaults:
+                self._add_default(*default)
     
     myset = TestSettings()
     myset.parse_eq_args(sys.argv[1:])
     myset._finish_parsing()
     
     if len(sys.argv) <= 1:
-        print("Use this class with: %s Box.Lx=11" % os.path.basename(__file__))
+        print("Use this class with: python -m DaemonCerts.utility.AbstractSettings Box.Lx=11")
         print("Afterwards check the file TestSettings.yml\n")
         myset.print_options(sys.stdout)
         
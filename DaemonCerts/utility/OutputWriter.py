@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+
+from DaemonCerts.utility.misc_file_functions import mkdir_p
+
+# All generated files are written through an OutputWriter:
+# - Content is compared with the existing file first. Unchanged files are not touched, only their mode is fixed.
+# - Changed files are written to a temporary file in the same directory, get their mode and are renamed
+#   over the old file. Readers therefore never see half written files.
+# - The directories of renamed files are fsynced once per directory in sync().
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class OutputWriter(object):
+    def __init__(self, fsync = True):
+        super(OutputWriter,self).__init__()
+        self.fsync = fsync
+        # Paths, which were (re)written or found unchanged
+        self.written = []
+        self.unchanged = []
+        self._dirty_dirs = set()
+
+    @staticmethod
+    def _same_content(path, data):
+        try:
+            if os.path.getsize(path) != len(data):
+                return False
+            with open(path, 'rb') as infile:
+                return infile.read() == data
+        except OSError:
+            return False
+
+    def write(self, path, content, mode = None):
+        """
+        Writes content (str or bytes) to path. mode defaults to the mode of the existing file or 0666 & ~umask.
+        Returns True, if the file was changed.
+        """
+        data = content if isinstance(content, bytes) else content.encode("UTF-8")
+        dirname = os.path.dirname(path) or "."
+        mkdir_p(dirname)
+
+        if self._same_content(path, data):
+            if mode is not None and (os.stat(path).st_mode & 0o7777) != mode:
+                os.chmod(path, mode)
+            self.unchanged.append(path)
+            return False
+
+        if mode is None:
+            try:
+                mode = os.stat(path).st_mode & 0o7777
+            except OSError:
+                mode = 0o666 & ~get_umask()
+
+        import tempfile
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".%s." % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+                if self.fsync:
+                    out.flush()
+                    os.fsync(out.fileno())
+            # The mode is set before the file becomes visible, private keys are never readable by others
+            os.chmod(tmpname, mode)
+            os.rename(tmpname, path)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self.written.append(path)
+        self._dirty_dirs.add(dirname)
+        return True
+
+    def sync(self):
+        # Makes the renames durable, one fsync per directory
+        if self.fsync:
+            for dirname in self._dirty_dirs:
+                fd = os.open(dirname, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self._dirty_dirs.clear()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import functools
+from timeit import default_timer
+
+# Named timing spans of a run. Spans nest: a span opened inside another one is recorded as its child.
+#   with timings.span("gen_ca"):
+#       ...
+# Methods of objects with a timings attribute can be instrumented with the timed decorator.
+# NullTimings is used, if no report was requested. Its span is a shared no-op context manager.
+
+class _Span(object):
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings._open(self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.timings._close()
+        return False
+
+
+class Timings(object):
+    def __init__(self):
+        super(Timings,self).__init__()
+        self.start = default_timer()
+        self.spans = []
+        self._stack = []
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def _open(self, name):
+        entry = {"name" : name,
+                 "parent" : self._stack[-1]["name"] if self._stack else None,
+                 "depth" : len(self._stack),
+                 "start" : default_timer() - self.start,
+                 "duration" : None}
+        self.spans.append(entry)
+        self._stack.append(entry)
+
+    def _close(self):
+        entry = self._stack.pop()
+        entry["duration"] = default_timer() - self.start - entry["start"]
+
+    def report(self):
+        # Spans in the order they were opened and the total time per name.
+        # The name of spans with an argument (e.g. gen_or_update_server_cert[UNITY]) is summed up without it.
+        summary = {}
+        for entry in self.spans:
+            if entry["duration"] is None:
+                continue
+            name = entry["name"].split("[")[0]
+            total = summary.setdefault(name, {"count" : 0, "total" : 0.0})
+            total["count"] += 1
+            total["total"] += entry["duration"]
+        return {"total" : default_timer() - self.start, "spans" : self.spans, "summary" : summary}
+
+    def write(self, path, writer):
+        writer.write(path, json.dumps(self.report(), indent=1, sort_keys=True))
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class NullTimings(object):
+    def span(self, name):
+        return _NULL_SPAN
+
+
+def timed(name, with_argument = False):
+    """
+    Decorator recording every call of a method as span name in self.timings.
+    with_argument appends the first argument to the name, e.g. gen_or_update_server_cert[UNITY].
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            spanname = "%s[%s]" % (name, args[0]) if with_argument and args else name
+            with self.timings.span(spanname):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
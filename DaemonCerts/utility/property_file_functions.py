@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from collections import OrderedDict
+
+from DaemonCerts.utility.OutputWriter import OutputWriter
+
+# Editing of plain key=value property files, such as uas.config or tsi.properties.
+# Special values:
+COMMENT = "<Comment>"      # comments out the key
+UNCOMMENT = "<UnComment>"  # removes the leading # of a commented key
+
+def property_key(line):
+    # "#key = value" -> "#key"
+    return line.split("=")[0].replace(" ","")
+
+def _apply_change(key, line, value):
+    # One change of key to its line (with line ending, None if the key is not in the file). Returns the new line.
+    if value == UNCOMMENT:
+        return line[1:] if line is not None and line.startswith("#") else line
+    if value == COMMENT:
+        return line if line is None or line.startswith("#") else "#%s" % line
+    return "%s=%s\n" % (key, value)
+
+def _patch_lines(filename, changes):
+    # Returns the patched lines of filename and [(key, old line, new line), ...] for every edited key.
+    # Lines are given without line ending, None if the key is not (or no longer) in the file.
+    # The changes of a key are applied in their order, as if the file was patched once per change.
+    changes = list(changes)
+    exists = os.path.isfile(filename)
+    source = []
+    if exists:
+        with open(filename, 'rt') as myin:
+            source = myin.readlines()
+    elif changes:
+        # As the single key patcher always did: a missing file starts with the first change written as given,
+        # also <Comment> and <UnComment>. The other changes are applied to that line.
+        source = ["%s=%s\n" % changes[0]]
+
+    # key -> [(position in changes, value), ...]
+    edits = OrderedDict()
+    for position, (key, value) in enumerate(changes):
+        if exists or position > 0:
+            edits.setdefault(key, []).append((position, value))
+    lookup = {}
+    for key in edits:
+        lookup[key] = key
+        lookup["#%s" % key] = key
+
+    found = {}
+    lines = []
+    for line in source:
+        if "=" in line:
+            key = lookup.get(property_key(line))
+            if key is not None:
+                if key in found:
+                    #If we have keys twice, we skip.
+                    continue
+                newline = line
+                for _, value in edits[key]:
+                    newline = _apply_change(key, newline, value)
+                found[key] = (line.rstrip("\n"), newline.rstrip("\n"))
+                lines.append(newline)
+                continue
+        lines.append(line)
+    # Keys, which are not in the file, are appended by their first change setting a value
+    appended = []
+    for key, values in edits.items():
+        if key in found:
+            continue
+        newline = None
+        for position, value in values:
+            if newline is None and not value in (COMMENT, UNCOMMENT):
+                start = position
+            newline = _apply_change(key, newline, value)
+        if newline is not None:
+            appended.append((start, newline))
+        found[key] = (None, None if newline is None else newline.rstrip("\n"))
+    lines += [newline for _, newline in sorted(appended)]
+
+    edited = [(key, found[key][0], found[key][1]) for key in edits]
+    if not exists:
+        # Nothing was in the file before, the first change made the first line
+        first = changes[0][0] if changes else None
+        if changes and not first in edits:
+            edited.insert(0, (first, None, source[0].rstrip("\n")))
+        edited = [(key, None, new) for key, old, new in edited]
+    return lines, edited
+
+def patch_property_file(filename, changes, writer = None):
+    """
+    Applies all (key, value) changes to filename with one read and at most one atomic write.
+    - The first occurrence of a key, commented (#key=) or not, is changed. Further occurrences are dropped.
+    - Keys, which do not occur in the file, are appended. <Comment> and <UnComment> of missing keys are ignored.
+    - If a key is changed more than once, the changes apply in their order, e.g. a value and then <Comment>.
+    A missing file is created with the first change as its first line, literally, even <Comment> or <UnComment>,
+    as the patcher of a single key did. The file is written through writer (an OutputWriter) and is not touched,
+    if nothing changed.
+    """
+    lines, _ = _patch_lines(filename, changes)
+    if writer is None:
+        writer = OutputWriter()
+        writer.write(filename, "".join(lines))
+        writer.sync()
+    else:
+        writer.write(filename, "".join(lines))
+
+def plan_property_file(filename, changes):
+    # Returns [(key, old line, new line), ...] for the keys patch_property_file would change. Nothing is written.
+    _, edited = _patch_lines(filename, changes)
+    return [(key, old, new) for key, old, new in edited if old != new]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks, that the crypto backends (setting crypto.backend) write the same certificates for the same inputs.
+
+    python benchmarks/compare_backends.py
+
+For every key type the CA, a daemon certificate and a certificate request are created from the same keys
+and serial numbers with every backend and compared field by field: subject (DER and RFC 4514), issuer,
+extensions, validity, serial and version. Keystores written by one backend have to load with the other one.
+Finally a complete run with each backend has to produce the same DNs (supportfiles/rfc4514_dns.txt).
+Exit code 1 on any difference.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import sys
+import shutil
+import tempfile
+import datetime
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from cryptography import x509
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.CryptoBackend import BACKENDS, CertSpec, get_crypto_backend
+from DaemonCerts.KeyGenerator import generate_key, key_to_pem
+
+from fixtures import daemon_args
+from run_benchmarks import Quiet
+
+KEYS = [("RSA", 2048), ("ECDSA", 256), ("ECDSA", 384), ("Ed25519", 0)]
+# Certificates of the backends are created some milliseconds apart
+VALIDITY_TOLERANCE = datetime.timedelta(seconds=5)
+
+def describe(pem, request = False):
+    # The fields of a certificate or request, which have to match between the backends
+    if request:
+        obj = x509.load_pem_x509_csr(pem)
+    else:
+        obj = x509.load_pem_x509_certificate(pem)
+    fields = {"subject" : obj.subject.public_bytes(),
+              "subject_rfc4514" : obj.subject.rfc4514_string(),
+              "extensions" : [(ext.oid.dotted_string, ext.critical, ext.value) for ext in obj.extensions]}
+    if not request:
+        fields["issuer"] = obj.issuer.public_bytes()
+        fields["serial"] = obj.serial_number
+        fields["version"] = obj.version
+        fields["lifetime"] = obj.not_valid_after - obj.not_valid_before
+        fields["not_before"] = obj.not_valid_before
+    return fields
+
+def compare_fields(label, reference, other):
+    differences = []
+    for name in sorted(reference):
+        if name == "not_before":
+            if abs(reference[name] - other[name]) > VALIDITY_TOLERANCE:
+                differences.append("%s: %s: %s != %s" % (label, name, reference[name], other[name]))
+        elif reference[name] != other[name]:
+            differences.append("%s: %s: %s != %s" % (label, name, reference[name], other[name]))
+    return differences
+
+def server_spec(dc, server):
+    spec = CertSpec()
+    dc.set_cert_attributes(server, spec)
+    return spec
+
+def compare_certificates(dc):
+    differences = []
+    backends = [get_crypto_backend(name) for name in BACKENDS]
+    for keytype, keysize in KEYS:
+        label = keytype if keytype == "Ed25519" else "%s-%d" % (keytype, keysize)
+        signing = [backend for backend in backends if backend.signs_ed25519 or keytype != "Ed25519"]
+        ca_keytype, ca_keysize = ("ECDSA", 256) if keytype == "Ed25519" else (keytype, keysize)
+        ca_key = generate_key(ca_keytype, ca_keysize)
+        key = generate_key(keytype, keysize)
+        ca_spec = CertSpec()
+        ca_spec.subject = [("C", "DE"), ("O", "Compare"), ("CN", "ca.example.com")]
+        ca_spec.add_extensions(dc.get_san_extension_ca("DNS:ca.example.com, email:admin@example.com"))
+        spec = server_spec(dc, "GATEWAY")
+
+        results = {}
+        for backend in backends:
+            ca_cert = backend.create_certificate(ca_spec, ca_key, 1, 10)
+            cert = backend.create_certificate(spec, key, 2, 10, issuer_cert=ca_cert, issuer_key=ca_key)
+            result = {"ca" : describe(backend.dump_certificate(ca_cert)),
+                      "cert" : describe(backend.dump_certificate(cert)),
+                      "p12" : backend.export_pkcs12(key, cert, "compare"),
+                      "p12_keyonly" : backend.export_pkcs12(key, None, "compare"),
+                      "dn" : dc.name_to_rfc4514(backend.subject_components(cert))}
+            if backend in signing:
+                result["csr"] = describe(backend.dump_csr(backend.create_csr(spec, key)), request=True)
+            results[backend.name] = result
+
+        reference_name = BACKENDS[0]
+        reference = results[reference_name]
+        for backend in backends:
+            result = results[backend.name]
+            pair = "%s %s/%s" % (label, reference_name, backend.name)
+            differences += compare_fields("%s CA" % pair, reference["ca"], result["ca"])
+            differences += compare_fields("%s certificate" % pair, reference["cert"], result["cert"])
+            if "csr" in result:
+                differences += compare_fields("%s request" % pair, reference["csr"], result["csr"])
+            if reference["dn"] != result["dn"]:
+                differences.append("%s DN: %s != %s" % (pair, reference["dn"], result["dn"]))
+            # Keystores have to be readable by every backend
+            for reader in backends:
+                loaded_key, loaded_cert = reader.load_pkcs12(result["p12"], "compare")
+                if not reader.public_key_matches(loaded_cert, key) or describe(reader.dump_certificate(loaded_cert)) != result["cert"]:
+                    differences.append("%s: keystore of %s does not load with %s" % (label, backend.name, reader.name))
+                loaded_key, loaded_cert = reader.load_pkcs12(result["p12_keyonly"], "compare")
+                if loaded_cert is not None or key_to_pem(loaded_key) != key_to_pem(key):
+                    differences.append("%s: key only keystore of %s does not load with %s" % (label, backend.name, reader.name))
+        print("%-10s %s" % (label, "differs" if differences else "same"))
+    return differences
+
+def compare_runs(workdir):
+    dns = {}
+    for name in BACKENDS:
+        directory = join(workdir, name)
+        with Quiet():
+            dc = DaemonCerts(daemon_args(directory, "crypto.backend=%s" % name))
+            dc.main()
+        with open(join(directory, "supportfiles", "rfc4514_dns.txt"), 'r') as infile:
+            dns[name] = infile.read()
+    differences = ["rfc4514_dns.txt of %s differs" % name for name in BACKENDS if dns[name] != dns[BACKENDS[0]]]
+    print("%-10s %s" % ("full run", "differs" if differences else "same"))
+    return differences
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="daemoncerts_compare_")
+    try:
+        with Quiet():
+            dc = DaemonCerts(daemon_args(workdir))
+        differences = compare_certificates(dc)
+        differences += compare_runs(workdir)
+    finally:
+        shutil.rmtree(workdir)
+    for difference in differences:
+        print(difference)
+    return 1 if differences else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks, that patch_property_file writes the same property files as the original patcher of single keys.
+
+    python benchmarks/compare_property_files.py
+
+The original patcher (DaemonCerts.create_add_change_plain before all changes of a file were applied in one pass)
+is kept below as reference. Every change list of DaemonCerts (get_plainfile_changes) is applied to several
+templates of its file by both: the benchmark template (all keys commented), a template with the keys set,
+duplicated and spaced, one without any of the keys and a missing file. Edge cases of <Comment> and <UnComment>
+are checked on their own. Exit code 1 on any difference.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import shutil
+import tempfile
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.utility.property_file_functions import patch_property_file
+
+from fixtures import daemon_args, write_property_template
+from run_benchmarks import Quiet
+
+def reference_patch(filename, key, value):
+    # The original create_add_change_plain, without its message
+    if os.path.isfile(filename):
+        found = False
+        outname = filename + '_new'
+        with open(filename, 'rt') as myin:
+            with open(outname,'wt') as myout:
+                for line in myin:
+                    if "=" in line:
+                        splitline = line.split("=")
+                        keypruned = splitline[0].replace(" ","")
+                        if keypruned == key or keypruned == "#%s"%key:
+                            if found:
+                                #If we have keys twice, we skip.
+                                continue
+                            found = True
+                            if value == "<UnComment>":
+                                if line.startswith("#"):
+                                    myout.write(line[1:])
+                                else:
+                                    myout.write(line)
+                            elif value == "<Comment>":
+                                if line.startswith("#"):
+                                    myout.write(line)
+                                else:
+                                    myout.write("#%s"%line)
+                            else:
+                                myout.write("%s=%s\n" % (key, value))
+                        else:
+                            myout.write(line)
+                    else:
+                        myout.write(line)
+                if not found:
+                    if not "Comment" in value:
+                        myout.write("%s=%s\n" % (key, value))
+        shutil.move(outname,filename)
+    else:
+        with open(filename,'a') as out:
+            out.write("%s=%s\n"%(key,value))
+
+def write_set_template(filename, changelist):
+    # Keys set, some twice, some with spaces around "=", and lines without "="
+    with open(filename, 'w') as out:
+        out.write("# Set template\nno separator here\n\n")
+        for number, (key, _) in enumerate(changelist):
+            if number % 3 == 0:
+                out.write("%s = old.%d\n" % (key, number))
+            else:
+                out.write("%s=old.%d\n" % (key, number))
+            if number % 2 == 0:
+                out.write("#%s=duplicate.%d\n" % (key, number))
+
+def write_unrelated_template(filename, changelist):
+    with open(filename, 'w') as out:
+        out.write("# Template without the keys\nother.key=1\n")
+
+TEMPLATES = [("commented", lambda filename, changelist: write_property_template(filename, changelist, 20)),
+             ("set", write_set_template),
+             ("unrelated", write_unrelated_template),
+             ("missing", None)]
+
+# (label, template lines, changes), <Comment> and <UnComment> of present, absent and repeated keys
+EDGE_CASES = [
+    ("comment set key", "a=1\nb=2\n", [("a", "<Comment>")]),
+    ("comment commented key", "#a=1\n", [("a", "<Comment>")]),
+    ("uncomment commented key", "#a=1\n#a=2\n", [("a", "<UnComment>")]),
+    ("uncomment absent key", "b=2\n", [("a", "<UnComment>")]),
+    ("set then comment", "b=2\n", [("a", "1"), ("a", "<Comment>")]),
+    ("comment then set", "a=1\n", [("a", "<Comment>"), ("a", "2")]),
+    ("comment missing file", None, [("a", "<Comment>"), ("b", "1")]),
+    ("uncomment missing file", None, [("a", "<UnComment>"), ("a", "1")]),
+    ("set then comment missing file", None, [("a", "1"), ("a", "<Comment>"), ("b", "<UnComment>")]),
+]
+
+def compare(directory, label, write_template, changes):
+    # Returns the differences of reference and patch_property_file for one template
+    outputs = {}
+    for name in ["reference", "patch"]:
+        filename = join(directory, "%s.properties" % name)
+        if os.path.isfile(filename):
+            os.remove(filename)
+        if write_template is not None:
+            write_template(filename)
+        if name == "reference":
+            for key, value in changes:
+                reference_patch(filename, key, value)
+        else:
+            with Quiet():
+                patch_property_file(filename, changes)
+        with open(filename, 'r') as infile:
+            outputs[name] = infile.read()
+    differs = outputs["reference"] != outputs["patch"]
+    print("%-60s %s" % (label, "differs" if differs else "same"))
+    return ["%s: reference\n%s\npatch_property_file\n%s" % (label, outputs["reference"], outputs["patch"])] if differs else []
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="daemoncerts_compare_")
+    differences = []
+    try:
+        with Quiet():
+            dc = DaemonCerts(daemon_args(workdir))
+        for filename, changelist in sorted(dc.get_plainfile_changes().items()):
+            for name, template in TEMPLATES:
+                write_template = None if template is None else (lambda path, template=template, changelist=changelist: template(path, changelist))
+                label = "%s [%s]" % (os.path.relpath(filename, join(workdir, "unicore")), name)
+                differences += compare(workdir, label, write_template, changelist)
+        for label, content, changes in EDGE_CASES:
+            write_template = None
+            if content is not None:
+                def write_template(path, content=content):
+                    with open(path, 'w') as out:
+                        out.write(content)
+            differences += compare(workdir, label, write_template, changes)
+    finally:
+        shutil.rmtree(workdir)
+    for difference in differences:
+        print(difference)
+    return 1 if differences else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
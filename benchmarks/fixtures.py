@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+from os.path import join
+
+from lxml import etree
+
+from DaemonCerts.XMLEditEngine import SIMPLE_XPATH
+from DaemonCerts.utility.misc_file_functions import mkdir_p
+
+# Fixture UNICORE trees for the benchmarks.
+# The templates are built from the edit tables of DaemonCerts itself: every XPath of static_xml_changes
+# gets a matching element, every key of static_plainfile_changes a line. size filler elements and lines
+# are added to every file, so the patchers have to work through realistic (and unrealistic) amounts of text.
+
+NAMESPACES = {"eng" : "http://www.fz-juelich.de/unicore/xnjs/engine"}
+
+def daemon_args(directory, *args):
+    # Command line arguments of a DaemonCerts run writing everything below directory
+    return ["FQDN=bench.example.com",
+            "directory.unicore=%s" % join(directory, "unicore"),
+            "directory.certs=%s" % join(directory, "unicore", "certs"),
+            "directory.ca=%s" % join(directory, "CA"),
+            "directory.csrs=%s" % join(directory, "csrs"),
+            "directory.support=%s" % join(directory, "supportfiles"),
+            "directory.userfiles=%s" % join(directory, "userfiles")] + list(args)
+
+def _qname(prefix, tag):
+    if prefix is None:
+        return tag
+    return "{%s}%s" % (NAMESPACES[prefix], tag)
+
+def write_xml_template(filename, attrib_and_value_dict, size):
+    xpaths = [xpath for xpath, _ in attrib_and_value_dict["values"]]
+    xpaths += [xpath for xpath, _, _ in attrib_and_value_dict["attrib"]]
+    matches = [SIMPLE_XPATH.match(xpath) for xpath in xpaths]
+    prefixes = set(match.group("prefix") for match in matches if match is not None)
+    prefixes.discard(None)
+    nsmap = dict((prefix, NAMESPACES[prefix]) for prefix in prefixes)
+    root_prefix = sorted(prefixes)[0] if prefixes else None
+    root = etree.Element(_qname(root_prefix, "Configuration"), nsmap=nsmap)
+    container = etree.SubElement(root, _qname(root_prefix, "Properties"))
+    for number in range(size):
+        etree.SubElement(container, _qname(root_prefix, "Property"), name="filler.%d" % number, value="x" * 20)
+    seen = set()
+    for match in matches:
+        if match is None or match.group(0) in seen:
+            continue
+        seen.add(match.group(0))
+        element = etree.SubElement(container, _qname(match.group("prefix"), match.group("tag")))
+        element.set(match.group("attr"), match.group("value"))
+        element.set("value", "template")
+    with open(filename, 'wb') as out:
+        out.write(etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True))
+
+def write_property_template(filename, changelist, size):
+    with open(filename, 'w') as out:
+        out.write("# Benchmark template\n")
+        for number in range(size):
+            out.write("filler.key.%d=%s\n" % (number, "x" * 20))
+        for key, _ in changelist:
+            out.write("#%s=template\n" % key)
+
+def build_tree(dc, size):
+    # Writes the templates of all files DaemonCerts patches. dc has to point to the fixture directories.
+    for filename, attrib_and_value_dict in dc.static_xml_changes.items():
+        mkdir_p(os.path.dirname(filename))
+        write_xml_template(filename, attrib_and_value_dict, size)
+    for filename, changelist in dc.static_plainfile_changes.items():
+        mkdir_p(os.path.dirname(filename))
+        write_property_template(filename, changelist, size)
+
+def copy_tree(source, destination):
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination)
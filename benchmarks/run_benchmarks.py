@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of DaemonCerts against fixture UNICORE trees of increasing size.
+
+    python benchmarks/run_benchmarks.py [--quick] [--filter=TEXT] [--repeat=N] [--output=FILE]
+                                        [--baseline=FILE] [--save-baseline] [--threshold=0.25]
+
+The results are written as JSON (default: benchmarks/results.json). If the baseline (default: benchmarks/baseline.json)
+exists, every benchmark is compared to it by its median and the exit code is 1, if any benchmark got slower
+by more than threshold. --save-baseline stores the results as new baseline instead.
+Key generation is random by nature, compare those numbers with a larger --repeat.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import timeit
+import datetime
+import subprocess
+from collections import OrderedDict
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from DaemonCerts.DaemonCerts import DaemonCerts
+from DaemonCerts.DaemonCertsSettings import DaemonCertsSettings
+from DaemonCerts.UNITYInitializerWriter import write_groovy_script
+from DaemonCerts.CertificateDatabase import CertificateDatabase
+from DaemonCerts.Inventory import Inventory
+from DaemonCerts.IssuingService import Issuer, IssueRequest
+
+from fixtures import daemon_args, build_tree, copy_tree
+
+BENCHMARK_DIR = dirname(abspath(__file__))
+SCRIPT = join(dirname(BENCHMARK_DIR), "CreateDaemonCerts.py")
+SIZES = [("small", 10), ("medium", 1000), ("large", 20000)]
+KEYS = [("RSA", 2048), ("RSA", 3072), ("ECDSA", 256), ("ECDSA", 384), ("Ed25519", 0)]
+BACKENDS = ["cryptography", "pyopenssl"]
+DN_COUNTS = [10, 1000, 10000]
+DATABASE_SIZE = 20000
+# Copies of a site tree with 9 keystores and 5 PEM files
+INVENTORY_SITES = 50
+SERVICE_REQUESTS = 16
+
+class Quiet(object):
+    # DaemonCerts reports every step on stdout
+    def __enter__(self):
+        self.stdout = sys.stdout
+        self.devnull = open(os.devnull, 'w')
+        sys.stdout = self.devnull
+
+    def __exit__(self, *args):
+        sys.stdout = self.stdout
+        self.devnull.close()
+
+
+class BenchmarkRun(object):
+    def __init__(self, workdir, repeat = 5, quick = False, name_filter = None):
+        super(BenchmarkRun,self).__init__()
+        self.workdir = workdir
+        self.repeat = repeat
+        self.sizes = SIZES[:2] if quick else SIZES
+        self.name_filter = name_filter
+        self.results = OrderedDict()
+
+    def add(self, name, function, setup = None, repeat = None):
+        # Times function repeat times. setup runs before every call and is not timed.
+        if self.name_filter is not None and not self.name_filter in name:
+            return
+        times = []
+        for _ in range(repeat or self.repeat):
+            with Quiet():
+                if setup is not None:
+                    setup()
+                start = timeit.default_timer()
+                function()
+                times.append(timeit.default_timer() - start)
+        times.sort()
+        self.results[name] = {"median" : times[len(times) // 2], "min" : times[0], "runs" : len(times)}
+        print("%-50s %10.2f ms (min %.2f ms, %d runs)" % (name, times[len(times) // 2] * 1000.0, times[0] * 1000.0, len(times)))
+        sys.stdout.flush()
+
+    def make_dc(self, directory, *args):
+        with Quiet():
+            return DaemonCerts(daemon_args(directory, *args))
+
+    def bench_startup(self):
+        # Complete interpreter runs of CreateDaemonCerts.py. Help, invalid settings and plans must not import
+        # the libraries of the paths they do not take (lxml, the crypto backends, ...).
+        # startup[python] is the interpreter alone.
+        def run(*args):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call([sys.executable] + list(args), stdout=devnull, stderr=devnull)
+        plan_dir = join(self.workdir, "startup")
+        # Writes the .pyc files of the first run outside the timing
+        run(SCRIPT)
+        self.add("startup[python]", lambda: run("-c", "pass"))
+        self.add("startup[help]", lambda: run(SCRIPT))
+        self.add("startup[invalid settings]", lambda: run(SCRIPT, "FQDN=bench.example.com", "Port.GATEWAY=none"))
+        self.add("startup[plan,fresh]", lambda: run(SCRIPT, "--plan", *daemon_args(plan_dir)))
+
+    def bench_settings(self):
+        args = daemon_args(self.workdir, "Port.GATEWAY=9090", "cert.Organization=Bench")
+        def parse():
+            dcs = DaemonCertsSettings()
+            dcs.parse_eq_args(args, createdicts=False)
+            dcs.finalize()
+        self.add("settings_parse", parse, repeat=self.repeat * 10)
+
+        # Site and fleet settings files, parsed every time and taken from the settings cache
+        settings_dir = join(self.workdir, "settings")
+        os.makedirs(settings_dir)
+        site_file = join(settings_dir, "site.yml")
+        fleet_file = join(settings_dir, "fleet.yml")
+        with Quiet():
+            template = DaemonCertsSettings()
+            template.parse_eq_args(args, createdicts=False)
+            template.finalize()
+        template.dump_to_file(site_file)
+        template.dump_to_file(fleet_file)
+        cache_dir = join(settings_dir, "cache")
+        def parse_files(use_cache):
+            dcs = DaemonCertsSettings()
+            dcs.load_layers(fleet_file=fleet_file, site_file=site_file, environ={}, args=args,
+                            cache_dir=cache_dir if use_cache else None)
+            dcs.finalize()
+        parse_files(True)
+        self.add("settings_parse[files]", lambda: parse_files(False), repeat=self.repeat * 10)
+        self.add("settings_parse[files,cached]", lambda: parse_files(True), repeat=self.repeat * 10)
+
+        dcs = DaemonCertsSettings()
+        dcs.parse_eq_args(args, createdicts=False)
+        dcs.finalize()
+        def lookup():
+            for _ in range(1000):
+                dcs.get_value("Domains.GATEWAY")
+                dcs.get_value("Port.GATEWAY")
+                dcs.Domains.UNITY
+        self.add("settings_lookup[3000 lookups]", lookup, repeat=self.repeat * 10)
+
+    def bench_certs(self):
+        for backend in BACKENDS:
+            for keytype, keysize in KEYS:
+                label = keytype if keytype == "Ed25519" else "%s-%d" % (keytype, keysize)
+                label = "%s,%s" % (label, backend)
+                args = ["cert.keytype=%s" % keytype, "cert.keysize=%d" % keysize, "incremental=False",
+                        "crypto.backend=%s" % backend]
+                if keytype == "Ed25519" and backend == "pyopenssl":
+                    # Ed25519 cannot sign with pyOpenSSL, see KeyGenerator.check_key_parameters
+                    args += ["cert.ca_keytype=ECDSA", "cert.ca_keysize=256"]
+                dc = self.make_dc(join(self.workdir, "certs-%s" % label.replace(",", "-")), *args)
+                with Quiet():
+                    dc.gen_ca()
+                p12_path = dc.get_p12_path("GATEWAY")
+                def remove_keystore():
+                    if os.path.isfile(p12_path):
+                        os.remove(p12_path)
+                self.add("gen_or_update_server_cert[%s]" % label, lambda: dc.gen_or_update_server_cert("GATEWAY"),
+                         setup=remove_keystore)
+                self.add("gen_or_update_server_cert[%s,existing key]" % label, lambda: dc.gen_or_update_server_cert("GATEWAY"))
+
+                if not os.path.isfile(p12_path):
+                    continue
+                passphrase = dc.dcs.get_value("KeystorePass.GATEWAY")
+                with open(p12_path, 'rb') as infile:
+                    key, cert = dc.crypto.load_pkcs12(infile.read(), passphrase)
+                self.add("pkcs12_export[%s]" % label, lambda: dc.crypto.export_pkcs12(key, cert, passphrase))
+
+    def bench_database(self):
+        # Lookups in a certificate database of DATABASE_SIZE certificates of 8 daemons per site
+        database = CertificateDatabase(join(self.workdir, "database"))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        rows = []
+        for serial in range(1, DATABASE_SIZE + 1):
+            site = "SITE-%d" % (serial // 8)
+            dn = "CN=SERVER%d,OU=IT,O=%s,L=Berlin,ST=Berlin,C=DE" % (serial % 8, site)
+            rows.append((serial, dn, "DNS:%s.example.com" % site.lower(), "SERVER%d" % (serial % 8), site,
+                         now + datetime.timedelta(days=serial % 3650), "%064x" % serial, now))
+        database.add_many(rows)
+        middle = DATABASE_SIZE // 2
+        self.add("database_lookup[serial]", lambda: database.by_serial(middle), repeat=self.repeat * 10)
+        self.add("database_lookup[dn]", lambda: database.by_dn(rows[middle][1]), repeat=self.repeat * 10)
+        self.add("database_lookup[site]", lambda: database.by_site(rows[middle][4]), repeat=self.repeat * 10)
+        self.add("database_lookup[expiring in 30 days]", lambda: database.expiring(now + datetime.timedelta(days=30)),
+                 repeat=self.repeat * 10)
+        database.close()
+
+    def bench_inventory(self):
+        site_dir = join(self.workdir, "inventory-site")
+        dc = self.make_dc(site_dir, "cert.keytype=ECDSA", "cert.keysize=256")
+        with Quiet():
+            dc.gen_ca()
+            for server in dc.servers:
+                dc.gen_or_update_server_cert(server)
+        sites_dir = join(self.workdir, "inventory")
+        for number in range(INVENTORY_SITES):
+            shutil.copytree(join(site_dir, "unicore"), join(sites_dir, "site%d" % number))
+        cache_path = join(self.workdir, "inventory.json")
+        inventory = Inventory(dc.dcs.get_value("KeystorePass"), cache_path=cache_path)
+        remove_cache = lambda: os.path.isfile(cache_path) and os.remove(cache_path)
+        label = "%d sites" % INVENTORY_SITES
+        self.add("inventory[%s]" % label, lambda: inventory.scan([sites_dir]), setup=remove_cache)
+        inventory.scan([sites_dir])
+        self.add("inventory[%s,cached]" % label, lambda: inventory.scan([sites_dir]))
+
+    def bench_service(self):
+        # Certificates of the issuing service, signed as one batch and as one batch per request
+        dc = self.make_dc(join(self.workdir, "service"), "cert.keytype=ECDSA", "cert.keysize=256")
+        with Quiet():
+            dc.gen_ca()
+        issuer = Issuer(dc)
+        requests = [IssueRequest("TSI", "node%d.example.com" % number) for number in range(SERVICE_REQUESTS)]
+        label = "%d requests" % SERVICE_REQUESTS
+        self.add("issue_batch[%s,one batch]" % label, lambda: issuer.issue_batch(requests))
+        self.add("issue_batch[%s,single requests]" % label, lambda: [issuer.issue_batch([request]) for request in requests])
+        issuer.close()
+
+    def bench_patchers(self):
+        for label, size in self.sizes:
+            template_dir = join(self.workdir, "fixture-%s" % label)
+            build_tree(self.make_dc(template_dir), size)
+            work_dir = join(self.workdir, "work-%s" % label)
+            copy_tree(template_dir, work_dir)
+            dc = self.make_dc(work_dir)
+            restore = lambda: copy_tree(join(template_dir, "unicore"), join(work_dir, "unicore"))
+
+            def update_xml():
+                for filename, attrib_and_value_dict in dc.static_xml_changes.items():
+                    dc.update_xml(filename, attrib_and_value_dict)
+            self.add("update_xml[%s]" % label, update_xml, setup=restore)
+
+            def change_one_key():
+                for filename, changelist in dc.static_plainfile_changes.items():
+                    key, value = changelist[0]
+                    dc.create_add_change_plain(filename, key, value)
+            self.add("create_add_change_plain[%s]" % label, change_one_key, setup=restore)
+
+            def change_all_keys():
+                for filename, changelist in dc.static_plainfile_changes.items():
+                    dc.apply_plain_changes(filename, changelist)
+            self.add("apply_plain_changes[%s]" % label, change_all_keys, setup=restore)
+
+    def bench_groovy(self):
+        for count in DN_COUNTS:
+            dn_list = [("SERVER%d" % number, "CN=SERVER%d,OU=IT,O=Bench,L=Berlin,ST=Berlin,C=DE" % number)
+                       for number in range(count)]
+            self.add("write_groovy_script[%d DNs]" % count, lambda: write_groovy_script(dn_list))
+
+    def bench_main(self):
+        for label, size in self.sizes:
+            template_dir = join(self.workdir, "fixture-%s" % label)
+            if not os.path.isdir(template_dir):
+                build_tree(self.make_dc(template_dir), size)
+            work_dir = join(self.workdir, "main-%s" % label)
+            def fresh_tree():
+                copy_tree(template_dir, work_dir)
+            def run_main():
+                dc = DaemonCerts(daemon_args(work_dir))
+                dc.main()
+            self.add("main[%s,fresh]" % label, run_main, setup=fresh_tree, repeat=max(1, self.repeat // 2))
+            self.add("main[%s,no changes]" % label, run_main)
+
+    def run(self):
+        self.bench_startup()
+        self.bench_settings()
+        self.bench_certs()
+        self.bench_database()
+        self.bench_inventory()
+        self.bench_service()
+        self.bench_patchers()
+        self.bench_groovy()
+        self.bench_main()
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    # Prints the change against the baseline and returns the names of the regressed benchmarks
+    regressions = []
+    for name, result in results.items():
+        if not name in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"] if baseline[name]["median"] > 0 else 1.0
+        marker = ""
+        if ratio > 1.0 + threshold:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        print("%-50s %+7.1f %%%s" % (name, (ratio - 1.0) * 100.0, marker))
+    return regressions
+
+
+def main(sysargs):
+    options = {"--output" : join(BENCHMARK_DIR, "results.json"),
+               "--baseline" : join(BENCHMARK_DIR, "baseline.json"),
+               "--threshold" : "0.25",
+               "--repeat" : "5",
+               "--filter" : None}
+    for arg in sysargs:
+        if "=" in arg and arg.split("=")[0] in options:
+            option, value = arg.split("=", 1)
+            options[option] = value
+
+    workdir = tempfile.mkdtemp(prefix="daemoncerts_bench_")
+    try:
+        benchmarks = BenchmarkRun(workdir, repeat=int(options["--repeat"]), quick="--quick" in sysargs,
+                                  name_filter=options["--filter"])
+        results = benchmarks.run()
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"version" : 1,
+              "python" : platform.python_version(),
+              "platform" : platform.platform(),
+              "time" : time.strftime("%Y-%m-%d %H:%M:%S"),
+              "results" : results}
+    target = options["--baseline"] if "--save-baseline" in sysargs else options["--output"]
+    with open(target, 'w') as out:
+        json.dump(report, out, indent=1)
+    print("Results written to %s" % target)
+
+    if "--save-baseline" in sysargs or not os.path.isfile(options["--baseline"]):
+        return 0
+    with open(options["--baseline"], 'r') as infile:
+        baseline = json.load(infile)["results"]
+    regressions = compare(results, baseline, float(options["--threshold"]))
+    if regressions:
+        print("%d benchmarks are slower than the baseline: %s" % (len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))